@@ -6,13 +6,27 @@ A FS object that integrates with Dropbox.
 
 """
 
+import os
+import re
 import time
+import calendar
+import datetime
 import shutil
+import sys
 import optparse
 import tempfile
 import logging
 import copy
-import pytz
+import fnmatch
+import hashlib
+import json
+import Queue
+import requests
+import threading
+from array import array
+from collections import OrderedDict
+from collections import deque
+from contextlib import contextmanager
 from UserDict import UserDict
 
 from fs.base import *
@@ -22,10 +36,18 @@ from fs.filelike import StringIO
 
 from dropbox import Dropbox
 from dropbox import DropboxOAuth2Flow
+from dropbox import create_session
+from dropbox.dropbox import RouteErrorResult
+from dropbox.dropbox import RouteResult
 from dropbox.exceptions import ApiError
 from dropbox.exceptions import BadInputError
+from dropbox.exceptions import InternalServerError
+from dropbox.files import CommitInfo
 from dropbox.files import DeletedMetadata
 from dropbox.files import FolderMetadata
+from dropbox.files import RelocationPath
+from dropbox.files import SearchMode
+from dropbox.files import UploadSessionCursor
 from dropbox.files import WriteMode
 
 LOGGER = logging.getLogger(__name__)
@@ -34,8 +56,63 @@ LOGGER = logging.getLogger(__name__)
 CACHE_TTL = 300
 # Max size for spooling to memory before using disk (5M).
 MAX_BUFFER = 1024 ** 2 * 5
+# Size of the chunks large files are uploaded in (8M).
+UPLOAD_CHUNK_SIZE = 1024 ** 2 * 8
 # Timezone to use for getinfo
 INFO_TIMEZONE = 'America/Indiana/Indianapolis'
+# Seconds to wait between checks of a running batch job.
+JOB_POLL_INTERVAL = 1
+# Size of the buffer reused while streaming a download (64K).
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+# Size of each byte range fetched by a parallel download (8M).
+SEGMENT_SIZE = 1024 ** 2 * 8
+# Number of byte ranges a parallel download fetches at once.
+SEGMENT_PARALLELISM = 4
+# Number of times a failed byte range is retried.
+SEGMENT_RETRIES = 3
+# Number of matches requested per page of search results (the API's max).
+SEARCH_PAGE_SIZE = 1000
+# Size of the blocks a materialized file is downloaded in (1M).
+MATERIALIZE_BLOCK_SIZE = 1024 ** 2
+# Accounts a DropboxPool keeps before dropping the least recently used.
+POOL_MAX_ACCOUNTS = 1000
+# Cached paths a DropboxPool keeps across all of its accounts.
+POOL_MAX_CACHED = 1000000
+# Seconds an account can sit unused in a DropboxPool before it is dropped.
+POOL_IDLE_TIMEOUT = 600
+# Connections a DropboxPool keeps open, shared by all of its accounts.
+POOL_MAX_CONNECTIONS = 32
+# Metadata misses under one folder that make us list the whole folder.
+PREFETCH_MISSES = 3
+# Seconds within which those misses have to happen.
+PREFETCH_WINDOW = 10
+# Folders DropboxFS.prefetch() lists at once.
+PREFETCH_PARALLELISM = 8
+# Key shared by a cache server and its clients, see serve_cache(). Change it
+# on hosts shared with untrusted users.
+CACHE_AUTHKEY = 'dropboxfs'
+# Fields of recorded API arguments and results that are replaced by a digest,
+# as they give access to an account or its files.
+RECORD_REDACTED = ('access_token', 'refresh_token', 'link', 'copy_reference')
+# Number of files DropboxSync transfers at once.
+SYNC_PARALLELISM = 8
+# Size of the blocks Dropbox content hashes are computed over.
+CONTENT_HASH_BLOCK_SIZE = 1024 ** 2 * 4
+# Priority classes of requests, see RequestScheduler. Requests are
+# interactive unless made within DropboxClient.priority(BULK).
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# Requests a DropboxClient runs at once.
+SCHEDULER_CONCURRENCY = 8
+# Requests each priority class may run at once, highest priority first. Bulk
+# requests always leave some room for interactive ones.
+SCHEDULER_LIMITS = ((INTERACTIVE, 8), (BULK, 6))
+
+
+class RevisionConflictError(OperationFailedError):
+    """Raised when a write expected another revision of the file than the
+    one on the server, i.e. it was changed since that revision was read."""
+    default_message = "Unable to %(opname)s, %(path)s was changed"
 
 
 class ContextManagerStream(object):
@@ -57,27 +134,89 @@ class ContextManagerStream(object):
 # tempfile.SpooledTemporaryFile, however I am unsure at this moment if doing
 # so would be bad since it is only available in Python 2.6+.
 
+class UploadSession(object):
+    """Uploads a file in chunks using an upload session. Each chunk is held
+    back until the next one arrives so the last one is sent along with the
+    commit, and a file that fits in one chunk is uploaded in one request."""
+    def __init__(self, client, path, mode=WriteMode.overwrite):
+        self.client = client
+        self.path = path
+        self.mode = mode
+        self.cursor = None
+        self.pending = None
+
+    def append(self, data):
+        if self.pending is not None:
+            try:
+                if self.cursor is None:
+                    result = self.client.files_upload_session_start(
+                        self.pending)
+                    self.cursor = UploadSessionCursor(
+                        result.session_id, len(self.pending))
+                else:
+                    self.client.files_upload_session_append_v2(
+                        self.pending, self.cursor)
+                    self.cursor.offset += len(self.pending)
+            except ApiError, e:
+                LOGGER.error(e, exc_info=True, extra={'stack': True,})
+                raise RemoteConnectionError(opname='put_file', path=self.path,
+                                            details=e)
+        self.pending = data
+
+    def finish(self):
+        "Commits the file and returns its metadata."
+        data = self.pending or ''
+        if self.cursor is None:
+            return self.client.files_upload(data, self.path, mode=self.mode)
+        try:
+            metadata = self.client.files_upload_session_finish(
+                data, self.cursor, CommitInfo(self.path, mode=self.mode))
+        except ApiError, e:
+            if self.mode.is_update() and e.error.is_path() and \
+                    e.error.get_path().is_conflict():
+                raise RevisionConflictError(opname='put_file', path=self.path,
+                                            details=e)
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname='put_file', path=self.path,
+                                        details=e)
+        self.client.cache.set(self.path, metadata)
+        return metadata
+
+
 class SpooledWriter(ContextManagerStream):
     """Spools bytes to a StringIO buffer until it reaches max_buffer. At that
-    point it switches to a temporary file."""
-    def __init__(self, client, name, max_buffer=MAX_BUFFER):
+    point it switches to a temporary file in spool_dir. On close the file is
+    uploaded in chunks of chunk_size."""
+    def __init__(self, client, name, max_buffer=MAX_BUFFER, spool_dir=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, mode=WriteMode.overwrite):
         self.client = client
+        self.mode = mode
         self.max_buffer = max_buffer
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
         self.bytes = 0
-        super(SpooledWriter, self).__init__(StringIO(), name)
+        # Skip the StringIO buffer when spooling to memory is disabled.
+        self.spooled = max_buffer <= 0
+        if self.spooled:
+            temp = tempfile.TemporaryFile(dir=spool_dir)
+        else:
+            temp = StringIO()
+        super(SpooledWriter, self).__init__(temp, name)
 
     def __len__(self):
         return self.bytes
 
     def write(self, data):
-        if self.temp.tell() + len(data) >= self.max_buffer:
+        if not self.spooled and \
+                self.temp.tell() + len(data) >= self.max_buffer:
             # We reached the max_buffer size that we want to keep in memory.
             # Switch to an on-disk temp file. Copy what has been written so
             # far to it.
-            temp = tempfile.TemporaryFile()
+            temp = tempfile.TemporaryFile(dir=self.spool_dir)
             self.temp.seek(0)
             shutil.copyfileobj(self.temp, temp)
             self.temp = temp
+            self.spooled = True
         self.temp.write(data)
         self.bytes += len(data)
 
@@ -86,13 +225,56 @@ class SpooledWriter(ContextManagerStream):
         if hasattr(self.temp, 'flush'):
             self.temp.flush()
         self.temp.seek(0)
-        self.client.files_upload(
-            self.temp.read(),
-            self.name,
-            mode=WriteMode.overwrite)
+        session = UploadSession(self.client, self.name, mode=self.mode)
+        for chunk in iter(lambda: self.temp.read(self.chunk_size), ''):
+            session.append(chunk)
+        self.metadata = session.finish()
         self.temp.close()
 
 
+class SessionWriter(ContextManagerStream):
+    """Writes straight into an upload session without spooling, holding at
+    most a couple of chunks in memory. Meant for streams of known length,
+    which is checked on close."""
+    def __init__(self, client, name, size=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, mode=WriteMode.overwrite):
+        self.session = UploadSession(client, name, mode=mode)
+        self.size = size
+        self.chunk_size = chunk_size
+        self.bytes = 0
+        self.closed = False
+        self.buf = bytearray()
+        super(SessionWriter, self).__init__(self.buf, name)
+
+    def __len__(self):
+        return self.bytes
+
+    def tell(self):
+        return self.bytes
+
+    def flush(self):
+        "Chunks are uploaded as they fill up, so there is nothing to flush."
+
+    def write(self, data):
+        self.buf += data
+        self.bytes += len(data)
+        while len(self.buf) >= self.chunk_size:
+            self.session.append(str(self.buf[:self.chunk_size]))
+            del self.buf[:self.chunk_size]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.size is not None and self.bytes != self.size:
+            raise OperationFailedError(
+                opname='put_file', path=self.name,
+                msg='Wrote %d bytes, expected %d' % (self.bytes, self.size))
+        if self.buf:
+            self.session.append(str(self.buf))
+        self.metadata = self.session.finish()
+
+
 class ChunkedReader(ContextManagerStream):
     """ A file-like that provides access to a file with dropbox API"""
     """Reads the file from the remote server as requested.
@@ -111,6 +293,12 @@ class ChunkedReader(ContextManagerStream):
         self.closed = False
         self.pos = 0
         self.seek_pos = 0
+        # Read ahead by readline(), of which buf[offset:] was not returned
+        # yet. It always ends at pos, which is kept equal to seek_pos while
+        # it is not empty. Returned bytes are only dropped from the front
+        # once per chunk read rather than once per line.
+        self.buf = ''
+        self.offset = 0
         super(ChunkedReader, self).__init__(self.r, name)
 
     def __len__(self):
@@ -125,28 +313,57 @@ class ChunkedReader(ContextManagerStream):
         object.
         """
         if (whence == 0):
-            self.seek_pos = offset
+            target = offset
         elif (whence == 1):
-            self.seek_pos += offset
+            target = self.tell() + offset
         elif (whence == 2):
-            self.seek_pos = self.size + offset
+            target = self.size + offset
+        start = self.seek_pos - len(self.buf)
+        if self.buf and start <= target <= self.seek_pos:
+            # Still within what was read ahead, keep the rest of it.
+            self.offset = target - start
+        else:
+            self._clear()
+            self.seek_pos = target
 
     def tell(self):
         """ Return the current stream position. """
-        return self.seek_pos
+        return self.seek_pos - self._buffered()
+
+    def _buffered(self):
+        return len(self.buf) - self.offset
+
+    def _clear(self):
+        self.buf = ''
+        self.offset = 0
 
     def next(self):
         """
-        Read the data until all data is read.
-        data is empty string when there is no more data to read.
+        Return the next line, stopping when all data is read.
         """
-        data = self.read()
-        if data is None:
+        # Lines already read ahead are served without a readline() call.
+        end = self.buf.find('\n', self.offset) + 1
+        if end:
+            line = self.buf[self.offset:end]
+            self.offset = end
+            return line
+        line = self.readline()
+        if not line:
             raise StopIteration()
-        return data
+        return line
 
     def read(self, amt=None):
         """ Read a piece of the file from dropbox. """
+        buffered = self._buffered()
+        if amt and amt <= buffered:
+            data = self.buf[self.offset:self.offset + amt]
+            self.offset += amt
+            return data
+        data = self.buf[self.offset:]
+        self._clear()
+        return data + self._read(amt - len(data) if amt else amt)
+
+    def _read(self, amt=None):
         if not self.r.closed:
             # Do some fake seeking
             if self.seek_pos < self.pos:
@@ -156,30 +373,72 @@ class ChunkedReader(ContextManagerStream):
                 self.r.read(self.seek_pos)
             elif self.seek_pos > self.pos:
                 # Read ahead enough to reconcile pos and seek_pos
-                self.r.read(self.pos - self.seek_pos)
-            self.pos = self.seek_pos
-
-            # Update position pointers
-            if amt:
-                self.pos += amt
-                self.seek_pos += amt
-            else:
-                self.pos = self.bytes
-                self.seek_pos = self.bytes
-            return self.r.read(amt)
+                self.r.read(self.seek_pos - self.pos)
+            data = self.r.read(amt)
+            # Update position pointers by what was actually read, which is
+            # less than amt at the end of the file.
+            self.pos = self.seek_pos = self.seek_pos + len(data)
+            return data
         else:
             self.close()
             return ''
 
+    def readinto(self, b):
+        """
+        Read up to len(b) bytes into the writable buffer b and return the
+        number of bytes read. Sequential reads go straight into b.
+        """
+        if self._buffered() or self.r.closed or self.seek_pos != self.pos:
+            data = self.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+        self._clear()
+        amt = self.r.readinto(b)
+        self.pos += amt
+        self.seek_pos += amt
+        return amt
+
     def readline(self, size=-1):
-        """ Not implemented. Read and return one line from the stream. """
-        raise NotImplementedError()
+        """
+        Read and return one line from the stream, or at most size bytes of
+        it. The stream is read ahead in chunks which are kept in one buffer
+        and scanned for the newline.
+        """
+        scanned = self.offset
+        while True:
+            end = self.buf.find('\n', scanned) + 1
+            if end:
+                break
+            if 0 <= size <= self._buffered():
+                end = self.offset + size
+                break
+            self.buf = self.buf[self.offset:]
+            self.offset = 0
+            scanned = len(self.buf)
+            data = self._read(DOWNLOAD_CHUNK_SIZE)
+            if not data:
+                end = len(self.buf)
+                break
+            self.buf += data
+        if 0 <= size < end - self.offset:
+            end = self.offset + size
+        line = self.buf[self.offset:end]
+        self.offset = end
+        return line
 
     def readlines(self, hint=-1):
         """
-        Not implemented. Read and return a list of lines from the stream.
+        Read and return a list of lines from the stream, stopping once the
+        lines add up to hint bytes if it is given.
         """
-        raise NotImplementedError()
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
 
     def writable(self):
         """ The stream does not support writing. """
@@ -202,6 +461,155 @@ class ChunkedReader(ContextManagerStream):
             self.closed = True
 
 
+class MaterializedFile(object):
+    """A local copy of a remote file, memory mapped for reading. The copy
+    starts out as a sparse file and is downloaded block by block as ranges
+    of it are read. It is shared by all readers of the file and removed
+    once the last one closes.
+
+    lock guards the count of readers. Owners that hand the file out pass
+    their own lock, and on_close is called with it held, so the file can
+    not be handed out again while it is being closed."""
+    # States of the blocks.
+    MISSING, FETCHING, FETCHED = range(3)
+
+    def __init__(self, client, metadata, link, on_close=None,
+                 block_size=MATERIALIZE_BLOCK_SIZE, lock=None):
+        self.client = client
+        self.metadata = metadata
+        self.link = link
+        self.on_close = on_close
+        self.block_size = block_size
+        self.size = metadata.size
+        self.blocks = bytearray((self.size + block_size - 1) // block_size)
+        # Signalled whenever blocks being fetched are done, only held while
+        # looking at blocks and never during a download.
+        self.fetched = threading.Condition(threading.Lock())
+        self.lock = lock or threading.RLock()
+        self.refs = 0
+        self.temp = tempfile.TemporaryFile()
+        self.temp.truncate(self.size)
+        # Zero length files can not be mapped.
+        self.map = ''
+        if self.size:
+            import mmap
+            self.map = mmap.mmap(self.temp.fileno(), self.size,
+                                 access=mmap.ACCESS_READ)
+
+    def fetch(self, start, end):
+        """Makes sure bytes start to end (exclusive) have been downloaded.
+        Readers download different blocks concurrently, and wait for blocks
+        another reader is already downloading."""
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        runs = []
+        with self.fetched:
+            block = first
+            while block <= last:
+                if self.blocks[block] != self.MISSING:
+                    block += 1
+                    continue
+                # Download each run of missing blocks with one request.
+                run = block
+                while run <= last and self.blocks[run] == self.MISSING:
+                    run += 1
+                self.mark(block, run, self.FETCHING)
+                runs.append((block, run))
+                block = run
+        try:
+            while runs:
+                block, run = runs[0]
+                self.client.download_range(
+                    self.link, block * self.block_size,
+                    min(run * self.block_size, self.size) - 1,
+                    self.temp.fileno())
+                with self.fetched:
+                    self.mark(block, run, self.FETCHED)
+                    self.fetched.notify_all()
+                runs.pop(0)
+        finally:
+            if runs:
+                # Let another reader download what this one could not.
+                with self.fetched:
+                    for block, run in runs:
+                        self.mark(block, run, self.MISSING)
+                    self.fetched.notify_all()
+        with self.fetched:
+            while self.FETCHING in self.blocks[first:last + 1]:
+                self.fetched.wait()
+            missing = self.MISSING in self.blocks[first:last + 1]
+        if missing:
+            # Another reader failed to download some of them.
+            self.fetch(start, end)
+
+    def mark(self, block, run, state):
+        self.blocks[block:run] = bytearray([state]) * (run - block)
+
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+            if self.on_close:
+                self.on_close(self)
+        # Nobody can get hold of the file any more, so it is safe to close.
+        if self.size:
+            self.map.close()
+        self.temp.close()
+
+
+class MappedReader(ContextManagerStream):
+    """A read only file-like over a MaterializedFile. Each reader keeps its
+    own position while sharing the file's mapping with other readers. The
+    reader takes over a reference to the file acquired for it, which it
+    releases on close."""
+    def __init__(self, shared, name):
+        super(MappedReader, self).__init__(shared, name)
+        self.shared = shared
+        self.pos = 0
+        self.closed = False
+
+    def __len__(self):
+        return self.shared.size
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = self.shared.size + offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.shared.size
+        else:
+            end = min(self.pos + size, self.shared.size)
+        if end <= self.pos:
+            return ''
+        self.shared.fetch(self.pos, end)
+        data = self.shared.map[self.pos:end]
+        self.pos = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.release()
+
+
 class CacheItem(object):
     """Represents a path in the cache. There are two components to a path.
     It's individual metadata, and the children contained within it."""
@@ -212,20 +620,37 @@ class CacheItem(object):
             timestamp = time.time()
         self.timestamp = timestamp
 
+    def _get_children(self):
+        return self._children
+
+    def _set_children(self, children):
+        self._children = children
+        # Lower cased names of the children, to look them up in large
+        # folders without scanning the list.
+        self.names = None
+        if children is not None:
+            self.names = set(c.lower() for c in children)
+    children = property(_get_children, _set_children)
+
+    def has_child(self, name):
+        return self.names is not None and name.lower() in self.names
+
     def add_child(self, name):
         if self.children is None:
             self.children = [name]
-        else:
+        elif name.lower() not in self.names:
             self.children.append(name)
+            self.names.add(name.lower())
 
     def del_child(self, name):
-        if self.children is None:
-            return
-        try:
-            i = self.children.index(name)
-        except ValueError:
+        if not self.has_child(name):
             return
-        self.children.pop(i)
+        name = name.lower()
+        self.names.discard(name)
+        for i, child in enumerate(self.children):
+            if child.lower() == name:
+                self.children.pop(i)
+                return
 
     def _get_expired(self):
         if self.timestamp <= time.time() - CACHE_TTL:
@@ -237,21 +662,614 @@ class CacheItem(object):
 
 
 class DropboxCache(UserDict):
+    """Maps paths to CacheItems. Dropbox paths are case insensitive, so
+    items are keyed by the lower cased path (as in path_lower) and any
+    casing a caller uses finds the same item. Display names are kept in the
+    items' metadata and children.
+
+    Items that are changed are stored again, so subclasses can keep copies
+    of them elsewhere, see SharedDropboxCache. The metadata stored is also
+    passed on to a TreeIndex, if one is set."""
+    index = None
+
+    def _key(self, path):
+        return path.lower()
+
+    def __getitem__(self, path):
+        return self.data[self._key(path)]
+
+    def __setitem__(self, path, item):
+        self.data[self._key(path)] = item
+        if self.index is not None and item.metadata is not None:
+            self.index.set(path, item.metadata)
+
+    def __delitem__(self, path):
+        del self.data[self._key(path)]
+
+    def __contains__(self, path):
+        return self._key(path) in self.data
+
+    def get(self, path, default=None):
+        return self.data.get(self._key(path), default)
+
+    def update(self, items):
+        self.data.update(dict(
+            (self._key(path), item) for path, item in items.iteritems()))
+        if self.index is not None:
+            for path, item in items.iteritems():
+                if item.metadata is not None:
+                    self.index.set(path, item.metadata)
+
     def set(self, path, metadata):
         self[path] = CacheItem(metadata)
         dname, bname = pathsplit(path)
         item = self.get(dname)
-        if item:
-            item.add_child(bname)
+        name = getattr(metadata, 'name', None) or bname
+        # Only extend a folder's children if they were listed, otherwise
+        # the folder would look like it only contains this one child.
+        if item and item.children is not None and not item.has_child(name):
+            item.add_child(name)
+            self[dname] = item
+
+    def set_parents(self, path):
+        """Records that the folders above path exist, as they do once a
+        folder was created with any missing parents."""
+        while path != '/':
+            dname, bname = pathsplit(path)
+            item = self.get(dname)
+            changed = False
+            if item and item.children is not None and \
+                    not item.has_child(bname):
+                item.add_child(bname)
+                changed = True
+            if dname != '/' and (not item or item.metadata is None):
+                metadata = FolderMetadata(name=basename(dname),
+                                          path_lower=dname.lower(),
+                                          path_display=dname)
+                if item:
+                    item.metadata = metadata
+                else:
+                    item = CacheItem(metadata)
+                changed = True
+            if changed:
+                self[dname] = item
+            path = dname
 
     def pop(self, path, default=None):
-        value = UserDict.pop(self, path, default)
+        value = self.data.pop(self._key(path), default)
+        if self.index is not None:
+            self.index.remove(path)
         dname, bname = pathsplit(path)
         item = self.get(dname)
-        if item:
+        if item and item.has_child(bname):
             item.del_child(bname)
+            self[dname] = item
         return value
 
+    def pop_tree(self, path):
+        "Removes a path and everything cached below it."
+        prefix = self._key(path.rstrip('/') + '/')
+        for key in [k for k in self.data.keys() if k.startswith(prefix)]:
+            del self.data[key]
+        self.pop(path, None)
+
+    def move(self, src, dst, metadata):
+        "Records that src was moved to dst, along with everything below it."
+        # Moved first, so the index keeps the totals of the tree.
+        if self.index is not None:
+            self.index.move(src, dst, metadata)
+        self.pop_tree(src)
+        self.set(dst, metadata)
+
+
+_shared_cache = {}
+
+
+def _get_shared_cache():
+    return _shared_cache
+
+
+# Created by cache_manager(), so multiprocessing is only imported once a
+# shared cache is used.
+_cache_manager_class = None
+
+
+def cache_manager(address, authkey=CACHE_AUTHKEY):
+    "Returns a manager for the cache server at address, see serve_cache()."
+    global _cache_manager_class
+    if _cache_manager_class is None:
+        from multiprocessing.managers import BaseManager
+        from multiprocessing.managers import DictProxy
+
+        class CacheManager(BaseManager):
+            "Serves the dict behind SharedDropboxCache."
+
+        CacheManager.register('get_cache', callable=_get_shared_cache,
+                              proxytype=DictProxy)
+        _cache_manager_class = CacheManager
+    return _cache_manager_class(address=address, authkey=authkey)
+
+
+def serve_cache(address, authkey=CACHE_AUTHKEY):
+    """Runs a cache server for SharedDropboxCache until it is killed, e.g.
+    next to the workers of a prefork server. address is the path of a Unix
+    socket, or a (host, port) pair."""
+    cache_manager(address, authkey).get_server().serve_forever()
+
+
+class SharedDropboxCache(DropboxCache):
+    """A DropboxCache kept by a cache server, so the processes on a host
+    share one cache instead of each listing the same folders. Items expire
+    and are invalidated just as in DropboxCache. Each account uses its own
+    prefix for its keys, though len() counts the items of all accounts.
+
+    If the server can not be reached, or stops responding, the cache falls
+    back to a dict in this process."""
+    def __init__(self, address, prefix='', authkey=CACHE_AUTHKEY):
+        DropboxCache.__init__(self)
+        self.prefix = prefix
+        from multiprocessing import ProcessError
+        try:
+            manager = cache_manager(address, authkey)
+            manager.connect()
+            self.data = manager.get_cache()
+        except (IOError, EOFError, ProcessError), e:
+            LOGGER.warning('Cache server %s is unavailable: %s', address, e)
+        else:
+            self.data = FallbackProxy(self.data, address)
+
+    def _key(self, path):
+        return self.prefix + path.lower()
+
+    def clear(self):
+        "Removes this account's items, leaving those of others alone."
+        self.pop_tree('/')
+
+
+class FallbackProxy(object):
+    """Passes dict operations on to a proxy of a dict in a cache server, and
+    to a local dict once the server is gone."""
+    def __init__(self, proxy, address):
+        self.proxy = proxy
+        self.address = address
+        self.local = {}
+
+    def _call(self, name, *args):
+        if self.proxy is not None:
+            try:
+                return getattr(self.proxy, name)(*args)
+            except (IOError, EOFError), e:
+                LOGGER.warning('Lost cache server %s: %s', self.address, e)
+                self.proxy = None
+        return getattr(self.local, name)(*args)
+
+    def __getitem__(self, key):
+        return self._call('__getitem__', key)
+
+    def __setitem__(self, key, item):
+        self._call('__setitem__', key, item)
+
+    def __delitem__(self, key):
+        self._call('__delitem__', key)
+
+    def __contains__(self, key):
+        return self._call('__contains__', key)
+
+    def __len__(self):
+        return self._call('__len__')
+
+    def get(self, key, default=None):
+        return self._call('get', key, default)
+
+    def pop(self, key, default=None):
+        return self._call('pop', key, default)
+
+    def update(self, items):
+        self._call('update', items)
+
+    def keys(self):
+        return self._call('keys')
+
+
+class TreeIndex(object):
+    """An index of everything below a folder in Dropbox that keeps the total
+    size and number of files below each folder, see DropboxFS.build_index().
+
+    Nodes are stored in arrays rather than as objects, so millions of them
+    fit in memory. A change updates the totals of the folders above it, so
+    total() answers straight away. largest() and modified_since() sort the
+    files once after each change and then walk that ordering."""
+    def __init__(self, path='/', pages=()):
+        self.path = abspath(normpath(path))
+        self.root = self.path.lower()
+        self.lock = threading.RLock()
+        self.names = []
+        self.parent = array('l')
+        # Children are linked lists, through each node's neighbours.
+        self.first = array('l')
+        self.next = array('l')
+        self.prev = array('l')
+        # 1 for folders, 0 for files and -1 for free nodes.
+        self.kind = array('b')
+        # A file's own size and 1, or the totals below a folder.
+        self.size = array('d')
+        self.files = array('l')
+        self.mtime = array('d')
+        self.free = []
+        self.nodes = {self.root: self._alloc(-1, basename(self.path), 1)}
+        self.orders = {}
+        # Parents come before their children in a listing, so children get
+        # higher node numbers and the totals can be added up at the end.
+        for page in pages:
+            for entry in page:
+                if not isinstance(entry, DeletedMetadata):
+                    self._set(entry.path_lower, entry, propagate=False)
+        for node in xrange(len(self.kind) - 1, 0, -1):
+            parent = self.parent[node]
+            self.size[parent] += self.size[node]
+            self.files[parent] += self.files[node]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, path):
+        return abspath(normpath(path)).lower() in self.nodes
+
+    def _alloc(self, parent, name, kind):
+        if self.free:
+            node = self.free.pop()
+            self.names[node] = name
+            for column, value in ((self.parent, parent), (self.kind, kind),
+                                  (self.size, 0), (self.files, 0),
+                                  (self.mtime, 0), (self.first, -1)):
+                column[node] = value
+        else:
+            node = len(self.kind)
+            self.names.append(name)
+            for column, value in ((self.parent, parent), (self.kind, kind),
+                                  (self.size, 0), (self.files, 0),
+                                  (self.mtime, 0), (self.first, -1),
+                                  (self.next, -1), (self.prev, -1)):
+                column.append(value)
+        if parent != -1:
+            self._link(node, parent)
+        return node
+
+    def _link(self, node, parent):
+        self.parent[node] = parent
+        self.prev[node] = -1
+        self.next[node] = self.first[parent]
+        if self.first[parent] != -1:
+            self.prev[self.first[parent]] = node
+        self.first[parent] = node
+
+    def _unlink(self, node):
+        if self.prev[node] != -1:
+            self.next[self.prev[node]] = self.next[node]
+        else:
+            self.first[self.parent[node]] = self.next[node]
+        if self.next[node] != -1:
+            self.prev[self.next[node]] = self.prev[node]
+
+    def _propagate(self, node, size, files):
+        node = self.parent[node]
+        while node != -1:
+            self.size[node] += size
+            self.files[node] += files
+            node = self.parent[node]
+
+    def _subtree(self, node):
+        "Yields node and every node below it."
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            child = self.first[node]
+            while child != -1:
+                stack.append(child)
+                child = self.next[child]
+
+    def _path(self, node):
+        names = []
+        while node != 0:
+            names.append(self.names[node])
+            node = self.parent[node]
+        return pathjoin(self.path, *reversed(names))
+
+    def _below(self, node, ancestor):
+        while node != -1:
+            if node == ancestor:
+                return True
+            node = self.parent[node]
+        return False
+
+    def _inside(self, key):
+        return key == self.root or key.startswith(self.root.rstrip('/') + '/')
+
+    def _folder(self, path):
+        "Returns the node of a folder, adding it and its parents if missing."
+        key = path.lower()
+        node = self.nodes.get(key)
+        if node is None:
+            node = self._alloc(self._folder(dirname(path)), basename(path), 1)
+            self.nodes[key] = node
+        return node
+
+    def set(self, path, metadata):
+        "Adds or updates a path below the indexed folder."
+        with self.lock:
+            self._set(path, metadata)
+
+    def _set(self, path, metadata, propagate=True):
+        path = abspath(normpath(path))
+        key = path.lower()
+        if key == self.root or not self._inside(key):
+            return
+        if isinstance(metadata, DeletedMetadata):
+            return self._remove(key)
+        kind = int(isinstance(metadata, FolderMetadata))
+        node = self.nodes.get(key)
+        if node is not None and self.kind[node] != kind:
+            self._remove(key)
+            node = None
+        if node is None:
+            node = self._alloc(self._folder(dirname(path)), None, kind)
+            self.nodes[key] = node
+            if not kind:
+                self.files[node] = 1
+                if propagate:
+                    self._propagate(node, 0, 1)
+        self.names[node] = getattr(metadata, 'name', None) or basename(path)
+        if not kind:
+            size = getattr(metadata, 'size', None) or 0
+            if propagate:
+                self._propagate(node, size - self.size[node], 0)
+            self.size[node] = size
+            modified = getattr(metadata, 'server_modified', None)
+            if modified is not None:
+                self.mtime[node] = calendar.timegm(modified.utctimetuple())
+        self.orders.clear()
+
+    def remove(self, path):
+        "Removes a path and everything below it."
+        with self.lock:
+            self._remove(abspath(normpath(path)).lower())
+
+    def _remove(self, key):
+        node = self.nodes.get(key)
+        if node is None or node == 0:
+            return
+        self._propagate(node, -self.size[node], -self.files[node])
+        for child, key in [(child, self._path(child).lower())
+                           for child in self._subtree(node)]:
+            del self.nodes[key]
+            self.kind[child] = -1
+            self.names[child] = None
+            self.free.append(child)
+        self._unlink(node)
+        self.orders.clear()
+
+    def move(self, src, dst, metadata):
+        "Moves a path and everything below it, keeping their totals."
+        src, dst = abspath(normpath(src)), abspath(normpath(dst))
+        with self.lock:
+            node = self.nodes.get(src.lower())
+            if node is None or node == 0 or not self._inside(dst.lower()):
+                self._remove(src.lower())
+                self._set(dst, metadata)
+                return
+            self._remove(dst.lower())
+            moved = [(child, self._path(child).lower())
+                     for child in self._subtree(node)]
+            self._propagate(node, -self.size[node], -self.files[node])
+            self._unlink(node)
+            self._link(node, self._folder(dirname(dst)))
+            self.names[node] = getattr(metadata, 'name', None) or \
+                basename(dst)
+            self._propagate(node, self.size[node], self.files[node])
+            for child, key in moved:
+                del self.nodes[key]
+            for child, key in moved:
+                self.nodes[self._path(child).lower()] = child
+            self.orders.clear()
+
+    def total(self, path):
+        """Returns the total size and number of files below a folder, or the
+        size of a file and 1."""
+        with self.lock:
+            node = self.nodes.get(abspath(normpath(path)).lower())
+            if node is None:
+                raise ResourceNotFoundError(path)
+            return int(self.size[node]), self.files[node]
+
+    def _order(self, column, kind):
+        "Returns the nodes of a kind, by the values of column descending."
+        order = self.orders.get((column, kind))
+        if order is None:
+            values = getattr(self, column)
+            order = array('l', sorted(
+                (n for n in xrange(1, len(self.kind)) if self.kind[n] == kind),
+                key=values.__getitem__, reverse=True))
+            self.orders[column, kind] = order
+        return order
+
+    def largest(self, count, path=None, folders=False):
+        """Returns the paths and sizes of the count largest files, or
+        folders, below path, by default the indexed folder."""
+        with self.lock:
+            path = abspath(normpath(path or self.path))
+            top = self.nodes.get(path.lower())
+            if top is None:
+                raise ResourceNotFoundError(path)
+            found = []
+            for node in self._order('size', int(folders)):
+                if len(found) == count:
+                    break
+                if node != top and self._below(node, top):
+                    found.append((self._path(node), int(self.size[node])))
+            return found
+
+    def modified_since(self, when, path=None):
+        """Returns the paths of the files below path modified at or after
+        when, a naive UTC or aware datetime or a timestamp, most recently
+        modified first. path defaults to the indexed folder."""
+        if isinstance(when, datetime.datetime):
+            when = calendar.timegm(when.utctimetuple())
+        with self.lock:
+            path = abspath(normpath(path or self.path))
+            top = self.nodes.get(path.lower())
+            if top is None:
+                raise ResourceNotFoundError(path)
+            found = []
+            for node in self._order('mtime', 0):
+                if self.mtime[node] < when:
+                    break
+                if self._below(node, top):
+                    found.append(self._path(node))
+            return found
+
+
+def redact(data):
+    """Replaces the values of RECORD_REDACTED fields in JSON data by a digest
+    of them, so equal values still match. Returns the data as JSON with its
+    keys sorted."""
+    def walk(value):
+        if isinstance(value, dict):
+            return dict((k, digest(v) if k in RECORD_REDACTED else walk(v))
+                        for k, v in value.items())
+        if isinstance(value, list):
+            return [walk(v) for v in value]
+        return value
+
+    def digest(value):
+        if isinstance(value, basestring) and value.startswith('redacted:'):
+            return value
+        value = json.dumps(value).encode('utf8')
+        return 'redacted:' + hashlib.sha1(value).hexdigest()[:16]
+
+    return json.dumps(walk(json.loads(data)), sort_keys=True)
+
+
+class TrafficRecorder(object):
+    """Records the API calls of the clients it is set as the recorder of:
+    their route, arguments and result, when they were made, how long they
+    took and the size of the file contents sent and received. The contents
+    themselves are not kept and values that give access are redacted, see
+    redact(). The access token is never part of a call. Recorded calls can
+    be replayed with ReplayClient."""
+    def __init__(self, calls=None):
+        self.calls = calls or []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def record(self, route, arg, started, **kwargs):
+        "Records a call to route with JSON arguments arg, made at started."
+        call = dict(kwargs, route=route, arg=redact(arg),
+                    time=started - self.started,
+                    latency=time.time() - started)
+        if call.get('result') is not None:
+            call['result'] = redact(call['result'])
+        with self.lock:
+            self.calls.append(call)
+
+    def dump(self, f):
+        "Writes the recorded calls to a file, one JSON object per line."
+        with self.lock:
+            for call in self.calls:
+                f.write(json.dumps(call, sort_keys=True) + '\n')
+
+    @classmethod
+    def load(cls, f):
+        "Reads calls written by dump()."
+        return cls([json.loads(line) for line in f if line.strip()])
+
+
+def payload_size(data):
+    "Returns the size of the contents of an upload, or None if unknown."
+    if data is None:
+        return 0
+    if isinstance(data, basestring):
+        return len(data)
+    try:
+        return os.fstat(data.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+class RequestScheduler(object):
+    """Decides when the requests of a client run. At most concurrency
+    requests run at once, and at most the limit of their priority class.
+    Waiting requests are let through by priority, and within a class in the
+    order they arrived. A running request is never interrupted, but as bulk
+    requests can not take every slot, an interactive one waits for at most
+    the requests ahead of it in its own class."""
+    def __init__(self, concurrency=SCHEDULER_CONCURRENCY,
+                 limits=SCHEDULER_LIMITS):
+        self.concurrency = concurrency
+        self.limits = OrderedDict(limits)
+        self.lock = threading.Lock()
+        self.running = dict.fromkeys(self.limits, 0)
+        self.queues = dict((name, deque()) for name in self.limits)
+        self.requests = dict.fromkeys(self.limits, 0)
+        self.waited = dict.fromkeys(self.limits, 0.0)
+        self.max_waited = dict.fromkeys(self.limits, 0.0)
+
+    def _admit(self):
+        "Lets through the waiting requests that may run, by priority."
+        running = sum(self.running.itervalues())
+        for name, limit in self.limits.iteritems():
+            queue = self.queues[name]
+            while queue and running < self.concurrency and \
+                    self.running[name] < limit:
+                queue.popleft().set()
+                self.running[name] += 1
+                running += 1
+
+    def acquire(self, priority):
+        "Waits until a request of a priority class may run."
+        ready = threading.Event()
+        started = time.time()
+        with self.lock:
+            self.queues[priority].append(ready)
+            self._admit()
+        ready.wait()
+        waited = time.time() - started
+        with self.lock:
+            self.requests[priority] += 1
+            self.waited[priority] += waited
+            self.max_waited[priority] = max(self.max_waited[priority], waited)
+
+    def release(self, priority):
+        "Ends a request, letting the next waiting one run."
+        with self.lock:
+            self.running[priority] -= 1
+            self._admit()
+
+    @contextmanager
+    def slot(self, priority):
+        "Runs the block as a request of a priority class."
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def metrics(self):
+        """Returns, for each priority class, the requests running and queued
+        now, the requests made and the total and longest seconds they waited
+        to run."""
+        with self.lock:
+            return dict((name, {
+                'running': self.running[name],
+                'queued': len(self.queues[name]),
+                'requests': self.requests[name],
+                'wait': self.waited[name],
+                'max_wait': self.max_waited[name],
+            }) for name in self.limits)
+
 
 class DropboxClient(Dropbox):
     """A wrapper around the official Dropbox client. This wrapper performs
@@ -259,6 +1277,67 @@ class DropboxClient(Dropbox):
     def __init__(self, *args, **kwargs):
         super(DropboxClient, self).__init__(*args, **kwargs)
         self.cache = DropboxCache()
+        # Set to 0 to disable prefetching siblings on repeated misses.
+        self.prefetch_misses = PREFETCH_MISSES
+        self.misses = {}
+        # Set to a TrafficRecorder to record the API calls made.
+        self.recorder = None
+        # Decides when requests run, by the priority of their thread.
+        self.scheduler = RequestScheduler()
+        self.local = threading.local()
+
+    @contextmanager
+    def priority(self, priority):
+        """Makes the requests this thread makes within the block run with a
+        priority class of the scheduler, e.g. BULK for background work."""
+        if priority not in self.scheduler.limits:
+            raise ValueError('Unknown priority: %s' % priority)
+        previous = self.current_priority()
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def current_priority(self):
+        return getattr(self.local, 'priority', INTERACTIVE)
+
+    def request_json_string_with_retry(self, host, route_name, route_style,
+                                       request_json_arg, request_binary,
+                                       timeout=None):
+        "Makes an API request once the scheduler lets it run."
+        with self.scheduler.slot(self.current_priority()):
+            return self._request(host, route_name, route_style,
+                                 request_json_arg, request_binary, timeout)
+
+    def _request(self, host, route_name, route_style, request_json_arg,
+                 request_binary, timeout):
+        "Makes an API request, recording it if there is a recorder."
+        request = super(DropboxClient, self).request_json_string_with_retry
+        if self.recorder is None:
+            return request(host, route_name, route_style, request_json_arg,
+                           request_binary, timeout=timeout)
+        upload = payload_size(request_binary)
+        started = time.time()
+        try:
+            res = request(host, route_name, route_style, request_json_arg,
+                          request_binary, timeout=timeout)
+        except Exception, e:
+            self.recorder.record(route_name, request_json_arg, started,
+                                 upload=upload, exception=type(e).__name__)
+            raise
+        download = None
+        if isinstance(res, RouteErrorResult):
+            request_id, error = res.request_id, True
+        else:
+            request_id, error = None, False
+            if res.http_resp is not None:
+                download = int(res.http_resp.headers.get('Content-Length', 0))
+        self.recorder.record(route_name, request_json_arg, started,
+                             result=res.obj_result, error=error,
+                             request_id=request_id, upload=upload,
+                             download=download)
+        return res
 
     # Below we split the DropboxClient metadata() method into two methods
     # metadata() and children(). This allows for more fine-grained fetches
@@ -266,7 +1345,33 @@ class DropboxClient(Dropbox):
 
     def metadata(self, path, cache_read=True):
         "Gets metadata for a given path."
+        # Copy the info so the caller cannot affect our cache.
+        return copy.deepcopy(self.cached_metadata(path, cache_read))
+
+    def stat(self, path):
+        """Gets the cached metadata for a path without copying it, for
+        callers that only look at its type or size. A path missing from a
+        cached listing of its folder is known not to exist, without a
+        request."""
+        item = self.cache.get(path)
+        if item and item.metadata is not None and not item.expired:
+            return item.metadata
+        if path != '/':
+            dname, bname = pathsplit(path)
+            parent = self.cache.get(dname)
+            if parent and parent.children is not None and \
+                    not parent.expired:
+                if not parent.has_child(bname):
+                    raise ResourceNotFoundError(path)
+        return self.cached_metadata(path)
+
+    def cached_metadata(self, path, cache_read=True):
+        """Gets metadata for a given path, as stored in the cache. Callers
+        must not modify it."""
         item = self.cache.get(path) if cache_read else None
+        if not item or item.metadata is None or item.expired:
+            if cache_read and self.prefetch_parent(path):
+                item = self.cache.get(path)
         if not item or item.metadata is None or item.expired:
             try:
                 metadata = super(DropboxClient, self).files_get_metadata(
@@ -286,8 +1391,32 @@ class DropboxClient(Dropbox):
             if isinstance(metadata, DeletedMetadata):
                 raise ResourceNotFoundError(path)
             item = self.cache[path] = CacheItem(metadata)
-        # Copy the info so the caller cannot affect our cache.
-        return copy.deepcopy(item.metadata)
+        return item.metadata
+
+    def prefetch_parent(self, path):
+        """Records a metadata miss for path. Once enough misses happen under
+        the same folder in a short time, that folder is listed, caching all
+        of its children at once. Returns True if the folder was listed."""
+        if not self.prefetch_misses or path == '/':
+            return False
+        parent = dirname(path)
+        key = parent.lower()
+        now = time.time()
+        count, since = self.misses.get(key, (0, now))
+        if since <= now - PREFETCH_WINDOW:
+            count, since = 0, now
+        if count + 1 < self.prefetch_misses:
+            # Forget stale misses rather than growing without bound.
+            if len(self.misses) > 1000:
+                self.misses.clear()
+            self.misses[key] = (count + 1, since)
+            return False
+        self.misses.pop(key, None)
+        try:
+            self.children(parent)
+        except FSError:
+            return False
+        return True
 
     def children(self, path):
         "Gets children of a given path."
@@ -340,8 +1469,21 @@ class DropboxClient(Dropbox):
                 LOGGER.error(e, exc_info=True, extra={'stack': True,})
                 raise RemoteConnectionError(opname='metadata', path=path,
                                             details=e)
+            entries = list(folder_list.entries)
+            # The listing has to be complete, as stat() takes a name missing
+            # from it to mean the path does not exist.
+            while folder_list.has_more:
+                try:
+                    folder_list = super(
+                        DropboxClient, self).files_list_folder_continue(
+                            folder_list.cursor)
+                except ApiError, e:
+                    LOGGER.error(e, exc_info=True, extra={'stack': True,})
+                    raise RemoteConnectionError(opname='metadata', path=path,
+                                                details=e)
+                entries.extend(folder_list.entries)
             children = []
-            for child in folder_list.entries:
+            for child in entries:
                 if isinstance(child, DeletedMetadata):
                     continue
                 children.append(child.name)
@@ -350,44 +1492,293 @@ class DropboxClient(Dropbox):
 
         return item.children
 
-    def files_create_folder(self, path):
-        "Add newly created directory to cache."
+    def files_create_folder(self, path, allow_recreate=False):
+        """Add newly created directory to cache. Dropbox creates any missing
+        parents along the way, so they are cached as well. An existing
+        folder is not an error with allow_recreate."""
         try:
             metadata = super(DropboxClient, self).files_create_folder(path)
         except ApiError, e:
             if e.error.is_path() and e.error.get_path().is_conflict():
+                if not e.error.get_path().get_conflict().is_folder():
+                    raise ResourceInvalidError(path)
+                if allow_recreate:
+                    return
                 raise DestinationExistsError(path)
             LOGGER.error(e, exc_info=True, extra={'stack': True,})
             raise RemoteConnectionError(opname='file_create_folder', path=path,
                                         details=e)
         self.cache.set(path, metadata)
+        self.cache.set_parents(getattr(metadata, 'path_display', None) or path)
 
     def files_copy(self, src, dst):
         try:
             metadata = super(DropboxClient, self).files_copy(src, dst)
         except ApiError, e:
-            if e.error.is_from_lookup() and e.error.get_from_lookup().is_not_found():
-                raise ResourceNotFoundError(src)
-            if e.error.is_to() and e.error.get_to().is_conflict():
-                raise DestinationExistsError(dst)
-            LOGGER.error(e, exc_info=True, extra={'stack': True,})
-            raise RemoteConnectionError(opname='file_copy', path=src,
-                                        details=e)
+            raise_relocation_error(e.error, 'file_copy', src, dst, e)
         self.cache.set(dst, metadata)
 
     def files_move(self, src, dst):
         try:
             metadata = super(DropboxClient, self).files_move(src, dst)
         except ApiError, e:
-            if e.error.is_from_lookup() and e.error.get_from_lookup().is_not_found():
-                raise ResourceNotFoundError(src)
-            if e.error.is_to() and e.error.get_to().is_conflict():
-                raise DestinationExistsError(dst)
+            raise_relocation_error(e.error, 'file_move', src, dst, e)
+        self.cache.move(src, dst, metadata)
+
+    def files_get_temporary_link(self, path):
+        "Returns a direct download link for a file, caching its metadata."
+        try:
+            result = super(DropboxClient, self).files_get_temporary_link(path)
+        except ApiError, e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                raise ResourceNotFoundError(path)
             LOGGER.error(e, exc_info=True, extra={'stack': True,})
-            raise RemoteConnectionError(opname='file_move', path=src,
-                                        details=e)
-        self.cache.pop(src, None)
+            raise RemoteConnectionError(opname='get_temporary_link',
+                                        path=path, details=e)
+        self.cache[path] = CacheItem(result.metadata)
+        return result.metadata, result.link
+
+    def download_range(self, link, start, end, fd, retries=SEGMENT_RETRIES):
+        """Downloads bytes start to end (inclusive) of a temporary link and
+        writes them to the file descriptor fd at offset start. The range is
+        retried if the request fails or comes back short."""
+        with self.scheduler.slot(self.current_priority()):
+            return self._record_range(link, start, end, fd, retries)
+
+    def _record_range(self, link, start, end, fd, retries):
+        if self.recorder is None:
+            return self._download_range(link, start, end, fd, retries)
+        arg = json.dumps({'link': link, 'start': start, 'end': end})
+        started = time.time()
+        try:
+            written = self._download_range(link, start, end, fd, retries)
+        except RemoteConnectionError, e:
+            self.recorder.record('download_range', arg, started,
+                                 exception=type(e).__name__)
+            raise
+        self.recorder.record('download_range', arg, started, download=written)
+        return written
+
+    def _download_range(self, link, start, end, fd, retries):
+        expected = end - start + 1
+        for attempt in xrange(retries + 1):
+            try:
+                response = self._session.get(
+                    link, headers={'Range': 'bytes=%d-%d' % (start, end)},
+                    stream=True, timeout=self._timeout)
+                try:
+                    if response.status_code != 206:
+                        raise requests.HTTPError(
+                            'Range not honoured: %s' % response.status_code)
+                    os.lseek(fd, start, os.SEEK_SET)
+                    written = 0
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        write_to_fd(fd, chunk)
+                        written += len(chunk)
+                finally:
+                    response.close()
+            except requests.RequestException, e:
+                LOGGER.warning('Range %s-%s failed: %s', start, end, e)
+                continue
+            if written == expected:
+                return written
+            LOGGER.warning('Range %s-%s was short: %s of %s bytes', start,
+                           end, written, expected)
+        raise RemoteConnectionError(opname='download_range', path=link)
+
+    def files_copy_reference_get(self, path):
+        "Returns a copy reference that another account can save."
+        try:
+            result = super(DropboxClient, self).files_copy_reference_get(path)
+        except ApiError, e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                raise ResourceNotFoundError(path)
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname='copy_reference_get',
+                                        path=path, details=e)
+        return result.copy_reference
+
+    def files_copy_reference_save(self, copy_reference, path):
+        "Saves a copy reference to path and adds the result to the cache."
+        try:
+            result = super(DropboxClient, self).files_copy_reference_save(
+                copy_reference, path)
+        except ApiError, e:
+            if e.error.is_path() and e.error.get_path().is_conflict():
+                raise DestinationExistsError(path)
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname='copy_reference_save',
+                                        path=path, details=e)
+        self.cache.pop_tree(path)
+        self.cache.set(path, result.metadata)
+        return result.metadata
+
+    def relocate_tree(self, src, dst, move=False, autorename=False,
+                      callback=None, ignore_errors=False):
+        """Copies or moves a whole tree on the server, then caches the new
+        tree with a single recursive listing.
+
+        The relocation runs as a batch job which is polled until done.
+        callback, if given, is called as callback(status, count) while the
+        job runs and while the destination is listed. The job reports no
+        progress of its own, so while it runs count is the number of times
+        its status was checked."""
+        opname = 'file_move' if move else 'file_copy'
+        if move:
+            launch = super(DropboxClient, self).files_move_batch
+            check = super(DropboxClient, self).files_move_batch_check
+        else:
+            launch = super(DropboxClient, self).files_copy_batch
+            check = super(DropboxClient, self).files_copy_batch_check
+        try:
+            job = launch([RelocationPath(src, dst)], autorename=autorename)
+            if job.is_async_job_id():
+                job_id = job.get_async_job_id()
+                job = check(job_id)
+                checks = 1
+                while job.is_in_progress():
+                    if callback:
+                        callback('in_progress', checks)
+                    time.sleep(JOB_POLL_INTERVAL)
+                    job = check(job_id)
+                    checks += 1
+                if job.is_failed():
+                    raise_relocation_error(job.get_failed(), opname, src, dst,
+                                           job.get_failed())
+        except ApiError, e:
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname=opname, path=src, details=e)
+        if not job.is_complete():
+            raise RemoteConnectionError(opname=opname, path=src, details=job)
+        metadata = job.get_complete().entries[0].metadata
+        if move:
+            self.cache.pop_tree(src)
+        # With autorename the tree may have landed somewhere other than dst.
+        dst = metadata.path_display
+        self.cache.pop_tree(dst)
         self.cache.set(dst, metadata)
+        count = 0
+        if isinstance(metadata, FolderMetadata):
+            try:
+                count = self.cache_tree(dst, metadata, callback=callback)
+            except FSError:
+                if not ignore_errors:
+                    raise
+                LOGGER.warning('Could not cache tree %s', dst, exc_info=True)
+        if callback:
+            callback('complete', count)
+        return metadata
+
+    def list_tree(self, path):
+        """Yields pages of entries below a folder using a recursive
+        listing, following the cursor until the listing is exhausted. The
+        pages are requested as BULK, as the crawl can be long."""
+        try:
+            with self.priority(BULK):
+                result = super(DropboxClient, self).files_list_folder(
+                    '' if path == '/' else path, recursive=True,
+                    include_deleted=False)
+            yield result.entries
+            while result.has_more:
+                with self.priority(BULK):
+                    result = super(
+                        DropboxClient, self).files_list_folder_continue(
+                            result.cursor)
+                yield result.entries
+        except ApiError, e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                raise ResourceNotFoundError(path)
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname='list_folder', path=path,
+                                        details=e)
+
+    def list_changes(self, path, cursor=None):
+        """Lists what changed below a folder since cursor, as returned by an
+        earlier call, or everything below it without one. Returns the
+        entries, with DeletedMetadata for deletions, the cursor for the next
+        call and whether everything was listed, which also happens when
+        Dropbox has reset the cursor."""
+        entries = []
+        try:
+            if cursor is not None:
+                try:
+                    result = super(
+                        DropboxClient, self).files_list_folder_continue(cursor)
+                except ApiError, e:
+                    if not e.error.is_reset():
+                        raise
+                    cursor = None
+            if cursor is None:
+                result = super(DropboxClient, self).files_list_folder(
+                    '' if path == '/' else path, recursive=True,
+                    include_deleted=False)
+            entries.extend(result.entries)
+            while result.has_more:
+                result = super(DropboxClient, self).files_list_folder_continue(
+                    result.cursor)
+                entries.extend(result.entries)
+        except ApiError, e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                raise ResourceNotFoundError(path)
+            LOGGER.error(e, exc_info=True, extra={'stack': True,})
+            raise RemoteConnectionError(opname='list_folder', path=path,
+                                        details=e)
+        return entries, result.cursor, cursor is None
+
+    def search(self, path, query, filename_only=True):
+        """Yields the metadata of everything below path matching a search
+        query, following pages of results. Matches are cached."""
+        mode = SearchMode.filename if filename_only else \
+            SearchMode.filename_and_content
+        start = 0
+        while True:
+            try:
+                result = super(DropboxClient, self).files_search(
+                    '' if path == '/' else path, query, start=start,
+                    max_results=SEARCH_PAGE_SIZE, mode=mode)
+            except ApiError, e:
+                if e.error.is_path() and e.error.get_path().is_not_found():
+                    raise ResourceNotFoundError(path)
+                LOGGER.error(e, exc_info=True, extra={'stack': True,})
+                raise RemoteConnectionError(opname='search', path=path,
+                                            details=e)
+            for match in result.matches:
+                self.cache[match.metadata.path_display] = CacheItem(
+                    match.metadata)
+                yield match.metadata
+            if not result.more:
+                break
+            start = result.start
+
+    def cache_tree(self, path, metadata, callback=None):
+        """Fills the cache with a folder and everything below it, including
+        every folder's children, using one recursive listing."""
+        # Keyed by path_lower, as only the last component of path_display
+        # is guaranteed to have the right casing.
+        root = path.lower()
+        items = {root: CacheItem(metadata, [])}
+        count = 0
+        for entries in self.list_tree(path):
+            for entry in entries:
+                if isinstance(entry, DeletedMetadata):
+                    continue
+                if entry.path_lower == root:
+                    continue
+                children = [] if isinstance(entry, FolderMetadata) else None
+                items[entry.path_lower] = CacheItem(entry, children)
+                count += 1
+            if callback:
+                callback('listing', count)
+        # Parents always precede their children in a recursive listing,
+        # but a page boundary can split them, so link up once at the end.
+        for child_path, item in items.iteritems():
+            if child_path == root:
+                continue
+            parent = items.get(dirname(child_path))
+            if parent is not None:
+                parent.add_child(item.metadata.name)
+        self.cache.update(items)
+        return count
 
     def files_delete(self, path):
         try:
@@ -400,26 +1791,94 @@ class DropboxClient(Dropbox):
         self.cache.pop(path, None)
 
     def files_upload(self, f, path, mode=WriteMode('add', None)):
+        """Uploads a file and caches the metadata returned for it. Raises
+        RevisionConflictError if mode is an update of another revision."""
         try:
-            super(DropboxClient, self).files_upload(f, path, mode)
+            metadata = super(DropboxClient, self).files_upload(f, path, mode)
         except ApiError, e:
+            if mode.is_update() and e.error.is_path() and \
+                    e.error.get_path().reason.is_conflict():
+                raise RevisionConflictError(opname='put_file', path=path,
+                                            details=e)
             LOGGER.error(e, exc_info=True, extra={'stack': True,})
             raise RemoteConnectionError(opname='put_file', path=path,
                                         details=e)
-        self.cache.pop(dirname(path), None)
+        self.cache.set(path, metadata)
+        return metadata
+
+
+def raise_relocation_error(error, opname, src, dst, details):
+    "Converts a copy or move error to the matching fs exception."
+    if error.is_from_lookup() and error.get_from_lookup().is_not_found():
+        raise ResourceNotFoundError(src)
+    if error.is_to() and error.get_to().is_conflict():
+        raise DestinationExistsError(dst)
+    LOGGER.error(details, exc_info=True, extra={'stack': True,})
+    raise RemoteConnectionError(opname=opname, path=src, details=details)
+
+
+def write_to_fd(fd, data):
+    "Writes all of data to an OS level file descriptor."
+    while data:
+        written = os.write(fd, data)
+        data = buffer(data, written)
 
 
-def create_client(token):
+def search_query(pattern):
+    """Returns a Dropbox search query that finds every name matching a
+    glob pattern, or None if search can not express the pattern. Search
+    matches on word prefixes, so only the literal text a pattern starts
+    with is safe to search for."""
+    prefix = re.split(r'[*?\[]', pattern, 1)[0]
+    # Only search for whole words, trailing punctuation never matches.
+    prefix = re.sub(r'\W+$', '', prefix, flags=re.UNICODE)
+    return prefix or None
+
+
+def content_hash(f, block_size=CONTENT_HASH_BLOCK_SIZE):
+    """Computes the Dropbox content hash of a file-like: the SHA-256 of the
+    SHA-256 digests of its blocks."""
+    digests = hashlib.sha256()
+    for block in iter(lambda: f.read(block_size), ''):
+        digests.update(hashlib.sha256(block).digest())
+    return digests.hexdigest()
+
+
+def create_client(token, **kwargs):
     """Uses token to gain access to the API."""
-    return DropboxClient(token)
+    return DropboxClient(token, **kwargs)
+
 
+# Timezones by name, as looking one up reads its data from disk.
+_timezones = {}
 
-def metadata_to_info(metadata, localtime=False):
+
+def get_timezone(name):
+    "Returns the tzinfo of a timezone name. pytz is imported on first use."
+    timezone = _timezones.get(name)
+    if timezone is None:
+        import pytz
+        timezone = _timezones[name] = pytz.timezone(name)
+    return timezone
+
+
+def metadata_to_info(metadata, localtime=False, timezone=INFO_TIMEZONE):
+    """Converts metadata to an info dict. Dropbox reports modification
+    times as naive UTC datetimes. With localtime they are converted to naive
+    local times. Otherwise they are converted to timezone, which can be a
+    name (looked up once, see get_timezone()) or a tzinfo, or left as they
+    are if timezone is None."""
     isdir = isinstance(metadata, FolderMetadata)
     modified_time = getattr(metadata, 'server_modified', None)
     if modified_time:
-        modified_time = modified_time.replace(tzinfo=pytz.utc).astimezone(
-            pytz.timezone(INFO_TIMEZONE))
+        if localtime:
+            modified_time = datetime.datetime.fromtimestamp(
+                calendar.timegm(modified_time.utctimetuple()))
+        elif timezone is not None:
+            if isinstance(timezone, basestring):
+                timezone = get_timezone(timezone)
+            modified_time = modified_time.replace(
+                tzinfo=get_timezone('UTC')).astimezone(timezone)
     info = {
         'size': getattr(metadata, 'size', 0),
         'isdir': isdir,
@@ -430,6 +1889,173 @@ def metadata_to_info(metadata, localtime=False):
     return info
 
 
+class SyntheticBody(object):
+    """Stands in for the raw body of a replayed download, with size zero
+    bytes as its contents."""
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+        self.closed = False
+
+    def getheader(self, name, default=None):
+        if name.lower() == 'content-length':
+            return str(self.size)
+        return default
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            amt = self.size - self.pos
+        amt = max(0, min(amt, self.size - self.pos))
+        self.pos += amt
+        return '\0' * amt
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayClient(DropboxClient):
+    """A client that answers API calls from recorded ones (see
+    TrafficRecorder) instead of the API, taking as long as they took when
+    recorded, divided by speed. Calls are matched on their route and
+    arguments and answered in the order they were recorded; a call made
+    more often than recorded gets the last answer again, one never recorded
+    raises BadInputError. Downloads return zeros of the recorded size. The
+    calls answered are kept in replayed, to compare runs of a workload."""
+    def __init__(self, calls, speed=1.0, **kwargs):
+        super(ReplayClient, self).__init__('replay', **kwargs)
+        self.speed = speed
+        self.answers = {}
+        for call in calls:
+            key = (call['route'], call['arg'])
+            self.answers.setdefault(key, []).append(call)
+        self.replayed = []
+        self.lock = threading.Lock()
+
+    def answer(self, route, arg):
+        "Returns the recorded call answering a call, after its latency."
+        key = (route, redact(arg))
+        with self.lock:
+            calls = self.answers.get(key)
+            if not calls:
+                raise BadInputError(None, 'No recorded call to %s with %s'
+                                    % key)
+            call = calls.pop(0) if len(calls) > 1 else calls[0]
+            self.replayed.append(call)
+        time.sleep(call['latency'] / self.speed)
+        return call
+
+    def request_json_string_with_retry(self, host, route_name, route_style,
+                                       request_json_arg, request_binary,
+                                       timeout=None):
+        call = self.answer(route_name, request_json_arg)
+        if call.get('exception'):
+            raise InternalServerError(call.get('request_id'), 500,
+                                      'Replayed %s' % call['exception'])
+        if call.get('error'):
+            return RouteErrorResult(call.get('request_id'), call['result'])
+        http_resp = None
+        if call.get('download') is not None:
+            http_resp = requests.Response()
+            http_resp.status_code = 200
+            http_resp.headers['Content-Length'] = str(call['download'])
+            http_resp.raw = SyntheticBody(call['download'])
+        return RouteResult(call['result'], http_resp)
+
+    def download_range(self, link, start, end, fd, retries=SEGMENT_RETRIES):
+        arg = json.dumps({'link': link, 'start': start, 'end': end})
+        call = self.answer('download_range', arg)
+        if call.get('exception'):
+            raise RemoteConnectionError(opname='download_range', path=link)
+        os.lseek(fd, start, os.SEEK_SET)
+        write_to_fd(fd, '\0' * call['download'])
+        return call['download']
+
+
+class Prefetcher(object):
+    """Lists folders into a client's cache with a pool of worker threads,
+    see DropboxFS.prefetch(). Errors are collected in errors rather than
+    raised, as prefetching is only an optimization."""
+    def __init__(self, client, paths, depth=1,
+                 parallelism=PREFETCH_PARALLELISM, callback=None):
+        self.client = client
+        self.depth = depth
+        self.callback = callback
+        self.count = 0
+        self.errors = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.queue = Queue.Queue()
+        for path in paths:
+            self.put(path, 1)
+        self.threads = [threading.Thread(target=self.worker)
+                        for i in xrange(min(parallelism, self.pending))]
+
+    def start(self):
+        if not self.threads:
+            self.finish()
+        for thread in self.threads:
+            # Don't keep the process alive for a warm up.
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        "Waits for the prefetch to finish. Returns True if it did."
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def put(self, path, level):
+        with self.lock:
+            self.pending += 1
+        self.queue.put((path, level))
+
+    def worker(self):
+        with self.client.priority(BULK):
+            self.work()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            try:
+                self.fetch(*task)
+            except Exception, e:
+                self.errors.append(e)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    pending = self.pending
+            if not pending:
+                for thread in self.threads:
+                    self.queue.put(None)
+                self.finish()
+
+    def fetch(self, path, level):
+        if self.depth is None:
+            count = self.client.cache_tree(
+                path, self.client.cached_metadata(path))
+        else:
+            children = self.client.children(path)
+            count = len(children)
+            if level < self.depth:
+                for name in children:
+                    child = pathjoin(path, name)
+                    if isinstance(self.client.stat(child), FolderMetadata):
+                        self.put(child, level + 1)
+        with self.lock:
+            self.count += count
+            count = self.count
+        if self.callback:
+            self.callback('listing', count)
+
+    def finish(self):
+        if self.callback:
+            self.callback('complete', self.count)
+        self.finished.set()
+
+
 class DropboxFS(FS):
     """A FileSystem that stores data in Dropbox."""
 
@@ -444,15 +2070,56 @@ class DropboxFS(FS):
              'atomic.rename': True,
              'mime_type': 'virtual/dropbox', }
 
-    def __init__(self, token, localtime=False, thread_synchronize=True):
+    def __init__(self, token, localtime=False, thread_synchronize=True,
+                 timezone=INFO_TIMEZONE, session=None, namespace_id=None,
+                 max_buffer=MAX_BUFFER, spool_dir=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, conditional_writes=False,
+                 cache_address=None, cache_authkey=CACHE_AUTHKEY,
+                 recorder=None):
         """Create an fs that interacts with Dropbox.
 
         :param token: The access token you received after authorization.
+        :param localtime: set to True to report naive local times
         :param thread_synchronize: set to True (default) to enable thread-safety
+        :param timezone: timezone name or tzinfo to report times in, or None
+            for naive UTC times
+        :param session: a requests session to share connections with other
+            clients, see dropbox.create_session()
+        :param namespace_id: a namespace (e.g. a team folder) to use as the
+            root instead of the user's home folder
+        :param max_buffer: bytes a file being written is kept in memory for
+            before spooling it to disk, 0 to spool straight to disk
+        :param spool_dir: directory to spool files being written to
+        :param chunk_size: size of the chunks large files are uploaded in
+        :param conditional_writes: set to True to only overwrite a file if it
+            is still at the revision cached for it, see setcontents()
+        :param cache_address: address of a cache server to share the cache
+            with other processes, see serve_cache()
+        :param cache_authkey: key of that cache server
+        :param recorder: a TrafficRecorder to record the API calls made
         """
         super(DropboxFS, self).__init__(thread_synchronize=thread_synchronize)
-        self.client = create_client(token)
+        headers = None
+        if namespace_id is not None:
+            headers = {'Dropbox-API-Path-Root': json.dumps({
+                '.tag': 'namespace_id', 'namespace_id': namespace_id})}
+        self.client = create_client(token, session=session, headers=headers)
+        if cache_address is not None:
+            prefix = hashlib.sha1('%s:%s' % (token, namespace_id)).hexdigest()
+            self.client.cache = SharedDropboxCache(
+                cache_address, prefix=prefix + ':', authkey=cache_authkey)
+        self.client.recorder = recorder
         self.localtime = localtime
+        # A name is looked up on first use, see get_timezone().
+        self.timezone = timezone
+        # Files opened with materialize, shared by their readers. The lock
+        # is needed even without thread_synchronize, as readers share them.
+        self.materialized = {}
+        self.materialized_lock = threading.RLock()
+        self.max_buffer = max_buffer
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+        self.conditional_writes = conditional_writes
 
     def __str__(self):
         return "<DropboxFS: >"
@@ -461,20 +2128,182 @@ class DropboxFS(FS):
         return u"<DropboxFS: >"
 
     @synchronize
-    def open(self, path, mode="rb", **kwargs):
+    def open(self, path, mode="rb", materialize=False, size=None,
+             max_buffer=None, spool_dir=None, chunk_size=None, rev=None,
+             **kwargs):
+        """Opens a file. With materialize, a file opened for reading is
+        downloaded into a local memory mapped copy as it is read, which
+        suits repeated random access and is shared by all its readers.
+
+        Files opened for writing are spooled and uploaded on close, see
+        __init__ for the settings that can be overridden here. If the size
+        of the file is given it is streamed to Dropbox as it is written. As
+        with setcontents(), rev makes the upload conditional."""
+        path = abspath(normpath(path))
         if 'r' in mode:
+            if materialize:
+                return MappedReader(self._materialize(path), path)
             return ChunkedReader(self.client, path)
-        else:
-            return SpooledWriter(self.client, path)
+        chunk_size = chunk_size or self.chunk_size
+        write_mode = self._write_mode(path, rev)
+        if size is not None:
+            return SessionWriter(self.client, path, size=size,
+                                 chunk_size=chunk_size, mode=write_mode)
+        if max_buffer is None:
+            max_buffer = self.max_buffer
+        return SpooledWriter(self.client, path, max_buffer=max_buffer,
+                             spool_dir=spool_dir or self.spool_dir,
+                             chunk_size=chunk_size, mode=write_mode)
+
+    def _write_mode(self, path, rev):
+        if rev is None and self.conditional_writes:
+            item = self.client.cache.get(path)
+            rev = getattr(item and item.metadata, 'rev', None)
+        if rev is None:
+            return WriteMode.overwrite
+        return WriteMode.update(rev)
+
+    def _materialize(self, path):
+        "Gets the shared copy of a file, with a reference acquired on it."
+        key = path.lower()
+        shared = self.materialized.get(key)
+        if shared is not None:
+            rev = self.client.stat(path).rev
+            with self.materialized_lock:
+                # Files are dropped from materialized, under the lock, as
+                # soon as their last reader closes, so this one is alive.
+                if self.materialized.get(key) is shared and \
+                        shared.metadata.rev == rev:
+                    shared.acquire()
+                    return shared
+        metadata, link = self.client.files_get_temporary_link(path)
+
+        def on_close(closed):
+            if self.materialized.get(key) is closed:
+                del self.materialized[key]
+        shared = MaterializedFile(
+            self.client, metadata, link, on_close=on_close,
+            block_size=MATERIALIZE_BLOCK_SIZE, lock=self.materialized_lock)
+        with self.materialized_lock:
+            shared.acquire()
+            self.materialized[key] = shared
+        return shared
 
     @synchronize
     def getcontents(self, path, mode="rb"):
         path = abspath(normpath(path))
         return self.open(path, mode).read()
 
+    def download_to(self, path, target, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Streams a file into target without reading it into memory.
+
+        target can be a file-like object, a socket or a file descriptor.
+        One buffer of chunk_size is reused for the whole download and
+        slices of it are passed to target without copying. Returns the
+        number of bytes written."""
+        path = abspath(normpath(path))
+        if isinstance(target, (int, long)):
+            write = lambda data: write_to_fd(target, data)
+        elif hasattr(target, 'sendall'):
+            write = target.sendall
+        else:
+            write = target.write
+        buf = bytearray(chunk_size)
+        total = 0
+        with ChunkedReader(self.client, path) as reader:
+            while True:
+                amt = reader.readinto(buf)
+                if not amt:
+                    break
+                write(buffer(buf, 0, amt))
+                total += amt
+        return total
+
+    def download_parallel(self, path, local_path, segment_size=SEGMENT_SIZE,
+                          parallelism=SEGMENT_PARALLELISM,
+                          retries=SEGMENT_RETRIES):
+        """Downloads a file to local_path by fetching byte ranges of it
+        concurrently over the client's pooled connections.
+
+        The local file is preallocated to the file's size and each segment
+        is written in place. Failed segments are retried individually.
+        Returns the number of bytes downloaded."""
+        path = abspath(normpath(path))
+        metadata, link = self.client.files_get_temporary_link(path)
+        size = metadata.size
+        with open(local_path, 'wb') as f:
+            f.truncate(size)
+        segments = Queue.Queue()
+        for start in xrange(0, size, segment_size):
+            segments.put((start, min(start + segment_size, size) - 1))
+        written = []
+        errors = []
+
+        def worker():
+            fd = os.open(local_path, os.O_WRONLY)
+            try:
+                with self.client.priority(BULK):
+                    while not errors:
+                        try:
+                            start, end = segments.get_nowait()
+                        except Queue.Empty:
+                            return
+                        try:
+                            written.append(self.client.download_range(
+                                link, start, end, fd, retries=retries))
+                        except Exception, e:
+                            errors.append(e)
+            finally:
+                os.close(fd)
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(min(parallelism, segments.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if sum(written) != size:
+            raise RemoteConnectionError(opname='download_parallel',
+                                        path=path)
+        return size
+
     def setcontents(self, path, data, *args, **kwargs):
+        """Writes data, a string or a file-like, to a file. Given the rev
+        of the file (or with conditional_writes and a cached rev) it is only
+        overwritten if still at that revision, otherwise this raises
+        RevisionConflictError. That makes a safe update a single request."""
         path = abspath(normpath(path))
-        self.client.files_upload(data, path, mode=WriteMode.overwrite)
+        mode = self._write_mode(path, kwargs.get('rev'))
+        if not hasattr(data, 'read'):
+            self.client.files_upload(data, path, mode=mode)
+            return
+        # Upload file-likes in chunks rather than reading them whole.
+        session = UploadSession(self.client, path, mode=mode)
+        for chunk in iter(lambda: data.read(self.chunk_size), ''):
+            session.append(chunk)
+        session.finish()
+
+    def prefetch(self, paths, depth=1, background=True,
+                 parallelism=PREFETCH_PARALLELISM, callback=None):
+        """Warms up the cache by listing folders, e.g. after a restart.
+
+        Each of paths is listed along with the folders below it up to depth
+        levels, or its whole tree with one recursive listing if depth is
+        None. Up to parallelism folders are listed at once. callback, if
+        given, is called as callback(status, count) with the number of
+        entries cached so far. Returns a Prefetcher, which has already
+        finished unless background is True; call its wait() to wait for it
+        and look at its errors for folders that could not be listed."""
+        if isinstance(paths, basestring):
+            paths = [paths]
+        prefetcher = Prefetcher(
+            self.client, [abspath(normpath(path)) for path in paths],
+            depth=depth, parallelism=parallelism, callback=callback).start()
+        if not background:
+            prefetcher.wait()
+        return prefetcher
 
     def desc(self, path):
         return "%s in Dropbox" % path
@@ -487,24 +2316,45 @@ class DropboxFS(FS):
 
     def isdir(self, path):
         try:
-            info = self.getinfo(path)
-            return info.get('isdir', False)
+            metadata = self.client.stat(abspath(normpath(path)))
         except ResourceNotFoundError:
             return False
+        return isinstance(metadata, FolderMetadata)
 
     def isfile(self, path):
         try:
-            info = self.getinfo(path)
-            return not info.get('isdir', False)
+            metadata = self.client.stat(abspath(normpath(path)))
         except ResourceNotFoundError:
             return False
+        return not isinstance(metadata, FolderMetadata)
 
     def exists(self, path):
         try:
-            self.getinfo(path)
-            return True
+            self.client.stat(abspath(normpath(path)))
         except ResourceNotFoundError:
             return False
+        return True
+
+    def exists_many(self, paths):
+        """Checks which of paths exist. Paths are grouped by folder and any
+        folder holding more than one of them is listed once, answering the
+        rest from the cache. Returns a dict mapping each path to a bool."""
+        groups = {}
+        for path in paths:
+            syspath = abspath(normpath(path))
+            groups.setdefault(dirname(syspath).lower(), []).append(
+                (path, syspath))
+        exists = {}
+        for group in groups.itervalues():
+            if len(group) > 1:
+                try:
+                    self.client.children(dirname(group[0][1]))
+                except FSError:
+                    # Fall back to checking each path on its own.
+                    pass
+            for path, syspath in group:
+                exists[path] = self.exists(syspath)
+        return exists
 
     def listdir(self, path='', wildcard=None, full=False, absolute=False,
                 dirs_only=False, files_only=False):
@@ -513,31 +2363,181 @@ class DropboxFS(FS):
         return self._listdir_helper(path, children, wildcard, full, absolute,
                                     dirs_only, files_only)
 
+    def listdirinfo(self, path='./', wildcard=None, full=False,
+                    absolute=False, dirs_only=False, files_only=False):
+        return list(self.ilistdirinfo(path, wildcard, full, absolute,
+                                      dirs_only, files_only))
+
+    def ilistdirinfo(self, path='./', wildcard=None, full=False,
+                     absolute=False, dirs_only=False, files_only=False):
+        """Yields (name, info) pairs for a folder, built from the entries
+        cached by its listing. Filters are applied before any info is
+        built."""
+        path = abspath(normpath(path))
+        if dirs_only and files_only:
+            raise ValueError("dirs_only and files_only can not both be True")
+        if wildcard is not None and not callable(wildcard):
+            wildcard_re = re.compile(fnmatch.translate(wildcard))
+            wildcard = lambda fn: bool(wildcard_re.match(fn))
+        for name in list(self.client.children(path)):
+            if wildcard is not None and not wildcard(name):
+                continue
+            child = pathjoin(path, name)
+            try:
+                metadata = self.client.stat(child)
+            except ResourceNotFoundError:
+                continue
+            isdir = isinstance(metadata, FolderMetadata)
+            if (dirs_only and not isdir) or (files_only and isdir):
+                continue
+            info = metadata_to_info(metadata, localtime=self.localtime,
+                                    timezone=self.timezone)
+            yield (child if full or absolute else name), info
+
+    def find(self, pattern, path='/', filename_only=True):
+        """Yields the paths of everything below path whose name matches the
+        glob pattern. The Dropbox search API narrows down the candidates
+        when the pattern allows it, otherwise the tree is listed
+        recursively. Either way names are checked against the pattern."""
+        path = abspath(normpath(path))
+        match = re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+        query = search_query(pattern)
+        if query is not None:
+            entries = self.client.search(path, query, filename_only)
+        else:
+            entries = (entry for page in self.client.list_tree(path)
+                       for entry in page)
+        for entry in entries:
+            if isinstance(entry, DeletedMetadata) or \
+                    entry.path_lower == path.lower():
+                continue
+            if match(entry.name):
+                yield entry.path_display
+
+    def build_index(self, path='/'):
+        """Builds a TreeIndex of everything below path from one recursive
+        listing, and keeps it up to date with the changes made through this
+        fs. Only one index is kept, building another replaces it."""
+        path = abspath(normpath(path))
+        index = TreeIndex(path, self.client.list_tree(path))
+        self.client.cache.index = index
+        return index
+
     @synchronize
     def getinfo(self, path, cache_read=True):
         path = abspath(normpath(path))
         metadata = self.client.metadata(path, cache_read=cache_read)
-        return metadata_to_info(metadata, localtime=self.localtime)
+        return metadata_to_info(metadata, localtime=self.localtime,
+                                timezone=self.timezone)
 
-    def copy(self, src, dst, *args, **kwargs):
+    def copy(self, src, dst, overwrite=False, chunk_size=65536):
         src = abspath(normpath(src))
         dst = abspath(normpath(dst))
+        if overwrite:
+            # Only replace dst once we know there is a file to replace it.
+            if isinstance(self.client.stat(src), FolderMetadata):
+                raise ResourceInvalidError(src)
+            self._remove_existing(dst)
         self.client.files_copy(src, dst)
 
-    def copydir(self, src, dst, *args, **kwargs):
+    def copy_from(self, other, src, dst, overwrite=False):
+        """Copies src from another fs to dst in this one.
+
+        When other is also a DropboxFS (e.g. another account or team
+        namespace) a copy reference is used so no file data passes through
+        this host. Otherwise the file is streamed from other."""
         src = abspath(normpath(src))
         dst = abspath(normpath(dst))
-        self.client.files_copy(src, dst)
+        # The source is opened before an existing dst is removed, so a
+        # missing source leaves dst alone.
+        if isinstance(other, DropboxFS):
+            copy_reference = other.client.files_copy_reference_get(src)
+            if overwrite:
+                self._remove_existing(dst)
+            self.client.files_copy_reference_save(copy_reference, dst)
+        else:
+            with other.open(src, 'rb') as f:
+                if overwrite:
+                    self._remove_existing(dst)
+                self.setcontents(dst, f)
+
+    def copydir(self, src, dst, overwrite=False, ignore_errors=False,
+                chunk_size=16384, autorename=False, callback=None):
+        """Copies a directory tree on the server.
+
+        With overwrite the tree is merged into an existing dst: files in
+        dst are replaced by those copied and anything else is kept. With
+        autorename a conflicting dst is renamed by Dropbox instead.
+        ignore_errors only applies to refreshing the cache afterwards."""
+        self._relocate_dir(src, dst, False, overwrite, ignore_errors,
+                           autorename, callback)
 
     def move(self, src, dst, *args, **kwargs):
         src = abspath(normpath(src))
         dst = abspath(normpath(dst))
         self.client.files_move(src, dst)
 
-    def movedir(self, src, dst, *args, **kwargs):
+    def movedir(self, src, dst, overwrite=False, ignore_errors=False,
+                chunk_size=16384, autorename=False, callback=None):
+        "Moves a directory tree on the server, see copydir()."
+        self._relocate_dir(src, dst, True, overwrite, ignore_errors,
+                           autorename, callback)
+
+    def _relocate_dir(self, src, dst, move, overwrite, ignore_errors,
+                      autorename, callback):
         src = abspath(normpath(src))
         dst = abspath(normpath(dst))
-        self.client.files_move(src, dst)
+        if overwrite and not autorename:
+            # Nothing in dst is touched unless src is there to replace it.
+            if not isinstance(self.client.stat(src), FolderMetadata):
+                raise ResourceInvalidError(src)
+            try:
+                target = self.client.stat(dst)
+            except ResourceNotFoundError:
+                target = None
+            if isinstance(target, FolderMetadata):
+                self._merge_tree(src, dst, move, ignore_errors, callback)
+                return
+            if target is not None:
+                self.client.files_delete(dst)
+        self.client.relocate_tree(src, dst, move=move, autorename=autorename,
+                                  callback=callback,
+                                  ignore_errors=ignore_errors)
+
+    def _merge_tree(self, src, dst, move, ignore_errors, callback):
+        """Copies or moves the contents of the folder src into the existing
+        folder dst. Folders on both sides are merged, other entries in dst
+        are replaced by their counterpart from src."""
+        # List dst up front so the lookups below are answered from cache.
+        self.client.children(dst)
+        for name in list(self.client.children(src)):
+            child_src = pathjoin(src, name)
+            child_dst = pathjoin(dst, name)
+            try:
+                target = self.client.stat(child_dst)
+            except ResourceNotFoundError:
+                target = None
+            if isinstance(target, FolderMetadata) and \
+                    isinstance(self.client.stat(child_src), FolderMetadata):
+                self._merge_tree(child_src, child_dst, move, ignore_errors,
+                                 callback)
+                continue
+            if target is not None:
+                self.client.files_delete(child_dst)
+            self.client.relocate_tree(child_src, child_dst, move=move,
+                                      callback=callback,
+                                      ignore_errors=ignore_errors)
+        if move:
+            self.client.files_delete(src)
+
+    def _remove_existing(self, path):
+        "Removes a file about to be replaced. Folders are never removed."
+        try:
+            if isinstance(self.client.stat(path), FolderMetadata):
+                raise ResourceInvalidError(path)
+            self.client.files_delete(path)
+        except ResourceNotFoundError:
+            pass
 
     def rename(self, src, dst, *args, **kwargs):
         src = abspath(normpath(src))
@@ -546,7 +2546,33 @@ class DropboxFS(FS):
 
     def makedir(self, path, recursive=False, allow_recreate=False):
         path = abspath(normpath(path))
-        self.client.files_create_folder(path)
+        if path == '/':
+            if allow_recreate:
+                return
+            raise DestinationExistsError(path)
+        dname = dirname(path)
+        # Dropbox always creates missing parents, so only check for them
+        # when that is not wanted.
+        if not recursive and dname != '/':
+            try:
+                if not isinstance(self.client.stat(dname), FolderMetadata):
+                    raise ResourceInvalidError(dname)
+            except ResourceNotFoundError:
+                raise ParentDirectoryMissingError(path)
+        self.client.files_create_folder(path, allow_recreate=allow_recreate)
+
+    def makedirs(self, paths, allow_recreate=True):
+        """Creates many folders along with any missing parents. Folders that
+        are the parent of another one in paths are created along with it, so
+        only one request is made per branch of the tree."""
+        paths = dict((p.lower(), p) for p in
+                     (abspath(normpath(p)) for p in paths) if p != '/')
+        keys = sorted(paths, key=lambda p: p.split('/'))
+        for i, key in enumerate(keys):
+            if i + 1 < len(keys) and keys[i + 1].startswith(key + '/'):
+                continue
+            self.makedir(paths[key], recursive=True,
+                         allow_recreate=allow_recreate)
 
     def remove(self, path):
         path = abspath(normpath(path))
@@ -557,9 +2583,659 @@ class DropboxFS(FS):
         self.client.files_delete(path)
 
 
-def main():  # pragma: no cover
-    parser = optparse.OptionParser(prog="dropboxfs",
-                                   description="CLI harness for DropboxFS.")
+class DropboxPool(object):
+    """Hands out a DropboxFS per account (token and namespace) and reuses it
+    for later requests of the same account. All accounts share one HTTP
+    connection pool, and each keeps its cache between requests. Accounts
+    left idle for idle_timeout are dropped, as are the least recently used
+    ones while there are more than max_accounts or their caches hold more
+    than max_cached paths in total."""
+    def __init__(self, max_accounts=POOL_MAX_ACCOUNTS,
+                 max_cached=POOL_MAX_CACHED, idle_timeout=POOL_IDLE_TIMEOUT,
+                 session=None, **kwargs):
+        if session is None:
+            session = create_session(max_connections=POOL_MAX_CONNECTIONS)
+        self.session = session
+        self.max_accounts = max_accounts
+        self.max_cached = max_cached
+        self.idle_timeout = idle_timeout
+        self.kwargs = kwargs
+        self.accounts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def get(self, token, namespace_id=None):
+        "Returns the DropboxFS for an account, creating it if needed."
+        key = (token, namespace_id)
+        with self.lock:
+            fs, used = self.accounts.pop(key, (None, None))
+            if fs is None:
+                fs = DropboxFS(token, session=self.session,
+                               namespace_id=namespace_id, **self.kwargs)
+            self.accounts[key] = (fs, time.time())
+            self.evict()
+        return fs
+
+    def evict(self):
+        "Drops idle accounts, then the least recently used while over budget."
+        idle = time.time() - self.idle_timeout
+        cached = 0
+        for key, (fs, used) in self.accounts.items():
+            if used <= idle:
+                del self.accounts[key]
+            else:
+                cached += len(fs.client.cache)
+        # The most recently used account is always kept.
+        while len(self.accounts) > 1 and (
+                len(self.accounts) > self.max_accounts or
+                cached > self.max_cached):
+            key, (fs, used) = self.accounts.popitem(last=False)
+            cached -= len(fs.client.cache)
+
+
+def replay(calls, workload, speed=1.0, **kwargs):
+    """Runs workload, a function taking a DropboxFS, against recorded calls
+    (see TrafficRecorder) rather than the API. Other arguments are passed on
+    to the DropboxFS. Returns the ReplayClient used, with the calls made in
+    replayed and the time workload took in elapsed."""
+    fs = DropboxFS('replay', **kwargs)
+    client = ReplayClient(calls, speed=speed)
+    client.cache = fs.client.cache
+    fs.client = client
+    started = time.time()
+    workload(fs)
+    client.elapsed = time.time() - started
+    return client
+
+
+class DropboxSync(object):
+    """Keeps a local fs and a folder in Dropbox in sync in both directions.
+
+    What was synced is kept in a state file along with the cursor of the
+    Dropbox listing, so later runs only list what changed in Dropbox since.
+    Local files are compared by size and modification time, and their
+    content hash is only computed for files that look changed. A file that
+    changed on both sides is kept as a conflicted copy locally, which the
+    next run uploads. Files are transferred parallelism at a time."""
+    def __init__(self, local, remote, path='/', state_path=None,
+                 parallelism=SYNC_PARALLELISM):
+        self.local = local
+        self.remote = remote
+        self.path = abspath(normpath(path))
+        self.state_path = state_path
+        self.parallelism = parallelism
+        self.cursor = None
+        # What was last synced, by lowercased path relative to both roots.
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        "Reads the state of the last run, unless it was of another folder."
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, 'rb') as f:
+            state = json.load(f)
+        if state['path'] == self.path:
+            self.cursor = state['cursor']
+            self.entries = state['entries']
+
+    def save(self):
+        "Writes the state, replacing the old one only once it is complete."
+        if self.state_path is None:
+            return
+        temp = self.state_path + '.tmp'
+        with open(temp, 'wb') as f:
+            json.dump({'path': self.path, 'cursor': self.cursor,
+                       'entries': self.entries}, f)
+        os.rename(temp, self.state_path)
+
+    def remote_path(self, rel):
+        return pathjoin(self.path, rel.lstrip('/'))
+
+    def relative(self, path):
+        return abspath(path[len(self.path.rstrip('/')):])
+
+    def remote_changes(self):
+        """Returns the metadata of what changed in Dropbox since the last
+        run by key, None for deletions, and the cursor to store."""
+        entries, cursor, full = self.remote.client.list_changes(
+            self.path, self.cursor)
+        changes = {}
+        if full:
+            changes = dict.fromkeys(self.entries)
+        for entry in entries:
+            rel = self.relative(entry.path_display or entry.path_lower)
+            key = rel.lower()
+            if rel == '/':
+                continue
+            known = self.entries.get(key)
+            if isinstance(entry, DeletedMetadata):
+                if known is not None:
+                    changes[key] = None
+            elif known is not None and \
+                    known['folder'] == isinstance(entry, FolderMetadata) and \
+                    known['rev'] == getattr(entry, 'rev', None):
+                # Unchanged, or our own upload coming back.
+                changes.pop(key, None)
+            else:
+                changes[key] = entry
+        return changes, cursor
+
+    def local_changes(self):
+        """Returns what changed locally since the last run by key, as
+        (path, info) with None as the info of folders, or None for
+        deletions."""
+        changes = {}
+        seen = set()
+        folders = ['/']
+        while folders:
+            folder = folders.pop()
+            for name in self.local.listdir(folder, dirs_only=True):
+                rel = pathjoin(folder, name)
+                key = rel.lower()
+                seen.add(key)
+                folders.append(rel)
+                known = self.entries.get(key)
+                if known is None or not known['folder']:
+                    changes[key] = (rel, None)
+            for name, info in self.local.ilistdirinfo(folder,
+                                                      files_only=True):
+                rel = pathjoin(folder, name)
+                key = rel.lower()
+                seen.add(key)
+                known = self.entries.get(key)
+                if known is None or known['folder'] or \
+                        known['size'] != info['size'] or \
+                        known['mtime'] != str(info['modified_time']):
+                    changes[key] = (rel, info)
+        for key in self.entries:
+            if key not in seen:
+                changes[key] = None
+        return changes
+
+    def record(self, key, rel, metadata=None):
+        "Stores what was synced for a path, None for a folder's metadata."
+        entry = {'path': rel, 'folder': metadata is None, 'rev': None,
+                 'hash': None, 'size': None, 'mtime': None}
+        if metadata is not None:
+            info = self.local.getinfo(rel)
+            entry.update(rev=metadata.rev, hash=metadata.content_hash,
+                         size=info['size'], mtime=str(info['modified_time']))
+        with self.lock:
+            self.entries[key] = entry
+
+    def forget(self, key):
+        "Drops what was synced for a path and everything below it."
+        with self.lock:
+            for other in self.entries.keys():
+                if other == key or other.startswith(key + '/'):
+                    del self.entries[other]
+
+    def local_hash(self, rel):
+        with self.local.open(rel, 'rb') as f:
+            return content_hash(f)
+
+    def run(self):
+        """Syncs both sides and saves the state. Returns how many files
+        were uploaded and downloaded, paths deleted on either side and
+        conflicts found. Requests to Dropbox are made as BULK."""
+        with self.remote.client.priority(BULK):
+            return self._run()
+
+    def _run(self):
+        counts = dict.fromkeys(('uploaded', 'downloaded', 'deleted_local',
+                                'deleted_remote', 'conflicts'), 0)
+        remote, cursor = self.remote_changes()
+        local = self.local_changes()
+        jobs = []
+        folders = []
+        deleted = set()
+
+        def count(name):
+            with self.lock:
+                counts[name] += 1
+
+        def bulk(job):
+            def run():
+                with self.remote.client.priority(BULK):
+                    job()
+            jobs.append(run)
+
+        def download(key, rel, metadata):
+            def job():
+                with self.remote.open(self.remote_path(rel), 'rb') as f:
+                    self.local.setcontents(rel, f)
+                self.record(key, rel, metadata)
+                count('downloaded')
+            bulk(job)
+
+        def upload(key, rel, known):
+            def job():
+                path = self.remote_path(rel)
+                rev = known and not known['folder'] and known['rev'] or None
+                try:
+                    with self.local.open(rel, 'rb') as f:
+                        self.remote.setcontents(path, f, rev=rev)
+                except RevisionConflictError:
+                    # Changed in Dropbox meanwhile, the next run sees it.
+                    count('conflicts')
+                    return
+                self.record(key, rel, self.remote.client.stat(path))
+                count('uploaded')
+            bulk(job)
+
+        def take_remote(key, metadata):
+            rel = self.relative(metadata.path_display)
+            if isinstance(metadata, FolderMetadata):
+                if self.local.isfile(rel):
+                    self.local.remove(rel)
+                self.local.makedir(rel, recursive=True, allow_recreate=True)
+                self.record(key, rel)
+            else:
+                if self.local.isdir(rel):
+                    self.local.removedir(rel, force=True)
+                download(key, rel, metadata)
+
+        def delete_remote(rel):
+            try:
+                self.remote.client.files_delete(self.remote_path(rel))
+            except ResourceNotFoundError:
+                pass
+
+        def take_local(key, rel, info, known):
+            if known is not None and known['folder'] != (info is None):
+                delete_remote(rel)
+            if info is None:
+                folders.append(self.remote_path(rel))
+                self.record(key, rel)
+            elif known is not None and known['hash'] is not None and \
+                    known['hash'] == self.local_hash(rel):
+                # Only touched, there is nothing to upload.
+                self.record(key, rel, self.remote.client.stat(
+                    self.remote_path(rel)))
+            else:
+                upload(key, rel, known)
+
+        # Parents are handled before their children, which are skipped if
+        # the parent was deleted.
+        keys = sorted(set(remote) | set(local), key=lambda k: k.split('/'))
+        for key in keys:
+            parts = key.split('/')
+            if any('/'.join(parts[:i]) in deleted
+                   for i in xrange(2, len(parts))):
+                continue
+            known = self.entries.get(key)
+            if key in remote and key in local:
+                metadata, change = remote[key], local[key]
+                if metadata is None and change is None:
+                    self.forget(key)
+                elif metadata is None:
+                    # Deleted in Dropbox, so there is no revision to update.
+                    take_local(key, change[0], change[1], None)
+                elif change is None:
+                    take_remote(key, metadata)
+                elif isinstance(metadata, FolderMetadata) and \
+                        change[1] is None:
+                    self.record(key, change[0])
+                elif not isinstance(metadata, FolderMetadata) and \
+                        change[1] is not None and metadata.content_hash == \
+                        self.local_hash(change[0]):
+                    self.record(key, change[0], metadata)
+                else:
+                    rel = change[0]
+                    root, ext = os.path.splitext(basename(rel))
+                    self.local.rename(rel, pathjoin(
+                        dirname(rel), '%s (conflicted copy %s)%s' % (
+                            root, time.strftime('%Y-%m-%d'), ext)))
+                    count('conflicts')
+                    take_remote(key, metadata)
+            elif key in remote:
+                metadata = remote[key]
+                if metadata is not None:
+                    take_remote(key, metadata)
+                    continue
+                rel = known['path']
+                if self.local.isdir(rel):
+                    self.local.removedir(rel, force=True)
+                elif self.local.exists(rel):
+                    self.local.remove(rel)
+                deleted.add(key)
+                self.forget(key)
+                count('deleted_local')
+            else:
+                change = local[key]
+                if change is not None:
+                    take_local(key, change[0], change[1], known)
+                    continue
+                delete_remote(known['path'])
+                deleted.add(key)
+                self.forget(key)
+                count('deleted_remote')
+        # What was done is saved even if a transfer failed, but the cursor
+        # is only advanced once everything was.
+        try:
+            self.remote.makedirs(folders)
+            run_parallel(jobs, self.parallelism)
+            self.cursor = cursor
+        finally:
+            self.save()
+        return counts
+
+
+def tree_sizes(pages, path):
+    """Adds up the size and number of files below each folder of a
+    recursive listing of path (pages as yielded by list_tree()), in one pass
+    over it. Returns a dict of each folder's path, as displayed, to its size
+    and file count."""
+    root = path.lower()
+    names = {root: path}
+    totals = {root: [0, 0]}
+    for page in pages:
+        for entry in page:
+            if isinstance(entry, FolderMetadata):
+                names[entry.path_lower] = entry.path_display
+                totals.setdefault(entry.path_lower, [0, 0])
+            elif not isinstance(entry, DeletedMetadata):
+                total = totals.setdefault(dirname(entry.path_lower), [0, 0])
+                total[0] += entry.size
+                total[1] += 1
+    # Add each folder to its parent, deepest folders first, rather than
+    # every file to all of its ancestors.
+    for key in sorted(totals, key=lambda p: -p.count('/')):
+        if key != root:
+            parent = totals.setdefault(dirname(key), [0, 0])
+            parent[0] += totals[key][0]
+            parent[1] += totals[key][1]
+    return dict((names.get(key, key), tuple(total))
+                for key, total in totals.items())
+
+
+def run_parallel(jobs, parallelism):
+    """Calls the functions in jobs with parallelism threads. Raises the first
+    error, after which no more jobs are started."""
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                job()
+            except Exception, e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(parallelism, queue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def write_line(out, *fields):
+    "Writes fields to out as a line separated by tabs."
+    line = u'\t'.join(unicode(field) for field in fields) + u'\n'
+    out.write(line.encode('utf8'))
+
+
+def command_ls(fs, args, out):
+    """ls [-R] [-l] [path]: lists a folder. With -R everything below it is
+    listed recursively, written out as each page of the listing arrives."""
+    parser = optparse.OptionParser(prog='dropboxfs ls',
+                                   usage='%prog [-R] [-l] [path]')
+    parser.add_option('-R', '--recursive', action='store_true',
+                      help='List everything below the folder.')
+    parser.add_option('-l', '--long', action='store_true',
+                      help='Show sizes and modification times.')
+    options, args = parser.parse_args(args)
+    path = abspath(normpath(args[0] if args else '/'))
+    if options.recursive:
+        entries = (
+            (entry.path_display, metadata_to_info(
+                entry, localtime=fs.localtime, timezone=fs.timezone))
+            for page in fs.client.list_tree(path) for entry in page
+            if entry.path_lower != path.lower())
+    else:
+        entries = fs.ilistdirinfo(path)
+    for name, info in entries:
+        if info['isdir']:
+            name += u'/'
+        if options.long:
+            write_line(out, info['size'], info['modified_time'] or '', name)
+        else:
+            write_line(out, name)
+
+
+def command_du(fs, args, out):
+    """du [-d depth] [-n count] [path]: shows the total size and number of
+    files below each folder, from a single recursive listing."""
+    parser = optparse.OptionParser(prog='dropboxfs du',
+                                   usage='%prog [-d depth] [-n count] [path]')
+    parser.add_option('-d', '--max-depth', type='int',
+                      help='Only show folders this deep below the path.')
+    parser.add_option('-n', '--largest', type='int',
+                      help='Only show this many folders, largest first.')
+    options, args = parser.parse_args(args)
+    path = abspath(normpath(args[0] if args else '/'))
+    totals = tree_sizes(fs.client.list_tree(path), path)
+    if options.max_depth is not None:
+        start = len(path.rstrip('/'))
+        depth = lambda p: p.rstrip('/')[start:].count('/')
+        totals = dict((p, t) for p, t in totals.items()
+                      if depth(p) <= options.max_depth)
+    if options.largest is not None:
+        folders = sorted(totals, key=lambda p: -totals[p][0])
+        folders = folders[:options.largest]
+    else:
+        folders = sorted(totals, key=lambda p: p.lower())
+    for folder in folders:
+        size, files = totals[folder]
+        write_line(out, size, files, folder)
+
+
+def command_stat(fs, args, out):
+    "stat path...: shows the info of files and folders."
+    parser = optparse.OptionParser(prog='dropboxfs stat',
+                                   usage='%prog path...')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('a path is required')
+    for path in args:
+        info = fs.getinfo(path)
+        write_line(out, abspath(normpath(path)))
+        for key in sorted(info):
+            write_line(out, u'', key, info[key])
+
+
+def command_find(fs, args, out):
+    "find [path] pattern: shows everything below path matching a glob."
+    parser = optparse.OptionParser(prog='dropboxfs find',
+                                   usage='%prog [path] pattern')
+    options, args = parser.parse_args(args)
+    if len(args) not in (1, 2):
+        parser.error('a pattern and optionally a path are required')
+    path = args[0] if len(args) == 2 else '/'
+    for found in fs.find(args[-1], path):
+        write_line(out, found)
+
+
+def command_rm(fs, args, out):
+    "rm [-r] path...: removes files, and folders with -r."
+    parser = optparse.OptionParser(prog='dropboxfs rm',
+                                   usage='%prog [-r] path...')
+    parser.add_option('-r', '--recursive', action='store_true',
+                      help='Remove folders along with their contents.')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('a path is required')
+    for path in args:
+        if fs.isdir(path):
+            if not options.recursive:
+                raise ResourceInvalidError(path, msg='%(path)s is a folder')
+            fs.removedir(path)
+        else:
+            fs.remove(path)
+
+
+def command_cp(fs, args, out):
+    """cp [-r] [-j count] src... dst: copies files, and folders with -r.
+    Paths starting with file: are local, others are in Dropbox. Files are
+    transferred count at a time; copies within Dropbox are done by it."""
+    parser = optparse.OptionParser(prog='dropboxfs cp',
+                                   usage='%prog [-r] [-j count] src... dst')
+    parser.add_option('-r', '--recursive', action='store_true',
+                      help='Copy folders along with their contents.')
+    parser.add_option('-j', '--jobs', type='int', default=PREFETCH_PARALLELISM,
+                      help='Number of files to transfer at once.')
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error('a source and a destination are required')
+    paths = [(p.startswith('file:'), p[5:] if p.startswith('file:') else
+              abspath(normpath(p))) for p in args]
+    (dst_local, dst), sources = paths[-1], paths[:-1]
+    if dst_local:
+        dst_isdir = os.path.isdir(dst)
+    else:
+        dst_isdir = fs.isdir(dst)
+    lock = threading.Lock()
+    jobs = []
+
+    def transfer(src, src_local, target):
+        def job():
+            if src_local:
+                with open(src, 'rb') as f:
+                    fs.setcontents(target, f)
+            else:
+                fs.download_parallel(src, target)
+            with lock:
+                write_line(out, src, target)
+        jobs.append(job)
+
+    for src_local, src in sources:
+        if len(sources) > 1 or dst_isdir:
+            if dst_local:
+                target = os.path.join(dst, basename(src.rstrip('/')))
+            else:
+                target = pathjoin(dst, basename(src.rstrip('/')))
+        else:
+            target = dst
+        if src_local and dst_local:
+            parser.error('at least one path must be in Dropbox')
+        isdir = os.path.isdir(src) if src_local else fs.isdir(src)
+        if isdir and not options.recursive:
+            raise ResourceInvalidError(src, msg='%(path)s is a folder')
+        if not src_local and not dst_local:
+            if isdir:
+                fs.copydir(src, target, overwrite=True)
+            else:
+                fs.copy(src, target, overwrite=True)
+            write_line(out, src, target)
+        elif not isdir:
+            transfer(src, src_local, target)
+        elif src_local:
+            folders = [target]
+            for root, dirs, files in os.walk(src):
+                remote = os.path.relpath(root, src)
+                if remote == os.curdir:
+                    remote = target
+                else:
+                    remote = pathjoin(target, remote.replace(os.sep, '/'))
+                folders.extend(pathjoin(remote, name) for name in dirs)
+                for name in files:
+                    transfer(os.path.join(root, name), True,
+                             pathjoin(remote, name))
+            fs.makedirs(folders)
+        else:
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            prefix = len(src.rstrip('/'))
+            for page in fs.client.list_tree(src):
+                for entry in page:
+                    local = os.path.join(target, *entry.path_display[
+                        prefix:].strip('/').split('/'))
+                    if isinstance(entry, FolderMetadata):
+                        if not os.path.isdir(local):
+                            os.makedirs(local)
+                    elif not isinstance(entry, DeletedMetadata):
+                        transfer(entry.path_display, False, local)
+    run_parallel(jobs, options.jobs)
+
+
+def command_sync(fs, args, out):
+    """sync [-j count] [-f state] dir [path]: syncs a local folder with a
+    folder in Dropbox both ways, see DropboxSync."""
+    from fs.osfs import OSFS
+    parser = optparse.OptionParser(
+        prog='dropboxfs sync', usage='%prog [-j count] [-f state] dir [path]')
+    parser.add_option('-j', '--jobs', type='int', default=SYNC_PARALLELISM,
+                      help='Number of files to transfer at once.')
+    parser.add_option('-f', '--state',
+                      help='File to keep the state in between runs, by '
+                           'default .dropboxfs-sync-<dir> next to dir.')
+    options, args = parser.parse_args(args)
+    if len(args) not in (1, 2):
+        parser.error('a local folder and optionally a path are required')
+    local = os.path.abspath(args[0])
+    state = options.state or os.path.join(
+        os.path.dirname(local), '.dropboxfs-sync-' + os.path.basename(local))
+    sync = DropboxSync(OSFS(local, create=True), fs,
+                       args[1] if len(args) == 2 else '/', state_path=state,
+                       parallelism=options.jobs)
+    counts = sync.run()
+    for name in sorted(counts):
+        write_line(out, name, counts[name])
+
+
+COMMANDS = OrderedDict([
+    ('ls', command_ls),
+    ('du', command_du),
+    ('stat', command_stat),
+    ('find', command_find),
+    ('cp', command_cp),
+    ('rm', command_rm),
+    ('sync', command_sync),
+])
+
+
+def authorize(app_key, app_secret):  # pragma: no cover
+    "Obtains an access token by having the user authorize the app."
+    session = {}
+    dbx = DropboxOAuth2Flow(
+        app_key,
+        app_secret,
+        'https://goo.gl/',
+        session,
+        'dropbox-auth-csrf-token')
+    print "Please visit the following URL and authorize this application.\n"
+    print dbx.start()
+    print "\nWhen you are done, observe the query parameters from the redirect and press <enter>."
+    raw_input()
+    state = raw_input('Please enter the state from the query parameters: ')
+    code = raw_input('Please enter the code from the query parameters: ')
+    result = dbx.finish({'state': state, 'code': code})
+    print 'Your access token will be printed below, store it for later use.'
+    print 'For future accesses, you can pass the --token argument.\n'
+    print 'Access token:', result.access_token
+    return result.access_token
+
+
+def main(args=None, out=sys.stdout):
+    parser = optparse.OptionParser(
+        prog="dropboxfs", usage="%prog [options] command [args]",
+        description="Command line interface for DropboxFS. Commands are: "
+                    "%s. Run a command with -h for its usage."
+                    % ', '.join(COMMANDS))
+    parser.disable_interspersed_args()
     parser.add_option(
         "-k",
         "--app-key",
@@ -578,60 +3254,33 @@ def main():  # pragma: no cover
         "-a",
         "--token",
         help="Your access token key (if you previously obtained one.")
+    parser.add_option(
+        "-n",
+        "--namespace-id",
+        help="A namespace to use as the root instead of your home folder.")
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(args)
 
-    # Can't operate without these parameters.
-    if not options.app_key or not options.app_secret:
-        parser.error('You must obtain an app key and secret from Dropbox at the following URL.\n\nhttps://www.dropbox.com/developers/apps')
+    if not args or args[0] not in COMMANDS:
+        parser.error('A command is required, one of: %s'
+                     % ', '.join(COMMANDS))
 
     # Instantiate a client one way or another.
-    if not options.token:
-        session = {}
-        dbx = DropboxOAuth2Flow(
-            options.app_key,
-            options.app_secret,
-            'https://goo.gl/',
-            session,
-            'dropbox-auth-csrf-token')
-        print "Please visit the following URL and authorize this application.\n"
-        print dbx.start()
-        print "\nWhen you are done, observe the query parameters from the redirect and press <enter>."
-        raw_input()
-        state = raw_input('Please enter the state from the query parameters: ')
-        code = raw_input('Please enter the code from the query parameters: ')
-        result = dbx.finish({'state': state, 'code': code})
-        token = result.access_token
-        print 'Your access token will be printed below, store it for later use.'
-        print 'For future accesses, you can pass the --token argument.\n'
-        print 'Access token:', result.access_token
-        print "\nWhen you are done, please press <enter>."
-        raw_input()
-    else:
+    if options.token:
         token = options.token
+    elif options.app_key and options.app_secret:  # pragma: no cover
+        token = authorize(options.app_key, options.app_secret)
+    else:
+        # Can't operate without these parameters.
+        parser.error('You must obtain an app key and secret from Dropbox at the following URL.\n\nhttps://www.dropbox.com/developers/apps')
 
-    fs = DropboxFS(token)
-
-    print fs.getinfo('/Public')
-    if fs.exists('/Bar'):
-        fs.removedir('/Bar')
-    print fs.listdir('/')
-    fs.makedir('/Bar')
-    print fs.listdir('/')
-    print fs.listdir('/Foo')
-
-    filelike = fs.open('/big-file.pdf')
-    print filelike.read(100)
-    filelike.seek(100)
-    chunk2 = filelike.read(100)
-    print chunk2
-    filelike.seek(200)
-    print filelike.read(100)
-    filelike.seek(100)
-    chunk2a = filelike.read(100)
-    print chunk2a
-    assert chunk2 == chunk2a
-    filelike.close()
+    fs = DropboxFS(token, namespace_id=options.namespace_id)
+    try:
+        COMMANDS[args[0]](fs, args[1:], out)
+    except FSError, e:
+        sys.stderr.write('dropboxfs %s: %s\n' % (args[0], e))
+        return 1
+    return 0
 
 if __name__ == '__main__':  # pragma: no cover
-    main()
+    sys.exit(main())
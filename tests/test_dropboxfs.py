@@ -1,11 +1,21 @@
 """DropboxFS tests."""
+import calendar
 import datetime
 import dropbox
+import io
+import json
+import os
 import pytz
 import random
 import requests
+import shutil
 import six
+import socket
 import string
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import traceback
 import unittest
@@ -14,6 +24,8 @@ from mock.mock import patch
 from mock.mock import Mock
 from mock.mock import PropertyMock
 
+from dropbox.dropbox import RouteErrorResult
+from dropbox.dropbox import RouteResult
 from dropbox.files import (
     CreateFolderError,
     DeletedMetadata,
@@ -21,36 +33,107 @@ from dropbox.files import (
     DownloadError,
     FileMetadata,
     FolderMetadata,
+    GetCopyReferenceError,
+    GetCopyReferenceResult,
     GetMetadataError,
+    GetTemporaryLinkError,
+    GetTemporaryLinkResult,
+    ListFolderContinueError,
     ListFolderError,
     ListFolderResult,
     LookupError,
+    RelocationBatchError,
+    RelocationBatchJobStatus,
+    RelocationBatchLaunch,
+    RelocationBatchResult,
     RelocationError,
+    RelocationResult,
+    SaveCopyReferenceError,
+    SaveCopyReferenceResult,
+    SearchError,
+    SearchMatch,
+    SearchMatchType,
+    SearchMode,
+    SearchResult,
     UploadError,
+    UploadSessionFinishError,
+    UploadSessionLookupError,
+    UploadSessionStartResult,
+    UploadWriteFailed,
     WriteConflictError,
     WriteError,
+    WriteMode,
 )
 from dropboxfs import (
+    BULK,
     CACHE_TTL,
+    PREFETCH_WINDOW,
     CacheItem,
     ChunkedReader,
     ContextManagerStream,
     DropboxCache,
     DropboxClient,
     DropboxFS,
+    DropboxPool,
+    DropboxSync,
     INFO_TIMEZONE,
+    INTERACTIVE,
     MAX_BUFFER,
+    MappedReader,
+    MaterializedFile,
+    Prefetcher,
+    ReplayClient,
+    RequestScheduler,
+    RevisionConflictError,
+    SessionWriter,
+    SharedDropboxCache,
     SpooledWriter,
+    SyntheticBody,
+    cache_manager,
+    TrafficRecorder,
+    TreeIndex,
+    UploadSession,
+    command_cp,
+    command_du,
+    command_find,
+    command_ls,
+    command_rm,
+    command_stat,
+    command_sync,
+    content_hash,
+    get_timezone,
+    main,
+    metadata_to_info,
+    payload_size,
+    redact,
+    replay,
+    run_parallel,
+    search_query,
+    serve_cache,
+    tree_sizes,
 )
 from fs.base import NoDefaultMeta
+from fs.filelike import StringIO
+from fs.memoryfs import MemoryFS
+from fs.path import basename
+from fs.path import pathjoin
 from fs.errors import (
     DestinationExistsError,
+    OperationFailedError,
+    ParentDirectoryMissingError,
     RemoteConnectionError,
     ResourceInvalidError,
     ResourceNotFoundError,
 )
 
 
+class FakeRaw(io.BytesIO):
+    """A stand in for a download's raw response stream."""
+
+    def getheader(self, name):
+        return len(self.getvalue())
+
+
 class TestSpooledWriter(unittest.TestCase):
     """Test SpooledWriter."""
 
@@ -82,6 +165,138 @@ class TestSpooledWriter(unittest.TestCase):
             self.writer.client.files_upload.call_args[0][0],
             six.binary_type)
 
+    def test_close_chunked(self):
+        """Test closing a file larger than a chunk."""
+        client = Mock(spec=DropboxClient)
+        client.cache = DropboxCache()
+        client.files_upload_session_start.return_value = \
+            UploadSessionStartResult(session_id='abc')
+        writer = SpooledWriter(client, '/file1.txt', max_buffer=0,
+                               spool_dir=tempfile.gettempdir(), chunk_size=4)
+        self.assertNotIsInstance(writer.temp, StringIO)
+
+        writer.write('0123456789')
+        writer.close()
+
+        client.files_upload_session_start.assert_called_once_with('0123')
+        self.assertEqual(
+            '4567', client.files_upload_session_append_v2.call_args[0][0])
+        data, cursor, commit = client.files_upload_session_finish.call_args[0]
+        self.assertEqual(('89', 8, '/file1.txt'),
+                         (data, cursor.offset, commit.path))
+        self.assertEqual(0, client.files_upload.call_count)
+
+    def test_write_spools_once(self):
+        """Test the buffer is only copied to disk once."""
+        writer = SpooledWriter(self.writer.client, '/file1.txt', max_buffer=4)
+
+        with patch('dropboxfs.shutil.copyfileobj') as mock_copy:
+            for i in range(5):
+                writer.write('123')
+
+        self.assertEqual(1, mock_copy.call_count)
+        self.assertEqual(15, len(writer))
+
+
+class TestUploadSession(unittest.TestCase):
+    """Test UploadSession."""
+
+    def setUp(self):
+        self.client = Mock(spec=DropboxClient)
+        self.client.cache = DropboxCache()
+        self.session = UploadSession(self.client, '/file1.txt')
+
+    def test_start_error(self):
+        """Test failing to start an upload session."""
+        self.client.files_upload_session_start.side_effect = \
+            dropbox.exceptions.ApiError('1', None, 'message', '')
+        self.session.append('123')
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.session.append('456')
+
+    def test_finish_error(self):
+        """Test failing to commit an upload session."""
+        self.client.files_upload_session_start.return_value = \
+            UploadSessionStartResult(session_id='abc')
+        self.client.files_upload_session_finish.side_effect = \
+            dropbox.exceptions.ApiError(
+                '1', UploadSessionFinishError('other'), 'message', '')
+        self.session.append('123')
+        self.session.append('456')
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.session.finish()
+
+    def test_finish_conflict(self):
+        """Test committing an update of a file that was changed."""
+        session = UploadSession(self.client, '/file.txt',
+                                mode=WriteMode.update('a1b2c3d4e5'))
+        self.client.files_upload_session_start.return_value = \
+            UploadSessionStartResult(session_id='abc')
+        write_error = WriteError(tag='conflict',
+                                 value=WriteConflictError(tag='file'))
+        self.client.files_upload_session_finish.side_effect = \
+            dropbox.exceptions.ApiError(
+                '1', UploadSessionFinishError('path', write_error),
+                'message', '')
+        session.append('123')
+        session.append('456')
+
+        with self.assertRaises(RevisionConflictError):
+            session.finish()
+        commit = self.client.files_upload_session_finish.call_args[0][2]
+        self.assertEqual('a1b2c3d4e5', commit.mode.get_update())
+
+
+class TestSessionWriter(unittest.TestCase):
+    """Test SessionWriter."""
+
+    def setUp(self):
+        self.client = Mock(spec=DropboxClient)
+        self.client.cache = DropboxCache()
+        self.client.files_upload_session_start.return_value = \
+            UploadSessionStartResult(session_id='abc')
+
+    def test_write(self):
+        """Test streaming a file into an upload session."""
+        with SessionWriter(self.client, '/file1.txt', size=10,
+                           chunk_size=4) as writer:
+            writer.write('01')
+            writer.write('23456')
+            writer.flush()
+            self.assertEqual(3, len(writer.buf))
+            self.assertEqual(7, writer.tell())
+            writer.write('789')
+
+        self.assertEqual(10, len(writer))
+        self.client.files_upload_session_start.assert_called_once_with(
+            '0123')
+        self.assertEqual(
+            '89', self.client.files_upload_session_finish.call_args[0][0])
+        writer.close()
+        self.assertEqual(
+            1, self.client.files_upload_session_finish.call_count)
+
+    def test_write_small(self):
+        """Test streaming a file smaller than a chunk."""
+        writer = SessionWriter(self.client, '/file1.txt', chunk_size=4)
+        writer.write('01')
+        writer.close()
+
+        self.client.files_upload.assert_called_once_with(
+            '01', '/file1.txt', mode=WriteMode.overwrite)
+
+    def test_write_wrong_size(self):
+        """Test streaming a file of another length than announced."""
+        writer = SessionWriter(self.client, '/file1.txt', size=10)
+        writer.write('01')
+
+        with self.assertRaises(OperationFailedError) as e:
+            writer.close()
+        self.assertEqual(0, self.client.files_upload.call_count)
+
+
 class TestChunkedReader(unittest.TestCase):
     """Test ChunkedReader."""
 
@@ -142,12 +357,12 @@ class TestChunkedReader(unittest.TestCase):
         self.reader.seek(15)
         self.assertEqual(15, self.reader.tell())
 
-    @patch.object(ChunkedReader, 'read')
-    def test_next(self, mock_read):
-        """Test getting the next piece of data."""
-        mock_read.side_effect = ['123', None]
+    def test_next(self):
+        """Test iterating over the lines of the file."""
+        self.reader.r = FakeRaw('line 1\nline 2\n\nlast line')
 
-        self.assertEqual('123', self.reader.next())
+        self.assertEqual(
+            ['line 1\n', 'line 2\n', '\n', 'last line'], list(self.reader))
         with self.assertRaises(StopIteration) as e:
             self.reader.next()
 
@@ -165,9 +380,10 @@ class TestChunkedReader(unittest.TestCase):
 
         data = self.reader.read()
 
+        # Positions move by what was read, not by what was asked for.
         self.assertEqual('456', data)
-        self.assertEqual(1028, self.reader.seek_pos)
-        self.assertEqual(1028, self.reader.pos)
+        self.assertEqual(6, self.reader.seek_pos)
+        self.assertEqual(6, self.reader.pos)
 
         self.reader.seek(64)
         data = self.reader.read(3)
@@ -188,15 +404,80 @@ class TestChunkedReader(unittest.TestCase):
         self.assertTrue(self.reader.closed)
         self.assertEqual('', data)
 
+    def test_readinto(self):
+        """Test reading data into a buffer."""
+        self.reader.r = FakeRaw('123456789')
+        buf = bytearray(4)
+
+        self.assertEqual(4, self.reader.readinto(buf))
+        self.assertEqual('1234', buf)
+        self.assertEqual(4, self.reader.tell())
+
+        _, response = self.reader.client.files_download.return_value
+        response.raw.read.side_effect = ['12', 'ab']
+        self.reader.seek(2)
+
+        self.assertEqual(2, self.reader.readinto(buf))
+        self.assertEqual('ab34', buf)
+
+    @patch('dropboxfs.DOWNLOAD_CHUNK_SIZE', 4)
     def test_readline(self):
         """Test reading a line of the file."""
-        with self.assertRaises(NotImplementedError) as e:
-            self.reader.readline()
+        self.reader.r = FakeRaw('first line\nsecond\nthird')
+
+        self.assertEqual('first line\n', self.reader.readline())
+        self.assertEqual(11, self.reader.tell())
+        self.assertEqual('se', self.reader.readline(2))
+        self.assertEqual('co', self.reader.read(2))
+        self.assertEqual('nd\n', self.reader.readline(10))
+        self.assertEqual('third', self.reader.readline())
+        self.assertEqual('', self.reader.readline())
+
+    @patch('dropboxfs.DOWNLOAD_CHUNK_SIZE', 4)
+    def test_readline_mixed(self):
+        """Test mixing line reads with reads and seeks."""
+        self.reader.r = FakeRaw('ab\ncdefg\ni\nj')
+
+        self.assertEqual('ab\n', self.reader.readline())
+        self.assertEqual(3, self.reader.tell())
+        buf = bytearray(2)
+        self.assertEqual(2, self.reader.readinto(buf))
+        self.assertEqual('cd', buf)
+        self.assertEqual('ef', self.reader.read(2))
+        self.assertEqual('g\n', self.reader.readline())
+        self.assertEqual('i', self.reader.readline(1))
+        self.assertEqual(10, self.reader.tell())
+        self.reader.seek(1, 1)
+        self.assertEqual(11, self.reader.tell())
+        self.assertEqual('j', self.reader.read())
+
+        self.reader.seek(0)
+        self.assertEqual(0, self.reader.tell())
+
+    def test_readline_short_chunk(self):
+        """Test positions after a line read hits the end of the file."""
+        self.reader.r = FakeRaw('ab\ncd\nefg')
+        downloads = self.reader.client.files_download.call_count
+
+        self.assertEqual('ab\n', self.reader.readline())
+        self.assertEqual(3, self.reader.tell())
+        self.assertEqual('cd\n', self.reader.readline())
+        self.assertEqual(6, self.reader.tell())
+
+        # Seeking back within what was read ahead needs no new download.
+        self.reader.seek(1)
+        self.assertEqual('b\n', self.reader.readline())
+        self.assertEqual('cd\nefg', self.reader.read())
+        self.assertEqual(9, self.reader.tell())
+        self.assertEqual(
+            downloads, self.reader.client.files_download.call_count)
 
     def test_readlines(self):
         """Test reading a list of lines of the file."""
-        with self.assertRaises(NotImplementedError) as e:
-            self.reader.readlines()
+        self.reader.r = FakeRaw('1\n22\n333\n4444\n')
+
+        self.assertEqual(['1\n', '22\n'], self.reader.readlines(4))
+        self.assertEqual(['333\n', '4444\n'], self.reader.readlines())
 
     def test_writable(self):
         """Test if file is writeable."""
@@ -213,6 +494,90 @@ class TestChunkedReader(unittest.TestCase):
         self.assertTrue(self.reader.closed)
 
 
+class TestMaterializedFile(unittest.TestCase):
+    """Test MaterializedFile."""
+
+    def setUp(self):
+        self.client = Mock(spec=DropboxClient)
+        self.shared = MaterializedFile(
+            self.client, FileMetadata(name=u'f', size=300), 'link',
+            block_size=100)
+
+    def tearDown(self):
+        self.shared.acquire()
+        self.shared.release()
+
+    def test_fetch_error(self):
+        """Test blocks that failed to download are fetched again."""
+        self.client.download_range.side_effect = [IOError(), None]
+
+        with self.assertRaises(IOError):
+            self.shared.fetch(0, 150)
+        self.assertEqual(bytearray(3), self.shared.blocks)
+
+        self.shared.fetch(0, 150)
+
+        self.assertEqual(bytearray([2, 2, 0]), self.shared.blocks)
+        self.assertEqual(
+            (('link', 0, 199, self.shared.temp.fileno()),),
+            self.client.download_range.call_args)
+
+    def test_fetch_concurrent(self):
+        """Test readers wait for blocks another reader is fetching."""
+        started = threading.Event()
+        proceed = threading.Event()
+        outcomes = [None, IOError()]
+
+        def download_range(link, start, end, fd):
+            started.set()
+            proceed.wait(5)
+            outcome = outcomes.pop()
+            if outcome:
+                raise outcome
+        self.client.download_range.side_effect = download_range
+        errors = []
+
+        def fetch():
+            try:
+                self.shared.fetch(0, 100)
+            except IOError, e:
+                errors.append(e)
+        first = threading.Thread(target=fetch)
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=fetch)
+        second.start()
+        second.join(0.1)
+
+        # The second reader waits rather than downloading the same block,
+        # and takes over once the first one fails.
+        self.assertTrue(second.is_alive())
+        self.assertEqual(1, self.client.download_range.call_count)
+        proceed.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(1, len(errors))
+        self.assertEqual(2, self.client.download_range.call_count)
+        self.assertEqual(bytearray([2, 0, 0]), self.shared.blocks)
+
+    def test_release(self):
+        """Test the file is given up before it is closed."""
+        closed = []
+        self.shared.on_close = lambda f: closed.append(f.temp.closed)
+        self.shared.acquire()
+        self.shared.acquire()
+
+        self.shared.release()
+        self.assertEqual([], closed)
+        self.shared.release()
+
+        self.assertEqual([False], closed)
+        self.assertTrue(self.shared.temp.closed)
+        self.shared = MaterializedFile(
+            self.client, FileMetadata(name=u'f', size=0), 'link')
+
+
 class TestCacheItem(unittest.TestCase):
     """Test CacheItem."""
 
@@ -240,6 +605,22 @@ class TestCacheItem(unittest.TestCase):
         self.item.del_child('child2')
         self.item.del_child('child1')
 
+    def test_has_child(self):
+        """Test looking up children by any casing."""
+        self.assertFalse(self.item.has_child('Child1'))
+        self.item.children = [u'Child1']
+        self.item.add_child(u'CHILD1')
+        self.item.add_child(u'child2')
+
+        self.assertTrue(self.item.has_child('child1'))
+        self.assertTrue(self.item.has_child('Child2'))
+        self.assertEqual([u'Child1', u'child2'], self.item.children)
+
+        self.item.del_child('CHILD1')
+
+        self.assertFalse(self.item.has_child('child1'))
+        self.assertEqual([u'child2'], self.item.children)
+
     def test_renew(self):
         """Test renewing an item."""
         self.assertTrue(self.item.expired)
@@ -257,13 +638,22 @@ class TestDropboxCache(unittest.TestCase):
 
     def test_set(self):
         """Test setting an item."""
-        self.cache.set('/files', {})
+        self.cache['/files'] = CacheItem({}, [])
+        self.cache.set('/files/file.txt', {})
         self.cache.set('/files/file.txt', {})
 
         self.assertEqual(2, len(self.cache))
         self.assertEqual(1, len(self.cache.get('/files').children))
         self.assertEqual('file.txt', self.cache.get('/files').children[0])
 
+    def test_set_unlisted_parent(self):
+        """Test setting an item whose parent was never listed."""
+        self.cache.set('/files', {})
+        self.cache.set('/files/file.txt', {})
+
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get('/files').children)
+
     def test_pop(self):
         """Test poping an item."""
         self.cache.set('/files', {})
@@ -273,6 +663,473 @@ class TestDropboxCache(unittest.TestCase):
 
         self.assertEqual(1, len(self.cache))
 
+    def test_case_insensitive(self):
+        """Test any casing of a path finds the same item."""
+        self.cache['/Files'] = CacheItem(FolderMetadata(name=u'Files'), [])
+        self.cache.set('/files/File.txt', FileMetadata(name=u'File.txt'))
+
+        self.assertIn('/FILES', self.cache)
+        self.assertIs(self.cache['/files'], self.cache.get('/FiLeS'))
+        self.assertEqual(['File.txt'], self.cache['/FILES'].children)
+
+        self.cache.pop('/FILES/file.TXT')
+
+        self.assertEqual([], self.cache['/files'].children)
+
+        del self.cache['/FILES']
+
+        self.assertEqual(0, len(self.cache))
+
+    def test_pop_tree(self):
+        """Test poping an item and everything below it."""
+        self.cache['/'] = CacheItem({}, [])
+        self.cache.set('/files', {})
+        self.cache.set('/files/more', {})
+        self.cache.set('/files/more/file.txt', {})
+        self.cache.set('/files2', {})
+
+        self.cache.pop_tree('/files')
+
+        self.assertEqual(['/', '/files2'], sorted(self.cache.keys()))
+        self.assertNotIn('files', self.cache.get('/').children)
+
+
+class TestSharedDropboxCache(unittest.TestCase):
+    """Test SharedDropboxCache."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tempdir, 'cache.sock')
+        self.manager = cache_manager(self.address, authkey='key')
+        self.manager.start()
+
+    def tearDown(self):
+        self.manager.shutdown()
+        shutil.rmtree(self.tempdir)
+
+    def cache(self, prefix='a:'):
+        return SharedDropboxCache(self.address, prefix=prefix, authkey='key')
+
+    def test_shared(self):
+        """Test caches with the same prefix share their items."""
+        cache1, cache2, other = self.cache(), self.cache(), self.cache('b:')
+
+        cache1['/Files'] = CacheItem(FolderMetadata(name=u'Files'), [])
+        cache1.set('/files/a.txt', FileMetadata(name=u'a.txt'))
+        cache1.set_parents('/files/sub/b')
+
+        self.assertEqual([u'a.txt', u'sub'], cache2.get('/FILES').children)
+        self.assertIn('/files/a.txt', cache2)
+        self.assertIsInstance(cache2['/files/sub'].metadata, FolderMetadata)
+        self.assertNotIn('/files', other)
+
+        cache2.pop('/files/a.txt')
+        cache2.update({'/files/c.txt': CacheItem(FileMetadata(name=u'c'))})
+        other.set('/x.txt', FileMetadata(name=u'x.txt'))
+
+        self.assertEqual([u'sub'], cache1['/files'].children)
+        self.assertIn('/files/c.txt', cache1)
+        self.assertEqual(4, len(cache1))
+
+        cache1.pop_tree('/files')
+        del other['/x.txt']
+
+        self.assertNotIn('/files/sub', cache2)
+        self.assertEqual(0, len(cache2))
+        other.set('/x.txt', FileMetadata(name=u'x.txt'))
+        cache1.set('/y.txt', FileMetadata(name=u'y.txt'))
+        cache1.clear()
+        self.assertIn('/x.txt', other)
+
+    def test_expired(self):
+        """Test items expire for all processes alike."""
+        cache1, cache2 = self.cache(), self.cache()
+        cache1['/a'] = CacheItem(FileMetadata(name=u'a'),
+                                 timestamp=time.time() - CACHE_TTL)
+
+        self.assertTrue(cache2['/a'].expired)
+
+    def test_unavailable(self):
+        """Test falling back to a local dict without a server."""
+        cache = SharedDropboxCache(os.path.join(self.tempdir, 'missing'))
+
+        cache.set('/a', FileMetadata(name=u'a'))
+
+        self.assertEqual({'/a'}, set(cache.data.keys()))
+
+    def test_lost(self):
+        """Test falling back to a local dict when the server goes away."""
+        cache = self.cache()
+        cache.set('/a', FileMetadata(name=u'a'))
+        self.manager.shutdown()
+
+        self.assertNotIn('/a', cache)
+        cache.set('/b', FileMetadata(name=u'b'))
+        self.assertIn('/b', cache)
+        self.assertIsNone(cache.data.proxy)
+
+    def test_dropboxfs(self):
+        """Test file systems of an account share their cache."""
+        fs1 = DropboxFS('123', cache_address=self.address,
+                        cache_authkey='key')
+        fs2 = DropboxFS('123', cache_address=self.address,
+                        cache_authkey='key')
+        fs3 = DropboxFS('123', namespace_id='1', cache_address=self.address,
+                        cache_authkey='key')
+
+        fs1.client.cache.set('/a.txt', FileMetadata(name=u'a.txt', size=3))
+
+        self.assertEqual(3, fs2.getinfo('/a.txt')['size'])
+        self.assertNotIn('/a.txt', fs3.client.cache)
+
+    def test_serve_cache(self):
+        """Test running a cache server."""
+        with patch.object(type(self.manager), 'get_server') as mock_server:
+            serve_cache(self.address + '2', authkey='key')
+
+        mock_server.return_value.serve_forever.assert_called_once_with()
+
+
+FILE_JSON = json.dumps({
+    '.tag': 'file', 'name': 'a.txt', 'id': 'id:a', 'rev': 'a1c10ce0dd78',
+    'client_modified': '2015-05-12T15:50:38Z',
+    'server_modified': '2015-05-12T15:50:38Z', 'size': 7,
+    'path_lower': '/a.txt', 'path_display': '/a.txt'})
+
+NOT_FOUND_JSON = json.dumps({
+    'error': {'.tag': 'path', 'path': {'.tag': 'not_found'}}})
+
+
+class TestTrafficRecorder(unittest.TestCase):
+    """Test TrafficRecorder."""
+
+    def setUp(self):
+        self.recorder = TrafficRecorder()
+        self.fs = DropboxFS('123', recorder=self.recorder)
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_record(self, mock_request):
+        """Test an API call is recorded."""
+        mock_request.return_value = RouteResult(FILE_JSON)
+
+        self.assertEqual(7, self.fs.getinfo('/a.txt')['size'])
+
+        call, = self.recorder.calls
+        self.assertEqual('files/get_metadata', call['route'])
+        self.assertEqual('/a.txt', json.loads(call['arg'])['path'])
+        self.assertEqual(json.loads(FILE_JSON), json.loads(call['result']))
+        self.assertFalse(call['error'])
+        self.assertEqual(0, call['upload'])
+        self.assertIsNone(call['download'])
+        self.assertGreaterEqual(call['latency'], 0)
+        self.assertGreaterEqual(call['time'], 0)
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_no_recorder(self, mock_request):
+        """Test nothing is recorded without a recorder."""
+        mock_request.return_value = RouteResult(FILE_JSON)
+        self.fs.client.recorder = None
+
+        self.assertEqual(7, self.fs.getinfo('/a.txt')['size'])
+
+        self.assertEqual(0, len(self.recorder))
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_record_error(self, mock_request):
+        """Test an API call that fails with an error is recorded."""
+        mock_request.return_value = RouteErrorResult('req1', NOT_FOUND_JSON)
+
+        self.assertFalse(self.fs.exists('/b.txt'))
+
+        call, = self.recorder.calls
+        self.assertTrue(call['error'])
+        self.assertEqual('req1', call['request_id'])
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_record_exception(self, mock_request):
+        """Test an API call that raises is recorded."""
+        mock_request.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.fs.client.files_get_metadata('/a.txt')
+
+        self.assertEqual('ConnectionError', self.recorder.calls[0]['exception'])
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_record_transfers(self, mock_request):
+        """Test the size of uploads and downloads is recorded, not their
+        contents."""
+        response = requests.Response()
+        response.headers['Content-Length'] = '7'
+        mock_request.side_effect = [
+            RouteResult(FILE_JSON, response), RouteResult(FILE_JSON)]
+
+        self.fs.client.files_download('/a.txt')
+        self.fs.client.files_upload('content', '/a.txt')
+
+        download, upload = self.recorder.calls
+        self.assertEqual(7, download['download'])
+        self.assertEqual(7, upload['upload'])
+        self.assertNotIn('content', json.dumps(self.recorder.calls))
+
+    @patch.object(DropboxClient, '_download_range')
+    def test_record_download_range(self, mock_range):
+        """Test ranged downloads are recorded without their link."""
+        mock_range.side_effect = [
+            10, RemoteConnectionError(opname='download_range')]
+
+        self.assertEqual(
+            10, self.fs.client.download_range('https://link', 0, 9, 1))
+        with self.assertRaises(RemoteConnectionError):
+            self.fs.client.download_range('https://link', 10, 19, 1)
+
+        done, failed = self.recorder.calls
+        self.assertEqual(10, done['download'])
+        self.assertEqual('RemoteConnectionError', failed['exception'])
+        self.assertNotIn('https://link', done['arg'])
+
+    def test_redact(self):
+        """Test values giving access are replaced by a stable digest."""
+        data = json.dumps({'link': 'https://link', 'n': [
+            {'copy_reference': 'secret1', 'access_token': 'secret2',
+             'name': 'a'}]})
+
+        redacted = redact(data)
+
+        self.assertNotIn('https://link', redacted)
+        self.assertNotIn('secret', redacted)
+        self.assertIn('"a"', redacted)
+        self.assertEqual(redacted, redact(redacted))
+        self.assertEqual(redacted, redact(json.dumps(json.loads(data))))
+
+    def test_dump_load(self):
+        """Test recorded calls are saved and loaded as JSON lines."""
+        self.recorder.record('files/get_metadata', '{"path": "/a"}', 0,
+                             result=FILE_JSON)
+        f = io.BytesIO()
+
+        self.recorder.dump(f)
+        f.seek(0)
+
+        self.assertEqual(self.recorder.calls, TrafficRecorder.load(f).calls)
+        self.assertEqual(1, len(self.recorder))
+
+    def test_payload_size(self):
+        """Test the size of an upload is found for strings and files."""
+        with tempfile.TemporaryFile() as f:
+            f.write('12345')
+            f.flush()
+            self.assertEqual(5, payload_size(f))
+        self.assertEqual(0, payload_size(None))
+        self.assertEqual(3, payload_size('abc'))
+        self.assertIsNone(payload_size(object()))
+
+
+class TestReplayClient(unittest.TestCase):
+    """Test ReplayClient and replay()."""
+
+    def setUp(self):
+        self.recorder = TrafficRecorder()
+
+    def call(self, route, arg, **kwargs):
+        self.recorder.record(route, json.dumps(arg), time.time(), **kwargs)
+
+    def get_metadata(self, path, **kwargs):
+        self.call('files/get_metadata', {
+            'path': path, 'include_media_info': False,
+            'include_deleted': False,
+            'include_has_explicit_shared_members': False}, **kwargs)
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_replay(self, mock_request):
+        """Test a recorded workload is replayed without the API."""
+        response = requests.Response()
+        response.headers['Content-Length'] = '7'
+        response.raw = FakeRaw('content')
+        mock_request.side_effect = [
+            RouteResult(FILE_JSON),
+            RouteErrorResult('req1', NOT_FOUND_JSON),
+            RouteResult(FILE_JSON, response),
+        ]
+
+        def workload(fs):
+            results.append((fs.getinfo('/a.txt')['size'],
+                            fs.exists('/b.txt'),
+                            fs.open('/a.txt').read()))
+
+        results = []
+        workload(DropboxFS('123', recorder=self.recorder))
+        mock_request.reset_mock()
+        client = replay(self.recorder.calls, workload, speed=100)
+
+        self.assertFalse(mock_request.called)
+        self.assertEqual([(7, False, 'content'), (7, False, '\0' * 7)],
+                         results)
+        self.assertEqual(3, len(client.replayed))
+        self.assertGreaterEqual(client.elapsed, 0)
+
+    def test_order(self):
+        """Test calls are answered in recorded order, repeating the last."""
+        self.get_metadata('/a.txt', result=FILE_JSON)
+        self.get_metadata('/a.txt', result=NOT_FOUND_JSON, error=True)
+        client = ReplayClient(self.recorder.calls)
+
+        self.assertEqual(7, client.files_get_metadata('/a.txt').size)
+        for i in range(2):
+            with self.assertRaises(dropbox.exceptions.ApiError):
+                client.files_get_metadata('/a.txt')
+        with self.assertRaises(dropbox.exceptions.BadInputError):
+            client.files_get_metadata('/b.txt')
+
+    def test_exception(self):
+        """Test a call that raised when recorded raises again."""
+        self.get_metadata('/a.txt', exception='ConnectionError')
+        client = ReplayClient(self.recorder.calls)
+
+        with self.assertRaises(dropbox.exceptions.InternalServerError):
+            client.files_get_metadata('/a.txt')
+
+    def test_download_range(self):
+        """Test ranged downloads are replayed as zeros."""
+        link = redact(json.dumps({'link': 'https://link'}))
+        link = json.loads(link)['link']
+        self.call('download_range', {'link': link, 'start': 2, 'end': 4},
+                  download=3)
+        self.call('download_range', {'link': link, 'start': 5, 'end': 6},
+                  exception='RemoteConnectionError')
+        client = ReplayClient(self.recorder.calls)
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('abcdefg')
+            f.flush()
+            self.assertEqual(3, client.download_range(link, 2, 4, f.fileno()))
+            with self.assertRaises(RemoteConnectionError):
+                client.download_range('https://link', 5, 6, f.fileno())
+            self.assertEqual('ab\0\0\0fg', open(f.name, 'rb').read())
+
+    def test_synthetic_body(self):
+        """Test a replayed download reads as zeros of its size."""
+        response = SyntheticBody(5)
+
+        self.assertEqual('5', response.getheader('Content-Length'))
+        self.assertIsNone(response.getheader('ETag'))
+        self.assertEqual('\0' * 2, response.read(2))
+        self.assertEqual('\0' * 3, response.read())
+        self.assertEqual('', response.read(1))
+        response.close()
+        self.assertTrue(response.closed)
+
+
+class TestRequestScheduler(unittest.TestCase):
+    """Test RequestScheduler."""
+
+    def setUp(self):
+        self.scheduler = RequestScheduler(
+            concurrency=2, limits=((INTERACTIVE, 2), (BULK, 1)))
+        self.started = []
+
+    def start(self, name, priority):
+        """Starts a request in a thread, once it is waiting to run."""
+        queued = self.scheduler.metrics()[priority]['queued']
+
+        def request():
+            self.scheduler.acquire(priority)
+            self.started.append(name)
+
+        thread = threading.Thread(target=request)
+        thread.daemon = True
+        thread.start()
+        while self.scheduler.metrics()[priority]['queued'] == queued and \
+                name not in self.started:
+            time.sleep(0.001)
+        return thread
+
+    def test_priority(self):
+        """Test waiting interactive requests run before bulk ones."""
+        self.scheduler.acquire(BULK)
+        self.scheduler.acquire(INTERACTIVE)
+        bulk = self.start('bulk', BULK)
+        first = self.start('first', INTERACTIVE)
+        second = self.start('second', INTERACTIVE)
+
+        metrics = self.scheduler.metrics()
+        self.assertEqual(1, metrics[BULK]['queued'])
+        self.assertEqual(2, metrics[INTERACTIVE]['queued'])
+        self.assertEqual([], self.started)
+
+        self.scheduler.release(BULK)
+        first.join(5)
+        self.scheduler.release(INTERACTIVE)
+        second.join(5)
+
+        self.assertEqual(['first', 'second'], self.started)
+
+        self.scheduler.release(INTERACTIVE)
+        bulk.join(5)
+
+        self.assertEqual(['first', 'second', 'bulk'], self.started)
+
+    def test_limit(self):
+        """Test a class runs no more than its limit, leaving room for the
+        others."""
+        self.scheduler.acquire(BULK)
+        bulk = self.start('bulk', BULK)
+
+        with self.scheduler.slot(INTERACTIVE):
+            self.assertEqual(1, self.scheduler.metrics()[INTERACTIVE][
+                'running'])
+        self.assertEqual([], self.started)
+
+        self.scheduler.release(BULK)
+        bulk.join(5)
+
+        self.assertEqual(['bulk'], self.started)
+
+    def test_metrics(self):
+        """Test the requests made and their waits are counted."""
+        self.scheduler.acquire(BULK)
+        bulk = self.start('bulk', BULK)
+        time.sleep(0.01)
+        self.scheduler.release(BULK)
+        bulk.join(5)
+
+        metrics = self.scheduler.metrics()[BULK]
+        self.assertEqual(1, metrics['running'])
+        self.assertEqual(0, metrics['queued'])
+        self.assertEqual(2, metrics['requests'])
+        self.assertGreaterEqual(metrics['wait'], 0.01)
+        self.assertGreaterEqual(metrics['max_wait'], 0.01)
+        self.assertEqual(0, self.scheduler.metrics()[INTERACTIVE]['requests'])
+
+    @patch.object(dropbox.Dropbox, 'request_json_string_with_retry')
+    def test_client(self, mock_request):
+        """Test a client's requests run with the priority of their
+        thread."""
+        client = DropboxFS('123').client
+        priorities = []
+
+        def request(*args, **kwargs):
+            metrics = client.scheduler.metrics()
+            priorities.append([name for name in metrics
+                               if metrics[name]['running']])
+            return RouteResult(FILE_JSON)
+
+        mock_request.side_effect = request
+
+        client.files_get_metadata('/a.txt')
+        with client.priority(BULK):
+            client.files_get_metadata('/a.txt')
+            with client.priority(INTERACTIVE):
+                client.files_get_metadata('/a.txt')
+        client.files_get_metadata('/a.txt')
+
+        self.assertEqual([[INTERACTIVE], [BULK], [INTERACTIVE],
+                          [INTERACTIVE]], priorities)
+        self.assertEqual(0, client.scheduler.metrics()[BULK]['running'])
+        with self.assertRaises(ValueError):
+            with client.priority('urgent'):
+                pass
+
 
 class TestDropboxFS(unittest.TestCase):
     """Test DropboxFS interface."""
@@ -280,6 +1137,17 @@ class TestDropboxFS(unittest.TestCase):
     def setUp(self):
         self.fs = DropboxFS('123')
 
+    def cache_folder(self, path, *names):
+        """Caches a listed folder. Names ending in a slash are folders."""
+        self.fs.client.cache[path] = CacheItem(
+            FolderMetadata(name=basename(path) or u'/', path_display=path),
+            [name.rstrip('/') for name in names])
+        for name in names:
+            child = pathjoin(path, name.rstrip('/'))
+            cls = FolderMetadata if name.endswith('/') else FileMetadata
+            self.fs.client.cache[child] = CacheItem(
+                cls(name=name.rstrip('/'), path_display=child))
+
     def test_str(self):
         """Test __str__ method."""
         self.assertEqual('<DropboxFS: >', str(self.fs))
@@ -311,6 +1179,23 @@ class TestDropboxFS(unittest.TestCase):
 
         self.assertIsInstance(writer, SpooledWriter)
 
+    def test_open_write_settings(self):
+        """Test the settings files opened for writing use."""
+        fs = DropboxFS('123', max_buffer=10, spool_dir='/tmp', chunk_size=20)
+
+        writer = fs.open('/file.txt', 'wb')
+        self.assertEqual((10, '/tmp', 20), (
+            writer.max_buffer, writer.spool_dir, writer.chunk_size))
+
+        writer = fs.open('/file.txt', 'wb', max_buffer=0, spool_dir='/var',
+                         chunk_size=30)
+        self.assertEqual((0, '/var', 30), (
+            writer.max_buffer, writer.spool_dir, writer.chunk_size))
+
+        writer = fs.open('/file.txt', 'wb', size=100)
+        self.assertIsInstance(writer, SessionWriter)
+        self.assertEqual((100, 20), (writer.size, writer.chunk_size))
+
     @patch.object(DropboxFS, 'open')
     def test_getcontents(self, mock_open):
         """Test downloading a file."""
@@ -320,6 +1205,217 @@ class TestDropboxFS(unittest.TestCase):
 
         self.assertEqual('123', data)
 
+    @patch.object(dropbox.Dropbox, 'files_download')
+    def test_download_to(self, mock_download):
+        """Test streaming a file into file objects, sockets and fds."""
+        data = '0123456789' * 10
+        mock_download.side_effect = lambda path: (
+            {}, Mock(raw=FakeRaw(data)))
+
+        target = io.BytesIO()
+        self.assertEqual(
+            100, self.fs.download_to('/file.txt', target, chunk_size=16))
+        self.assertEqual(data, target.getvalue())
+
+        sender, receiver = socket.socketpair()
+        self.assertEqual(100, self.fs.download_to('/file.txt', sender))
+        self.assertEqual(data, receiver.recv(1024))
+        sender.close()
+        receiver.close()
+
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(
+                100, self.fs.download_to('/file.txt', f.fileno(), 7))
+            f.seek(0)
+            self.assertEqual(data, f.read())
+
+    def ranged_get(self, data, failures=None):
+        """Returns a fake session.get() serving byte ranges of data. The
+        ranges requested are kept in its calls, as Mock does not count
+        concurrent calls reliably."""
+        failures = failures or {}
+        lock = threading.Lock()
+
+        def get(link, headers, stream, timeout):
+            start, end = map(int, headers['Range'][6:].split('-'))
+            with lock:
+                get.calls.append((start, end))
+                failure = failures.get(start)
+                if failure:
+                    failures[start] = failure[1:]
+            if failure:
+                if failure[0] == 'error':
+                    raise requests.ConnectionError()
+                if failure[0] == 'short':
+                    end -= 1
+            response = Mock(spec=requests.Response)
+            response.status_code = 206
+            if failure and failure[0] == 'full':
+                response.status_code = 200
+            chunk = data[start:end + 1]
+            response.iter_content.return_value = [chunk[:3], chunk[3:]]
+            return response
+        get.calls = []
+        return get
+
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_download_parallel(self, mock_link):
+        """Test downloading a file in parallel segments."""
+        data = ''.join(chr(i % 256) for i in range(1000))
+        mock_link.return_value = GetTemporaryLinkResult(
+            metadata=FileMetadata(name=u'big.bin', size=len(data)),
+            link='https://content/big.bin')
+        self.fs.client._session = Mock()
+        get = self.ranged_get(
+            data, {0: ['error', 'short', 'full'], 900: ['short']})
+        self.fs.client._session.get.side_effect = get
+        local = tempfile.NamedTemporaryFile()
+
+        size = self.fs.download_parallel(
+            '/big.bin', local.name, segment_size=100, parallelism=3)
+
+        self.assertEqual(1000, size)
+        self.assertEqual(data, open(local.name, 'rb').read())
+        self.assertEqual(14, len(get.calls))
+        self.assertEqual(1000, self.fs.getinfo('/big.bin')['size'])
+
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_download_parallel_error(self, mock_link):
+        """Test downloading a file in parallel when a segment keeps failing."""
+        mock_link.return_value = GetTemporaryLinkResult(
+            metadata=FileMetadata(name=u'big.bin', size=300),
+            link='https://content/big.bin')
+        self.fs.client._session = Mock()
+        self.fs.client._session.get.side_effect = self.ranged_get(
+            'x' * 300, {100: ['error'] * 3})
+        local = tempfile.NamedTemporaryFile()
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.download_parallel(
+                '/big.bin', local.name, segment_size=100, retries=2)
+
+    @patch.object(DropboxClient, 'download_range')
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_download_parallel_size_mismatch(self, mock_link, mock_range):
+        """Test downloading a file in parallel that comes back short."""
+        mock_link.return_value = GetTemporaryLinkResult(
+            metadata=FileMetadata(name=u'big.bin', size=300),
+            link='https://content/big.bin')
+        mock_range.return_value = 99
+        local = tempfile.NamedTemporaryFile()
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.download_parallel('/big.bin', local.name, 100)
+
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_download_parallel_link_error(self, mock_link):
+        """Test downloading a file in parallel when it can not be linked."""
+        lookup_error = LookupError(tag='not_found')
+        mock_link.side_effect = [
+            dropbox.exceptions.ApiError(
+                '1', GetTemporaryLinkError('path', lookup_error), 'message',
+                ''),
+            dropbox.exceptions.ApiError(
+                '1', GetTemporaryLinkError('other'), 'message', ''),
+        ]
+
+        with self.assertRaises(ResourceNotFoundError) as e:
+            self.fs.download_parallel('/big.bin', '/tmp/big.bin')
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.download_parallel('/big.bin', '/tmp/big.bin')
+
+    @patch('dropboxfs.MATERIALIZE_BLOCK_SIZE', 100)
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_open_materialize(self, mock_link):
+        """Test opening a file into a shared local mapped copy."""
+        data = ''.join(chr(i % 256) for i in range(1000))
+        mock_link.return_value = GetTemporaryLinkResult(
+            metadata=FileMetadata(name=u'db.sqlite', size=len(data),
+                                  rev=u'000000001'),
+            link='https://content/db.sqlite')
+        self.fs.client._session = Mock()
+        self.fs.client._session.get.side_effect = self.ranged_get(data)
+        ranges = lambda: [
+            c[1]['headers']['Range']
+            for c in self.fs.client._session.get.call_args_list]
+
+        reader1 = self.fs.open('db.sqlite', 'rb', materialize=True)
+        reader2 = self.fs.open('/DB.sqlite', 'rb', materialize=True)
+
+        self.assertIsInstance(reader1, MappedReader)
+        self.assertIs(reader1.shared, reader2.shared)
+        self.assertEqual(1, mock_link.call_count)
+        self.assertEqual(1000, len(reader1))
+
+        reader1.seek(250)
+        self.assertEqual(data[250:260], reader1.read(10))
+        self.assertEqual(['bytes=200-299'], ranges())
+        reader2.seek(-50, 2)
+        self.assertEqual(data[950:], reader2.read())
+        reader2.seek(-20, 1)
+        self.assertEqual(980, reader2.tell())
+        buf = bytearray(40)
+        self.assertEqual(20, reader2.readinto(buf))
+        self.assertEqual('', reader2.read(5))
+        reader1.seek(100)
+        self.assertEqual(data[100:350], reader1.read(250))
+        self.assertEqual(
+            ['bytes=200-299', 'bytes=900-999', 'bytes=100-199',
+             'bytes=300-399'], ranges())
+        reader1.seek(0)
+        self.assertEqual(data, reader1.read())
+        self.assertEqual(6, len(ranges()))
+
+        reader1.close()
+        reader1.close()
+        self.assertIn('/db.sqlite', self.fs.materialized)
+        with reader2:
+            pass
+        self.assertEqual({}, self.fs.materialized)
+
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_open_materialize_changed(self, mock_link):
+        """Test a changed file is materialized again."""
+        file1 = FileMetadata(name=u'f', size=0, rev=u'000000001')
+        file2 = FileMetadata(name=u'f', size=0, rev=u'000000002')
+        mock_link.side_effect = [
+            GetTemporaryLinkResult(metadata=file1, link='1'),
+            GetTemporaryLinkResult(metadata=file2, link='2'),
+        ]
+
+        reader1 = self.fs.open('/f', materialize=True)
+        self.fs.client.cache.set('/f', file2)
+        reader2 = self.fs.open('/f', materialize=True)
+
+        self.assertIsNot(reader1.shared, reader2.shared)
+        self.assertEqual('', reader1.read())
+        reader1.close()
+        self.assertIs(reader2.shared, self.fs.materialized['/f'])
+        reader2.close()
+        self.assertEqual({}, self.fs.materialized)
+
+    @patch.object(dropbox.Dropbox, 'files_get_temporary_link')
+    def test_open_materialize_closing(self, mock_link):
+        """Test a copy closed by its last reader meanwhile is not reused."""
+        file1 = FileMetadata(name=u'f', size=0, rev=u'000000001')
+        mock_link.side_effect = [
+            GetTemporaryLinkResult(metadata=file1, link='1'),
+            GetTemporaryLinkResult(metadata=file1, link='2'),
+        ]
+        reader1 = self.fs.open('/f', materialize=True)
+
+        def stat(path):
+            reader1.close()
+            return file1
+        with patch.object(self.fs.client, 'stat', side_effect=stat):
+            reader2 = self.fs.open('/f', materialize=True)
+
+        self.assertIsNot(reader1.shared, reader2.shared)
+        self.assertEqual('2', reader2.shared.link)
+        self.assertEqual(1, reader2.shared.refs)
+        self.assertIs(reader2.shared, self.fs.materialized['/f'])
+        reader2.close()
+
     @patch.object(dropbox.Dropbox, 'files_upload')
     def test_setcontents(self, mock_upload):
         """Test uploading a file."""
@@ -330,6 +1426,32 @@ class TestDropboxFS(unittest.TestCase):
         except Exception, e:
             self.fail(e)
 
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_upload')
+    def test_setcontents_cache(self, mock_upload, mock_list, mock_metadata):
+        """Test uploads update the cache instead of dropping the folder."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'files', path_display=u'/files')
+        mock_list.return_value = ListFolderResult(has_more=False, entries=[
+            FileMetadata(name=u'a.txt', path_display=u'/files/a.txt')])
+        mock_upload.side_effect = lambda f, path, mode: FileMetadata(
+            name=basename(path), path_display=path, size=len(f))
+        self.fs.listdir('/files')
+
+        for i in range(3):
+            self.fs.setcontents('/files/file%d.txt' % i, '123')
+        with self.fs.open('/files/a.txt', 'wb') as f:
+            f.write('12345')
+
+        self.assertEqual(
+            ['a.txt', 'file0.txt', 'file1.txt', 'file2.txt'],
+            self.fs.listdir('/files'))
+        self.assertEqual(3, self.fs.getinfo('/files/file2.txt')['size'])
+        self.assertEqual(5, self.fs.getinfo('/files/a.txt')['size'])
+        self.assertEqual(1, mock_list.call_count)
+        self.assertEqual(1, mock_metadata.call_count)
+
     @patch.object(dropbox.Dropbox, 'files_upload')
     def test_setcontents_error(self, mock_upload):
         """Test uploading a file with an error."""
@@ -340,6 +1462,170 @@ class TestDropboxFS(unittest.TestCase):
         with self.assertRaises(RemoteConnectionError) as e:
             self.fs.setcontents('/file.txt', '123')
 
+    @patch.object(dropbox.Dropbox, 'files_upload')
+    def test_setcontents_rev(self, mock_upload):
+        """Test only updating a file that is still at a given rev."""
+        write_error = WriteError(tag='conflict',
+                                 value=WriteConflictError(tag='file'))
+        upload_error = UploadError('path', UploadWriteFailed(
+            reason=write_error, upload_session_id='abc'))
+        mock_upload.side_effect = dropbox.exceptions.ApiError(
+            '1', upload_error, 'message', '')
+
+        with self.assertRaises(RevisionConflictError):
+            self.fs.setcontents('/file.txt', '123', rev='a1b2c3d4e5')
+        mode = mock_upload.call_args[0][2]
+        self.assertEqual('a1b2c3d4e5', mode.get_update())
+
+        # Without a rev the same error is not a conflict of revisions.
+        with self.assertRaises(RemoteConnectionError):
+            self.fs.setcontents('/file.txt', '123')
+        self.assertTrue(mock_upload.call_args[0][2].is_overwrite())
+
+    @patch.object(dropbox.Dropbox, 'files_upload_session_finish')
+    @patch.object(dropbox.Dropbox, 'files_upload_session_start')
+    @patch.object(dropbox.Dropbox, 'files_upload')
+    def test_setcontents_conditional(self, mock_upload, mock_start,
+                                     mock_finish):
+        """Test conditional writes use the cached rev of a file."""
+        self.fs.conditional_writes = True
+        self.fs.chunk_size = 2
+        mock_start.return_value = UploadSessionStartResult(session_id='abc')
+        self.fs.client.cache.set('/file.txt', FileMetadata(
+            name=u'file.txt', rev='a1b2c3d4e5', size=3))
+        mock_upload.side_effect = lambda f, path, mode: FileMetadata(
+            name=basename(path), rev='f6f7f8f9f0', size=len(f))
+        mock_finish.return_value = FileMetadata(name=u'file.txt',
+                                                rev='0a0b0c0d0e', size=4)
+
+        self.fs.setcontents('/file.txt', '123')
+        self.fs.setcontents('/file.txt', StringIO('1234'))
+        self.fs.setcontents('/new.txt', '123')
+
+        self.assertEqual('a1b2c3d4e5',
+                         mock_upload.call_args_list[0][0][2].get_update())
+        commit = mock_finish.call_args[0][2]
+        self.assertEqual('f6f7f8f9f0', commit.mode.get_update())
+        self.assertTrue(mock_upload.call_args_list[1][0][2].is_overwrite())
+
+    def test_open_rev(self):
+        """Test files opened for writing with a rev update that rev."""
+        self.fs.client.cache.set('/file.txt', FileMetadata(
+            name=u'file.txt', rev='a1b2c3d4e5', size=3))
+
+        writer = self.fs.open('/file.txt', 'wb', rev='f6f7f8f9f0')
+        self.assertEqual('f6f7f8f9f0', writer.mode.get_update())
+        writer = self.fs.open('/file.txt', 'wb', size=3)
+        self.assertTrue(writer.session.mode.is_overwrite())
+        self.fs.conditional_writes = True
+        writer = self.fs.open('/file.txt', 'wb', size=3)
+        self.assertEqual('a1b2c3d4e5', writer.session.mode.get_update())
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder_continue')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_listdir_pages(self, mock_metadata, mock_list, mock_continue):
+        """Test listing a folder follows every page of the listing."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'd', path_display=u'/d')
+        mock_list.return_value = ListFolderResult(entries=[
+            FileMetadata(name=u'a.txt', path_display=u'/d/a.txt')],
+            cursor='c1', has_more=True)
+        mock_continue.side_effect = [
+            ListFolderResult(entries=[FileMetadata(
+                name=u'b.txt', path_display=u'/d/b.txt')],
+                cursor='c2', has_more=False),
+            dropbox.exceptions.ApiError('1', None, 'message', ''),
+        ]
+
+        self.assertEqual([u'a.txt', u'b.txt'], self.fs.listdir('/d'))
+        self.assertTrue(self.fs.exists('/d/b.txt'))
+        self.assertFalse(self.fs.exists('/d/c.txt'))
+        mock_continue.assert_called_once_with('c1')
+
+        self.fs.client.cache.clear()
+        with self.assertRaises(RemoteConnectionError):
+            self.fs.listdir('/d')
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_prefetch(self, mock_metadata, mock_list):
+        """Test prefetching folders down to a depth."""
+        folders = {
+            '/a': [FolderMetadata(name=u'b', path_display=u'/a/b'),
+                   FileMetadata(name=u'f.txt', path_display=u'/a/f.txt')],
+            '/a/b': [FolderMetadata(name=u'c', path_display=u'/a/b/c')],
+        }
+
+        def get_metadata(path, include_deleted):
+            if path not in folders:
+                raise dropbox.exceptions.ApiError(
+                    '1', GetMetadataError('path', LookupError('not_found')),
+                    'message', '')
+            return FolderMetadata(name=basename(path), path_display=path)
+        mock_metadata.side_effect = get_metadata
+        mock_list.side_effect = lambda path, include_deleted: \
+            ListFolderResult(has_more=False, entries=folders[path])
+        progress = []
+
+        prefetcher = self.fs.prefetch(
+            ['/a', '/missing'], depth=2, background=False,
+            callback=lambda status, count: progress.append((status, count)))
+
+        self.assertTrue(prefetcher.wait(0))
+        self.assertEqual(1, len(prefetcher.errors))
+        self.assertEqual(['/a', '/a/b'],
+                         sorted(c[0][0] for c in mock_list.call_args_list))
+        self.assertEqual(('complete', 3), progress[-1])
+        self.assertIn(('listing', 2), progress)
+        self.assertEqual([u'c'], self.fs.listdir('/a/b'))
+        self.assertTrue(self.fs.isfile('/a/f.txt'))
+        self.assertEqual(2, mock_list.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_prefetch_recursive(self, mock_metadata, mock_list):
+        """Test prefetching whole trees in the background."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'a', path_display=u'/a', path_lower=u'/a')
+        mock_list.return_value = ListFolderResult(entries=[
+            FolderMetadata(name=u'b', path_display=u'/a/b',
+                           path_lower=u'/a/b'),
+            FileMetadata(name=u'f.txt', path_display=u'/a/b/f.txt',
+                         path_lower=u'/a/b/f.txt')], has_more=False)
+
+        prefetcher = self.fs.prefetch('/a', depth=None)
+
+        self.assertTrue(prefetcher.wait(5))
+        self.assertEqual(2, prefetcher.count)
+        self.assertTrue(mock_list.call_args[1]['recursive'])
+        self.assertEqual([u'f.txt'], self.fs.listdir('/a/b'))
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_cache_tree_casing(self, mock_list):
+        """Test caching a tree whose casing differs from the caller's."""
+        mock_list.return_value = ListFolderResult(entries=[
+            FolderMetadata(name=u'Sub', path_display=u'/a/Sub',
+                           path_lower=u'/a/sub'),
+            FileMetadata(name=u'F.txt', path_display=u'/A/sub/F.txt',
+                         path_lower=u'/a/sub/f.txt')], has_more=False)
+        folder = FolderMetadata(name=u'A', path_display=u'/A',
+                                path_lower=u'/a')
+
+        self.assertEqual(2, self.fs.client.cache_tree('/A', folder))
+
+        self.assertEqual([u'Sub'], self.fs.listdir('/a'))
+        self.assertEqual([u'F.txt'], self.fs.listdir('/A/SUB'))
+
+    def test_prefetch_nothing(self):
+        """Test prefetching no paths finishes at once."""
+        callback = Mock()
+
+        prefetcher = self.fs.prefetch([], callback=callback)
+
+        self.assertTrue(prefetcher.wait(0))
+        callback.assert_called_once_with('complete', 0)
+
     def test_desc(self):
         """Test description."""
         self.assertEqual('/files in Dropbox', self.fs.desc('/files'))
@@ -352,78 +1638,143 @@ class TestDropboxFS(unittest.TestCase):
         """Test get syspath allow none."""
         self.assertIsNone(self.fs.getsyspath('files', True))
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isdir(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isdir(self, mock_stat):
         """Test if a directory."""
-        mock_getinfo.return_value = {'isdir': True}
+        mock_stat.return_value = FolderMetadata()
 
         isdir = self.fs.isdir('/files')
 
         self.assertTrue(isdir)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isdir_false(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isdir_false(self, mock_stat):
         """Test if not a directory."""
-        mock_getinfo.return_value = {'isdir': False}
+        mock_stat.return_value = FileMetadata()
 
         isdir = self.fs.isdir('/file.txt')
 
         self.assertFalse(isdir)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isdir_does_not_exist(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isdir_does_not_exist(self, mock_stat):
         """Test if not a directory when it does not exist."""
-        mock_getinfo.side_effect = ResourceNotFoundError()
+        mock_stat.side_effect = ResourceNotFoundError()
 
         isdir = self.fs.isdir('/files')
 
         self.assertFalse(isdir)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isfile(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isfile(self, mock_stat):
         """Test if a file."""
-        mock_getinfo.return_value = {'isdir': False}
+        mock_stat.return_value = FileMetadata()
 
         isfile = self.fs.isfile('/file.txt')
 
         self.assertTrue(isfile)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isfile_false(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isfile_false(self, mock_stat):
         """Test if not a file."""
-        mock_getinfo.return_value = {'isdir': True}
+        mock_stat.return_value = FolderMetadata()
 
         isfile = self.fs.isfile('/files')
 
         self.assertFalse(isfile)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_isfile_does_not_exist(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_isfile_does_not_exist(self, mock_stat):
         """Test if not a file when it does not exist."""
-        mock_getinfo.side_effect = ResourceNotFoundError()
+        mock_stat.side_effect = ResourceNotFoundError()
 
         isfile = self.fs.isfile('/file.txt')
 
         self.assertFalse(isfile)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_exists(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_exists(self, mock_stat):
         """Test file exists."""
-        mock_getinfo.return_value = {}
+        mock_stat.return_value = FileMetadata()
 
         exists = self.fs.exists('/file.txt')
 
         self.assertTrue(exists)
 
-    @patch.object(DropboxFS, 'getinfo')
-    def test_exists_false(self, mock_getinfo):
+    @patch.object(DropboxClient, 'stat')
+    def test_exists_false(self, mock_stat):
         """Test file does not exist."""
-        mock_getinfo.side_effect = ResourceNotFoundError()
+        mock_stat.side_effect = ResourceNotFoundError()
 
         exists = self.fs.exists('/file.txt')
 
         self.assertFalse(exists)
 
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_exists_listed_folder(self, mock_list, mock_metadata):
+        """Test existence checks are answered from a listed folder."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'files', path_display=u'/files')
+        mock_list.return_value = ListFolderResult(has_more=False, entries=[
+            FileMetadata(name=u'a.txt', path_display=u'/files/a.txt'),
+            FolderMetadata(name=u'more', path_display=u'/files/more')])
+        self.fs.listdir('/files')
+
+        self.assertTrue(self.fs.exists('/files/A.txt'))
+        self.assertTrue(self.fs.isfile('/files/a.txt'))
+        self.assertTrue(self.fs.isdir('/files/more'))
+        self.assertFalse(self.fs.exists('/files/b.txt'))
+        self.assertTrue(self.fs.isdir('/files'))
+
+        self.assertEqual(1, mock_metadata.call_count)
+        self.assertEqual(1, mock_list.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_exists_many(self, mock_list, mock_metadata):
+        """Test checking many paths with one listing per folder."""
+        lookup_error = LookupError(tag='not_found')
+        metadata_error = GetMetadataError(tag='path', value=lookup_error)
+        not_found = dropbox.exceptions.ApiError(
+            '1', metadata_error, 'message', '')
+        responses = {
+            '/files': FolderMetadata(name=u'files', path_display=u'/files'),
+            '/other': not_found,
+            '/other/a.txt': FileMetadata(name=u'a.txt'),
+            '/other/b.txt': not_found,
+            '/other/c.txt': FileMetadata(name=u'c.txt'),
+        }
+
+        def get_metadata(path, include_deleted):
+            if isinstance(responses[path], Exception):
+                raise responses[path]
+            return responses[path]
+        mock_metadata.side_effect = get_metadata
+        mock_list.return_value = ListFolderResult(has_more=False, entries=[
+            FileMetadata(name=u'a.txt', path_display=u'/files/a.txt'),
+            FileMetadata(name=u'b.txt', path_display=u'/files/b.txt')])
+
+        exists = self.fs.exists_many([
+            '/files/a.txt', 'files/b.txt', '/files/c.txt', '/other/c.txt'])
+
+        self.assertEqual({
+            '/files/a.txt': True,
+            'files/b.txt': True,
+            '/files/c.txt': False,
+            '/other/c.txt': True,
+        }, exists)
+        self.assertEqual(1, mock_list.call_count)
+        self.assertEqual(2, mock_metadata.call_count)
+
+        # A folder that can not be listed falls back to single lookups.
+        exists = self.fs.exists_many(['/other/a.txt', '/other/b.txt'])
+
+        self.assertEqual(
+            {'/other/a.txt': True, '/other/b.txt': False}, exists)
+        self.assertEqual(1, mock_list.call_count)
+        self.assertEqual(6, mock_metadata.call_count)
+
     @patch.object(CacheItem, 'expired', new_callable=PropertyMock)
     @patch.object(dropbox.Dropbox, 'files_get_metadata')
     @patch.object(dropbox.Dropbox, 'files_list_folder')
@@ -443,10 +1794,10 @@ class TestDropboxFS(unittest.TestCase):
         ]
         mock_metadata.return_value = Mock(FolderMetadata)
         mock_list.side_effect = [
-            ListFolderResult(entries=entries),
-            ListFolderResult(entries=[]),
-            ListFolderResult(entries=[Mock(FolderMetadata)]),
-            ListFolderResult(entries=[Mock(FolderMetadata)]),
+            ListFolderResult(has_more=False, entries=entries),
+            ListFolderResult(has_more=False, entries=[]),
+            ListFolderResult(has_more=False, entries=[Mock(FolderMetadata)]),
+            ListFolderResult(has_more=False, entries=[Mock(FolderMetadata)]),
         ]
         mock_expired.side_effect = [False, False, True]
 
@@ -482,6 +1833,144 @@ class TestDropboxFS(unittest.TestCase):
         self.assertEqual(4, mock_list.call_count)
         self.assertEqual(1, len(children))
 
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_listdir_mixed_case(self, mock_list, mock_metadata):
+        """Test paths differing only in case share cache entries."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'Files', path_display=u'/Files')
+        mock_list.return_value = ListFolderResult(has_more=False, entries=[
+            FileMetadata(name=u'Big.pdf', path_display=u'/Files/Big.pdf',
+                         size=10)])
+
+        self.assertEqual(['Big.pdf'], self.fs.listdir('/files'))
+        self.assertEqual(['Big.pdf'], self.fs.listdir('/FILES'))
+        self.assertEqual(10, self.fs.getinfo('/fIlEs/big.PDF')['size'])
+        self.assertEqual('Big.pdf', self.fs.getinfo('/files/big.pdf')['path'])
+
+        self.assertEqual(1, mock_metadata.call_count)
+        self.assertEqual(1, mock_list.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_listdirinfo(self, mock_list, mock_metadata):
+        """Test listing a directory with info from a single listing."""
+        mock_metadata.return_value = FolderMetadata(
+            name=u'files', path_display=u'/files')
+        mock_list.return_value = ListFolderResult(has_more=False, entries=[
+            FileMetadata(name=u'a.txt', path_display=u'/files/a.txt',
+                         size=1),
+            FileMetadata(name=u'b.pdf', path_display=u'/files/b.pdf',
+                         size=2),
+            FolderMetadata(name=u'more', path_display=u'/files/more')])
+
+        listing = self.fs.listdirinfo('/files')
+
+        self.assertEqual(['a.txt', 'b.pdf', 'more'], [n for n, i in listing])
+        self.assertEqual([1, 2, 0], [i['size'] for n, i in listing])
+        self.assertEqual(
+            [('/files/a.txt', 1)],
+            [(n, i['size']) for n, i in self.fs.listdirinfo(
+                'files', wildcard='*.txt', full=True)])
+        self.assertEqual(
+            ['b.pdf'],
+            [n for n, i in self.fs.ilistdirinfo(
+                '/files', wildcard=lambda n: n.startswith('b'))])
+        self.assertEqual(
+            ['more'],
+            [n for n, i in self.fs.listdirinfo('/files', dirs_only=True)])
+        self.assertEqual(
+            ['/files/a.txt', '/files/b.pdf'],
+            [n for n, i in self.fs.listdirinfo(
+                '/files', files_only=True, absolute=True)])
+        self.assertEqual(1, mock_list.call_count)
+        self.assertEqual(1, mock_metadata.call_count)
+
+        with self.assertRaises(ValueError) as e:
+            self.fs.listdirinfo('/files', dirs_only=True, files_only=True)
+
+        # Entries that vanished from the cache are skipped.
+        self.fs.client.cache['/files'].add_child(u'gone.txt')
+        mock_metadata.side_effect = ResourceNotFoundError('/files/gone.txt')
+
+        self.assertEqual(3, len(self.fs.listdirinfo('/files')))
+
+    def test_search_query(self):
+        """Test turning glob patterns into search queries."""
+        self.assertEqual('report', search_query('report*.pdf'))
+        self.assertEqual('report', search_query('report-?.pdf'))
+        self.assertEqual('a.txt', search_query('a.txt'))
+        self.assertIsNone(search_query('*.pdf'))
+        self.assertIsNone(search_query('[ab]*'))
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_search')
+    def test_find(self, mock_search, mock_metadata):
+        """Test finding files with the search API."""
+        def match(name, path):
+            return SearchMatch(
+                match_type=SearchMatchType.filename, metadata=FileMetadata(
+                    name=name, path_display=path, path_lower=path.lower(),
+                    size=1))
+        mock_search.side_effect = [
+            SearchResult(matches=[
+                match(u'Report1.pdf', u'/files/Report1.pdf'),
+                match(u'report1.doc', u'/files/report1.doc'),
+            ], more=True, start=2),
+            SearchResult(matches=[
+                match(u'report2.pdf', u'/files/more/report2.pdf'),
+            ], more=False, start=3),
+        ]
+
+        found = list(self.fs.find('report*.pdf', '/files'))
+
+        self.assertEqual(
+            ['/files/Report1.pdf', '/files/more/report2.pdf'], found)
+        self.assertEqual(
+            (('/files', 'report'), {
+                'start': 2, 'max_results': 1000, 'mode': SearchMode.filename}),
+            mock_search.call_args)
+        # Matches are cached.
+        self.assertEqual(1, self.fs.getinfo('/files/report1.doc')['size'])
+        self.assertEqual(0, mock_metadata.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_search')
+    def test_find_error(self, mock_search):
+        """Test finding files when search fails."""
+        lookup_error = LookupError(tag='not_found')
+        mock_search.side_effect = [
+            dropbox.exceptions.ApiError(
+                '1', SearchError('path', lookup_error), 'message', ''),
+            dropbox.exceptions.ApiError(
+                '1', SearchError('other'), 'message', ''),
+        ]
+
+        with self.assertRaises(ResourceNotFoundError) as e:
+            list(self.fs.find('a*', '/', filename_only=False))
+        with self.assertRaises(RemoteConnectionError) as e:
+            list(self.fs.find('a*', '/'))
+
+        self.assertEqual('', mock_search.call_args[0][0])
+
+    @patch.object(dropbox.Dropbox, 'files_search')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_find_listing(self, mock_list, mock_search):
+        """Test finding files by listing when search can not be used."""
+        mock_list.return_value = ListFolderResult(entries=[
+            FolderMetadata(name=u'files', path_display=u'/files',
+                           path_lower=u'/files'),
+            FileMetadata(name=u'a.pdf', path_display=u'/files/a.pdf',
+                         path_lower=u'/files/a.pdf'),
+            FileMetadata(name=u'b.txt', path_display=u'/files/b.txt',
+                         path_lower=u'/files/b.txt'),
+            Mock(spec=DeletedMetadata),
+        ], has_more=False)
+
+        found = list(self.fs.find('*.PDF', '/files'))
+
+        self.assertEqual(['/files/a.pdf'], found)
+        self.assertEqual(0, mock_search.call_count)
+
     @patch.object(dropbox.Dropbox, 'files_get_metadata')
     @patch.object(dropbox.Dropbox, 'files_list_folder')
     def test_listdir_root(self, mock_list, mock_metadata):
@@ -493,7 +1982,7 @@ class TestDropboxFS(unittest.TestCase):
         mock_list.side_effect = [
             dropbox.exceptions.BadInputError(
                 1, 'Specify the root folder as an empty string'),
-            ListFolderResult(entries=entries)
+            ListFolderResult(has_more=False, entries=entries)
         ]
         mock_metadata.side_effect = dropbox.exceptions.BadInputError(
             1, 'The root folder is unsupported')
@@ -634,6 +2123,107 @@ class TestDropboxFS(unittest.TestCase):
         self.assertEqual(957694, info['size'])
         self.assertEqual('big-file.pdf', info['path'])
 
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_info_prefetch(self, mock_list, mock_metadata):
+        """Test repeated misses in a folder list the folder instead."""
+        files = [
+            FileMetadata(name=u'file%d.txt' % i,
+                         path_display=u'/files/file%d.txt' % i, size=i)
+            for i in range(10)
+        ]
+        folder = FolderMetadata(name=u'files', path_display=u'/files')
+        mock_metadata.side_effect = files[:2] + [folder]
+        mock_list.return_value = ListFolderResult(
+            has_more=False, entries=files)
+
+        for i in range(10):
+            self.assertEqual(
+                i, self.fs.getinfo('/files/file%d.txt' % i)['size'])
+
+        self.assertEqual(3, mock_metadata.call_count)
+        self.assertEqual(1, mock_list.call_count)
+
+    @patch('dropboxfs.time.time')
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_info_prefetch_window(self, mock_metadata, mock_time):
+        """Test misses spread out in time do not list the folder."""
+        mock_metadata.return_value = FileMetadata(name=u'file.txt')
+        mock_time.side_effect = [
+            PREFETCH_WINDOW * i for i in range(1, 20) for j in range(2)]
+
+        for i in range(5):
+            self.fs.getinfo('/files/file%d.txt' % i)
+
+        self.assertEqual(5, mock_metadata.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_info_prefetch_error(self, mock_metadata):
+        """Test failing to list the folder falls back to the single path."""
+        mock_metadata.return_value = FileMetadata(name=u'file.txt')
+        self.fs.client.misses['/files'] = (2, time.time())
+        self.fs.client.prefetch_misses = 3
+
+        self.fs.getinfo('/files/file.txt')
+
+        self.assertEqual(2, mock_metadata.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_info_prefetch_forget(self, mock_metadata):
+        """Test old misses are forgotten once too many are tracked."""
+        mock_metadata.return_value = FileMetadata(name=u'file.txt')
+        self.fs.client.misses = dict(
+            ('/folder%d' % i, (1, time.time())) for i in range(1001))
+
+        self.fs.getinfo('/files/file.txt')
+
+        self.assertEqual(['/files'], self.fs.client.misses.keys())
+
+    def test_info_timezones(self):
+        """Test the timezone modification times are reported in."""
+        metadata = FileMetadata(
+            name=u'file.txt',
+            server_modified=datetime.datetime(2017, 6, 19, 16, 24, 12))
+        utc = datetime.datetime(2017, 6, 19, 16, 24, 12, tzinfo=pytz.utc)
+
+        info = metadata_to_info(metadata)
+        self.assertEqual(utc, info['modified_time'])
+        self.assertEqual(INFO_TIMEZONE, info['modified_time'].tzinfo.zone)
+
+        info = metadata_to_info(metadata, timezone=pytz.timezone('UTC'))
+        self.assertEqual('UTC', info['modified_time'].tzinfo.zone)
+
+        info = metadata_to_info(metadata, timezone=None)
+        self.assertEqual(metadata.server_modified, info['modified_time'])
+
+        info = metadata_to_info(metadata, localtime=True)
+        self.assertIsNone(info['modified_time'].tzinfo)
+        self.assertEqual(
+            calendar.timegm(utc.utctimetuple()),
+            time.mktime(info['modified_time'].timetuple()))
+
+    @patch('pytz.timezone')
+    def test_timezone_lookup(self, mock_timezone):
+        """Test timezones are looked up once, when first used."""
+        mock_timezone.return_value = pytz.utc
+        fs = DropboxFS('123', timezone='Test/Zone')
+
+        self.assertEqual('Test/Zone', fs.timezone)
+        self.assertFalse(mock_timezone.called)
+        self.assertIs(pytz.utc, get_timezone('Test/Zone'))
+        self.assertIs(pytz.utc, get_timezone('Test/Zone'))
+        mock_timezone.assert_called_once_with('Test/Zone')
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    def test_info_raw_utc(self, mock_metadata):
+        """Test a fs that reports naive UTC times."""
+        modified = datetime.datetime(2017, 6, 19, 16, 24, 12)
+        mock_metadata.return_value = FileMetadata(
+            name=u'file.txt', server_modified=modified)
+        fs = DropboxFS('123', timezone=None)
+
+        self.assertEqual(modified, fs.getinfo('/file.txt')['modified_time'])
+
     @patch.object(dropbox.Dropbox, 'files_get_metadata')
     def test_info_file_deleted(self, mock_metadata):
         """Test getting info for a file when it was deleted."""
@@ -778,15 +2368,327 @@ class TestDropboxFS(unittest.TestCase):
         with self.assertRaises(RemoteConnectionError) as e:
             self.fs.copy('/file1.txt', '/file2.txt')
 
+    @patch.object(dropbox.Dropbox, 'files_delete')
     @patch.object(dropbox.Dropbox, 'files_copy')
-    def test_copydir(self, mock_copy):
-        """Test copying a directory."""
-        mock_copy.return_value = {}
+    def test_copy_overwrite(self, mock_copy, mock_delete):
+        """Test copying a file over an existing one."""
+        self.cache_folder('/', 'file1.txt', 'file2.txt', 'folder/')
 
-        try:
+        self.fs.copy('/file1.txt', '/file2.txt', overwrite=True)
+        self.fs.copy('/file1.txt', '/file3.txt', overwrite=True)
+
+        mock_delete.assert_called_once_with('/file2.txt')
+        self.assertEqual(2, mock_copy.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(dropbox.Dropbox, 'files_copy')
+    def test_copy_overwrite_invalid(self, mock_copy, mock_delete):
+        """Test overwriting leaves dst alone if src or dst is not a file."""
+        self.cache_folder('/', 'file1.txt', 'file2.txt', 'folder/')
+
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.copy('/missing.txt', '/file2.txt', overwrite=True)
+        with self.assertRaises(ResourceInvalidError):
+            self.fs.copy('/folder', '/file2.txt', overwrite=True)
+        with self.assertRaises(ResourceInvalidError):
+            self.fs.copy('/file1.txt', '/folder', overwrite=True)
+
+        self.assertFalse(mock_delete.called)
+        self.assertFalse(mock_copy.called)
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(dropbox.Dropbox, 'files_copy_reference_save')
+    @patch.object(dropbox.Dropbox, 'files_copy_reference_get')
+    def test_copy_from(self, mock_get, mock_save, mock_delete):
+        """Test copying a file from another account by reference."""
+        other = DropboxFS('456')
+        file1 = FileMetadata(
+            name=u'file2.txt', path_lower=u'/file2.txt',
+            path_display=u'/file2.txt', size=3)
+        mock_get.return_value = GetCopyReferenceResult(
+            metadata=file1, copy_reference='ref')
+        mock_save.return_value = SaveCopyReferenceResult(metadata=file1)
+        self.cache_folder('/', 'file2.txt')
+
+        self.fs.copy_from(other, '/file1.txt', '/file2.txt', overwrite=True)
+
+        mock_get.assert_called_once_with('/file1.txt')
+        mock_save.assert_called_once_with('ref', '/file2.txt')
+        self.assertEqual(1, mock_delete.call_count)
+        self.assertEqual(3, self.fs.getinfo('/file2.txt')['size'])
+
+    @patch.object(dropbox.Dropbox, 'files_upload')
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    def test_copy_from_other_fs(self, mock_delete, mock_upload):
+        """Test copying a file from a non Dropbox fs."""
+        other = MemoryFS()
+        other.setcontents('/file1.txt', '123')
+        self.cache_folder('/', 'file2.txt')
+
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.copy_from(other, '/missing.txt', '/file2.txt',
+                              overwrite=True)
+        self.assertFalse(mock_delete.called)
+
+        self.fs.copy_from(other, '/file1.txt', '/file2.txt', overwrite=True)
+
+        self.assertEqual('123', mock_upload.call_args[0][0])
+        mock_delete.assert_called_once_with('/file2.txt')
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(dropbox.Dropbox, 'files_copy_reference_get')
+    def test_copy_from_does_not_exist(self, mock_get, mock_delete):
+        """Test copying a file from another account when it does not exist."""
+        lookup_error = LookupError(tag='not_found')
+        mock_get.side_effect = [
+            dropbox.exceptions.ApiError(
+                '1', GetCopyReferenceError('path', lookup_error), 'message',
+                ''),
+            dropbox.exceptions.ApiError(
+                '1', GetCopyReferenceError('other'), 'message', ''),
+        ]
+
+        with self.assertRaises(ResourceNotFoundError) as e:
+            self.fs.copy_from(DropboxFS('456'), '/file1.txt', '/file2.txt',
+                              overwrite=True)
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.copy_from(DropboxFS('456'), '/file1.txt', '/file2.txt')
+        self.assertFalse(mock_delete.called)
+
+    @patch.object(dropbox.Dropbox, 'files_copy_reference_save')
+    @patch.object(dropbox.Dropbox, 'files_copy_reference_get')
+    def test_copy_from_exists(self, mock_get, mock_save):
+        """Test copying a file from another account when dst exists."""
+        write_conflict_error = WriteConflictError(tag='file')
+        write_error = WriteError(tag='conflict', value=write_conflict_error)
+        mock_get.return_value = GetCopyReferenceResult(copy_reference='ref')
+        mock_save.side_effect = [
+            dropbox.exceptions.ApiError(
+                '1', SaveCopyReferenceError('path', write_error), 'message',
+                ''),
+            dropbox.exceptions.ApiError(
+                '1', SaveCopyReferenceError('not_found'), 'message', ''),
+        ]
+
+        with self.assertRaises(DestinationExistsError) as e:
+            self.fs.copy_from(DropboxFS('456'), '/file1.txt', '/file2.txt')
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.copy_from(DropboxFS('456'), '/file1.txt', '/file2.txt')
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder_continue')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_copy_batch_check')
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    @patch('dropboxfs.time.sleep')
+    def test_copydir(self, mock_sleep, mock_batch, mock_check, mock_list,
+                     mock_continue):
+        """Test copying a directory and caching the copied tree."""
+        folder = FolderMetadata(
+            name=u'files2', path_lower=u'/files2', path_display=u'/files2')
+        subfolder = FolderMetadata(
+            name=u'sub', path_lower=u'/files2/sub',
+            path_display=u'/files2/sub')
+        file1 = FileMetadata(
+            name=u'a.txt', path_lower=u'/files2/sub/a.txt',
+            path_display=u'/files2/sub/a.txt', size=3)
+        mock_batch.return_value = RelocationBatchLaunch('async_job_id', 'job')
+        mock_check.side_effect = [
+            RelocationBatchJobStatus('in_progress'),
+            RelocationBatchJobStatus('complete', RelocationBatchResult(
+                entries=[RelocationResult(metadata=folder)])),
+        ]
+        mock_list.return_value = ListFolderResult(
+            entries=[folder, subfolder], cursor='c', has_more=True)
+        mock_continue.return_value = ListFolderResult(
+            entries=[file1, Mock(spec=DeletedMetadata)], cursor='c',
+            has_more=False)
+        callback = Mock()
+
+        self.fs.copydir('/files', '/files2', callback=callback)
+
+        self.assertEqual(1, mock_sleep.call_count)
+        mock_list.assert_called_once_with(
+            u'/files2', recursive=True, include_deleted=False)
+        self.assertEqual(['sub'], self.fs.listdir('/files2'))
+        self.assertEqual(['a.txt'], self.fs.listdir('/files2/sub'))
+        self.assertEqual(3, self.fs.getinfo('/files2/sub/a.txt')['size'])
+        self.assertEqual(1, mock_list.call_count)
+        self.assertEqual([
+            (('in_progress', 1),),
+            (('listing', 1),),
+            (('listing', 2),),
+            (('complete', 2),),
+        ], callback.call_args_list)
+
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    def test_copydir_file(self, mock_batch):
+        """Test copying a directory that completes right away."""
+        file1 = FileMetadata(
+            name=u'a.txt', path_lower=u'/b.txt', path_display=u'/b.txt')
+        mock_batch.return_value = RelocationBatchLaunch(
+            'complete', RelocationBatchResult(
+                entries=[RelocationResult(metadata=file1)]))
+
+        metadata = self.fs.client.relocate_tree('/a.txt', '/b.txt')
+
+        self.assertEqual(file1, metadata)
+        self.assertIn('/b.txt', self.fs.client.cache)
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(DropboxClient, 'relocate_tree')
+    def test_copydir_overwrite(self, mock_relocate, mock_delete):
+        """Test copying a directory over a missing dst or a file."""
+        self.cache_folder('/', 'files/', 'file.txt', 'a.txt')
+
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.copydir('/missing', '/file.txt', overwrite=True)
+        with self.assertRaises(ResourceInvalidError):
+            self.fs.copydir('/a.txt', '/file.txt', overwrite=True)
+        self.assertFalse(mock_delete.called)
+
+        self.fs.copydir('/files', '/files2', overwrite=True)
+        self.fs.copydir('/files', '/file.txt', overwrite=True)
+        self.fs.copydir('/files', '/files2', overwrite=True, autorename=True)
+
+        mock_delete.assert_called_once_with('/file.txt')
+        self.assertEqual(3, mock_relocate.call_count)
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(DropboxClient, 'relocate_tree')
+    def test_copydir_merge(self, mock_relocate, mock_delete):
+        """Test copying a directory into an existing one merges them."""
+        self.cache_folder('/', 'src/', 'dst/')
+        self.cache_folder('/src', 'a.txt', 'sub/', 'new/', 'x/')
+        self.cache_folder('/src/sub', 'b.txt')
+        self.cache_folder('/dst', 'a.txt', 'sub/', 'keep.txt', 'x')
+        self.cache_folder('/dst/sub', 'c.txt')
+
+        self.fs.copydir('/src', '/dst', overwrite=True)
+
+        self.assertEqual(
+            ['/dst/a.txt', '/dst/x'],
+            sorted(c[0][0] for c in mock_delete.call_args_list))
+        self.assertEqual(
+            [('/src/a.txt', '/dst/a.txt'), ('/src/new', '/dst/new'),
+             ('/src/sub/b.txt', '/dst/sub/b.txt'), ('/src/x', '/dst/x')],
+            sorted(c[0] for c in mock_relocate.call_args_list))
+        self.assertFalse(mock_relocate.call_args[1]['move'])
+
+        mock_delete.reset_mock()
+        self.fs.movedir('/src', '/dst', overwrite=True)
+
+        self.assertIn((('/src/sub',),), mock_delete.call_args_list)
+        self.assertEqual(('/src',), mock_delete.call_args[0])
+        self.assertTrue(mock_relocate.call_args[1]['move'])
+
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    def test_copydir_other(self, mock_batch):
+        """Test copying a directory with an unexpected job result."""
+        mock_batch.return_value = RelocationBatchLaunch('other')
+
+        with self.assertRaises(RemoteConnectionError) as e:
             self.fs.copydir('/files', '/files2')
-        except Exception, e:
-            self.fail(e)
+
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    def test_copydir_error(self, mock_batch):
+        """Test copying a directory with an error."""
+        mock_batch.side_effect = dropbox.exceptions.ApiError(
+            '1', None, 'message', '')
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.copydir('/files', '/files2')
+
+    @patch.object(dropbox.Dropbox, 'files_copy_batch_check')
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    def test_copydir_exists(self, mock_batch, mock_check):
+        """Test copying a directory when the destination exists."""
+        write_conflict_error = WriteConflictError(tag='folder')
+        write_error = WriteError(tag='conflict', value=write_conflict_error)
+        mock_batch.return_value = RelocationBatchLaunch('async_job_id', 'job')
+        mock_check.return_value = RelocationBatchJobStatus(
+            'failed', RelocationBatchError('to', write_error))
+
+        with self.assertRaises(DestinationExistsError) as e:
+            self.fs.copydir('/files', '/files2')
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_copy_batch')
+    def test_copydir_cache_error(self, mock_batch, mock_list):
+        """Test copying a directory when caching the copy fails."""
+        folder = FolderMetadata(
+            name=u'files2', path_lower=u'/files2', path_display=u'/files2')
+        mock_batch.return_value = RelocationBatchLaunch(
+            'complete', RelocationBatchResult(
+                entries=[RelocationResult(metadata=folder)]))
+        mock_list.side_effect = dropbox.exceptions.ApiError(
+            '1', ListFolderError(tag='other'), 'message', '')
+
+        with self.assertRaises(RemoteConnectionError) as e:
+            self.fs.copydir('/files', '/files2')
+
+        self.fs.copydir('/files', '/files2', ignore_errors=True)
+
+        self.assertIn('/files2', self.fs.client.cache)
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_list_tree_not_found(self, mock_list):
+        """Test listing a tree that does not exist."""
+        lookup_error = LookupError(tag='not_found')
+        mock_list.side_effect = dropbox.exceptions.ApiError(
+            '1', ListFolderError(tag='path', value=lookup_error), 'message',
+            '')
+
+        with self.assertRaises(ResourceNotFoundError) as e:
+            list(self.fs.client.list_tree('/'))
+
+        mock_list.assert_called_once_with(
+            '', recursive=True, include_deleted=False)
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder_continue')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_list_changes(self, mock_list, mock_continue):
+        """Test listing changes since a cursor, or everything without one."""
+        a, b = FileMetadata(name=u'a'), FileMetadata(name=u'b')
+        mock_list.return_value = ListFolderResult(
+            entries=[a], cursor='c1', has_more=True)
+        mock_continue.side_effect = [
+            ListFolderResult(entries=[b], cursor='c2', has_more=False),
+            ListFolderResult(entries=[b], cursor='c3', has_more=False),
+        ]
+
+        self.assertEqual(([a, b], 'c2', True),
+                         self.fs.client.list_changes('/files'))
+        self.assertEqual(([b], 'c3', False),
+                         self.fs.client.list_changes('/files', 'c2'))
+
+        mock_list.assert_called_once_with(
+            '/files', recursive=True, include_deleted=False)
+        mock_continue.assert_called_with('c2')
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder_continue')
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    def test_list_changes_errors(self, mock_list, mock_continue):
+        """Test a reset cursor lists everything again."""
+        mock_list.return_value = ListFolderResult(
+            entries=[], cursor='c2', has_more=False)
+        mock_continue.side_effect = [
+            dropbox.exceptions.ApiError(
+                '1', ListFolderContinueError('reset'), 'message', ''),
+            dropbox.exceptions.ApiError(
+                '1', ListFolderContinueError('other'), 'message', ''),
+        ]
+
+        self.assertEqual(([], 'c2', True),
+                         self.fs.client.list_changes('/', 'c1'))
+        with self.assertRaises(RemoteConnectionError):
+            self.fs.client.list_changes('/', 'c2')
+        mock_list.side_effect = dropbox.exceptions.ApiError(
+            '1', ListFolderError('path', LookupError('not_found')),
+            'message', '')
+        with self.assertRaises(ResourceNotFoundError):
+            self.fs.client.list_changes('/')
+
+        mock_list.assert_called_with('', recursive=True, include_deleted=False)
 
     @patch.object(dropbox.Dropbox, 'files_move')
     def test_move(self, mock_move):
@@ -798,15 +2700,26 @@ class TestDropboxFS(unittest.TestCase):
         except Exception, e:
             self.fail(e)
 
-    @patch.object(dropbox.Dropbox, 'files_move')
-    def test_movedir(self, mock_move):
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(dropbox.Dropbox, 'files_move_batch_check')
+    @patch.object(dropbox.Dropbox, 'files_move_batch')
+    def test_movedir(self, mock_batch, mock_check, mock_delete):
         """Test moving a directory."""
-        mock_move.return_value = {}
-
-        try:
-            self.fs.movedir('/files', '/files2')
-        except Exception, e:
-            self.fail(e)
+        moved = FileMetadata(
+            name=u'files2', path_lower=u'/files2', path_display=u'/files2')
+        mock_batch.return_value = RelocationBatchLaunch('async_job_id', 'job')
+        mock_check.return_value = RelocationBatchJobStatus(
+            'complete', RelocationBatchResult(
+                entries=[RelocationResult(metadata=moved)]))
+        self.cache_folder('/', 'files/')
+        self.cache_folder('/files', 'a.txt')
+
+        self.fs.movedir('/files', '/files2', overwrite=True)
+
+        self.assertEqual(0, mock_delete.call_count)
+        self.assertNotIn('/files', self.fs.client.cache)
+        self.assertNotIn('/files/a.txt', self.fs.client.cache)
+        self.assertIn('/files2', self.fs.client.cache)
 
     @patch.object(dropbox.Dropbox, 'files_move')
     def test_rename(self, mock_move):
@@ -888,6 +2801,84 @@ class TestDropboxFS(unittest.TestCase):
         with self.assertRaises(RemoteConnectionError) as e:
             self.fs.makedir('/files')
 
+    @patch.object(dropbox.Dropbox, 'files_create_folder')
+    def test_makedir_recreate(self, mock_create_folder):
+        """Test creating a folder that exists with allow_recreate."""
+        write_conflict_error = WriteConflictError(tag='folder')
+        write_error = WriteError(tag='conflict', value=write_conflict_error)
+        create_error = CreateFolderError(tag='path', value=write_error)
+        mock_create_folder.side_effect = dropbox.exceptions.ApiError(
+            '1', create_error, 'message', '')
+
+        self.fs.makedir('/files', allow_recreate=True)
+        self.fs.makedir('/', allow_recreate=True)
+        with self.assertRaises(DestinationExistsError):
+            self.fs.makedir('/')
+
+    @patch.object(dropbox.Dropbox, 'files_create_folder')
+    def test_makedir_file_exists(self, mock_create_folder):
+        """Test creating a folder where a file exists."""
+        write_conflict_error = WriteConflictError(tag='file')
+        write_error = WriteError(tag='conflict', value=write_conflict_error)
+        create_error = CreateFolderError(tag='path', value=write_error)
+        mock_create_folder.side_effect = dropbox.exceptions.ApiError(
+            '1', create_error, 'message', '')
+
+        with self.assertRaises(ResourceInvalidError):
+            self.fs.makedir('/file.txt', allow_recreate=True)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_create_folder')
+    def test_makedir_parent_missing(self, mock_create_folder, mock_metadata):
+        """Test creating a folder whose parent is missing or a file."""
+        mock_metadata.side_effect = ResourceNotFoundError('/a')
+
+        with self.assertRaises(ParentDirectoryMissingError):
+            self.fs.makedir('/a/b')
+        self.fs.client.cache.set('/a', FileMetadata(
+            name=u'a', path_lower=u'/a', path_display=u'/a'))
+        with self.assertRaises(ResourceInvalidError):
+            self.fs.makedir('/a/b')
+        self.assertFalse(mock_create_folder.called)
+
+        self.fs.client.cache.set('/a', FolderMetadata(
+            name=u'a', path_lower=u'/a', path_display=u'/a'))
+        mock_create_folder.return_value = FolderMetadata(
+            name=u'b', path_lower=u'/a/b', path_display=u'/a/b')
+        self.fs.makedir('/a/b')
+        mock_create_folder.assert_called_once_with('/a/b')
+
+    @patch.object(dropbox.Dropbox, 'files_list_folder')
+    @patch.object(dropbox.Dropbox, 'files_create_folder')
+    def test_makedir_recursive(self, mock_create_folder, mock_list_folder):
+        """Test creating a folder with its parents in one request."""
+        self.fs.client.cache['/A'] = CacheItem(FolderMetadata(
+            name=u'A', path_lower=u'/a', path_display=u'/A'), [u'Other'])
+        self.fs.client.cache['/A/B'] = CacheItem(None, None)
+        mock_create_folder.return_value = FolderMetadata(
+            name=u'C', path_lower=u'/a/b/c', path_display=u'/A/B/C')
+
+        self.fs.makedir('/a/b/c', recursive=True)
+
+        mock_create_folder.assert_called_once_with('/a/b/c')
+        self.assertEqual(self.fs.listdir('/a'), [u'Other', u'B'])
+        self.assertTrue(self.fs.isdir('/A'))
+        self.assertTrue(self.fs.isdir('/a/b'))
+        self.assertTrue(self.fs.isdir('/a/b/c'))
+        self.assertEqual(self.fs.getinfo('/a/b')['path'], u'B')
+        self.assertFalse(mock_list_folder.called)
+
+    @patch.object(dropbox.Dropbox, 'files_create_folder')
+    def test_makedirs(self, mock_create_folder):
+        """Test creating many folders with one request per branch."""
+        mock_create_folder.return_value = {}
+
+        self.fs.makedirs(['/a', '/a/b', '/A/b/c', '/a/b-x', '/d', '/'])
+
+        self.assertEqual(
+            sorted(c[0][0] for c in mock_create_folder.call_args_list),
+            ['/A/b/c', '/a/b-x', '/d'])
+
     @patch.object(dropbox.Dropbox, 'files_delete')
     def test_remove(self, mock_delete):
         """Test deleting a file."""
@@ -929,3 +2920,746 @@ class TestDropboxFS(unittest.TestCase):
             self.fs.removedir('/files')
         except Exception, e:
             self.fail(e)
+
+
+def folder(path):
+    return FolderMetadata(name=basename(path), path_lower=path.lower(),
+                          path_display=path)
+
+
+def file(path, size=1):
+    return FileMetadata(name=basename(path), path_lower=path.lower(),
+                        path_display=path, size=size,
+                        server_modified=datetime.datetime(2017, 1, 1))
+
+
+TREE = [
+    [folder(u'/Docs'), file(u'/Docs/a.txt', 10), folder(u'/Docs/Old')],
+    [file(u'/Docs/Old/b.txt', 5), file(u'/Docs/Old/c.txt', 5),
+     folder(u'/Music'), file(u'/top.txt', 1),
+     DeletedMetadata(name=u'gone', path_lower=u'/gone')],
+]
+
+
+class TestCommandLine(unittest.TestCase):
+    """Test the command line interface."""
+
+    def setUp(self):
+        self.fs = DropboxFS('123')
+        self.out = io.BytesIO()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cache(self, *entries):
+        for entry in entries:
+            self.fs.client.cache.set(entry.path_display, entry)
+
+    def lines(self):
+        return self.out.getvalue().decode('utf8').splitlines()
+
+    def test_tree_sizes(self):
+        """Test sizes and file counts are added up for every folder."""
+        self.assertEqual({
+            u'/': (21, 4),
+            u'/Docs': (20, 3),
+            u'/Docs/Old': (10, 2),
+            u'/Music': (0, 0),
+        }, tree_sizes(TREE, u'/'))
+
+    @patch.object(DropboxClient, 'list_tree')
+    def test_du(self, mock_tree):
+        """Test showing folder sizes."""
+        mock_tree.return_value = TREE
+
+        self.assertEqual(0, main(['-a', '123', 'du'], self.out))
+
+        self.assertEqual([u'21\t4\t/', u'20\t3\t/Docs',
+                          u'10\t2\t/Docs/Old', u'0\t0\t/Music'],
+                         self.lines())
+        mock_tree.assert_called_once_with('/')
+
+    @patch.object(DropboxClient, 'list_tree')
+    def test_du_options(self, mock_tree):
+        """Test showing the largest folders and limiting their depth."""
+        mock_tree.side_effect = [TREE, TREE[:1] + [TREE[1][:2]]]
+
+        command_du(self.fs, ['-d', '1', '-n', '2', '/'], self.out)
+        command_du(self.fs, ['-d', '0', '/Docs'], self.out)
+
+        self.assertEqual([u'21\t4\t/', u'20\t3\t/Docs', u'20\t3\t/Docs'],
+                         self.lines())
+
+    def test_ls(self):
+        """Test listing a folder."""
+        self.fs.client.cache['/docs'] = CacheItem(
+            folder(u'/Docs'), [u'a.txt', u'Old'])
+        self.cache(file(u'/Docs/a.txt', 10), folder(u'/Docs/Old'))
+        self.fs.timezone = None
+
+        command_ls(self.fs, ['/Docs'], self.out)
+        command_ls(self.fs, ['-l', '/Docs'], self.out)
+
+        self.assertEqual([u'a.txt', u'Old/', u'10\t2017-01-01 00:00:00\ta.txt',
+                          u'0\t\tOld/'], self.lines())
+
+    @patch.object(DropboxClient, 'list_tree')
+    def test_ls_recursive(self, mock_tree):
+        """Test listing everything below a folder, page by page."""
+        pages = [[folder(u'/Docs'), file(u'/Docs/a.txt')],
+                 [folder(u'/Docs/Old')]]
+        listed = []
+
+        def list_tree(path):
+            for page in pages:
+                yield page
+                listed.append(self.lines())
+
+        mock_tree.side_effect = list_tree
+
+        command_ls(self.fs, ['-R', '/docs'], self.out)
+
+        self.assertEqual([[u'/Docs/a.txt'], [u'/Docs/a.txt', u'/Docs/Old/']],
+                         listed)
+
+    def test_stat(self):
+        """Test showing the info of a path."""
+        self.cache(file(u'/Docs/a.txt', 10))
+
+        command_stat(self.fs, ['/Docs/a.txt'], self.out)
+
+        lines = self.lines()
+        self.assertEqual(u'/Docs/a.txt', lines[0])
+        self.assertIn(u'\tsize\t10', lines)
+        with self.assertRaises(SystemExit):
+            command_stat(self.fs, [], self.out)
+
+    @patch.object(DropboxFS, 'find')
+    def test_find(self, mock_find):
+        """Test finding paths by name."""
+        mock_find.return_value = iter([u'/Docs/a.txt'])
+
+        command_find(self.fs, ['/Docs', '*.txt'], self.out)
+        command_find(self.fs, ['*.txt'], self.out)
+
+        self.assertEqual([u'/Docs/a.txt'], self.lines())
+        mock_find.assert_any_call('*.txt', '/Docs')
+        mock_find.assert_any_call('*.txt', '/')
+        with self.assertRaises(SystemExit):
+            command_find(self.fs, [], self.out)
+
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    def test_rm(self, mock_delete):
+        """Test removing files, and folders with -r."""
+        self.cache(file(u'/a.txt'), folder(u'/Docs'))
+
+        command_rm(self.fs, ['/a.txt'], self.out)
+        with self.assertRaises(ResourceInvalidError):
+            command_rm(self.fs, ['/Docs'], self.out)
+        command_rm(self.fs, ['-r', '/Docs'], self.out)
+
+        self.assertEqual(['/a.txt', '/Docs'],
+                         [c[0][0] for c in mock_delete.call_args_list])
+        with self.assertRaises(SystemExit):
+            command_rm(self.fs, [], self.out)
+
+    @patch.object(DropboxFS, 'copydir')
+    @patch.object(DropboxFS, 'copy')
+    def test_cp_remote(self, mock_copy, mock_copydir):
+        """Test copies within Dropbox are left to it."""
+        self.fs.client.cache['/'] = CacheItem(folder(u'/'), [])
+        self.cache(file(u'/a.txt'), folder(u'/Docs'), folder(u'/Backup'))
+
+        command_cp(self.fs, ['/a.txt', '/b.txt'], self.out)
+        command_cp(self.fs, ['-r', '/a.txt', '/Docs', '/Backup'], self.out)
+
+        mock_copy.assert_any_call('/a.txt', '/b.txt', overwrite=True)
+        mock_copy.assert_any_call('/a.txt', '/Backup/a.txt', overwrite=True)
+        mock_copydir.assert_called_once_with(
+            '/Docs', '/Backup/Docs', overwrite=True)
+        self.assertEqual(3, len(self.lines()))
+
+    @patch.object(DropboxFS, 'makedirs')
+    @patch.object(DropboxFS, 'setcontents')
+    def test_cp_upload(self, mock_setcontents, mock_makedirs):
+        """Test uploading a local folder."""
+        os.makedirs(os.path.join(self.tempdir, 'Docs', 'Old'))
+        for name in ('a.txt', os.path.join('Old', 'b.txt')):
+            with open(os.path.join(self.tempdir, 'Docs', name), 'wb') as f:
+                f.write(name)
+        uploaded = {}
+        mock_setcontents.side_effect = \
+            lambda path, f: uploaded.update({path: f.read()})
+        self.fs.client.cache['/'] = CacheItem(folder(u'/'), [])
+
+        command_cp(self.fs, ['-r', '-j', '2',
+                             'file:' + os.path.join(self.tempdir, 'Docs'),
+                             '/Docs'], self.out)
+
+        self.assertEqual({'/Docs/a.txt': 'a.txt',
+                          '/Docs/Old/b.txt': os.path.join('Old', 'b.txt')},
+                         uploaded)
+        mock_makedirs.assert_called_once_with(['/Docs', '/Docs/Old'])
+        self.assertEqual(2, len(self.lines()))
+
+    @patch.object(DropboxFS, 'download_parallel')
+    @patch.object(DropboxClient, 'list_tree')
+    def test_cp_download(self, mock_tree, mock_download):
+        """Test downloading files and folders."""
+        self.cache(folder(u'/Docs'), file(u'/top.txt'))
+        mock_tree.return_value = TREE[:1] + [TREE[1][:2]]
+        target = os.path.join(self.tempdir, 'Docs')
+
+        command_cp(self.fs, ['-r', '/Docs', '/top.txt',
+                             'file:' + self.tempdir], self.out)
+        copy = os.path.join(self.tempdir, 'Copy')
+        command_cp(self.fs, ['-r', '/Docs', 'file:' + copy], self.out)
+
+        self.assertTrue(os.path.isdir(os.path.join(target, 'Old')))
+        self.assertTrue(os.path.isdir(os.path.join(copy, 'Old')))
+        downloads = sorted(c[0] for c in mock_download.call_args_list)
+        self.assertEqual([
+            (u'/Docs/Old/b.txt', os.path.join(copy, 'Old', 'b.txt')),
+            (u'/Docs/Old/b.txt', os.path.join(target, 'Old', 'b.txt')),
+            (u'/Docs/Old/c.txt', os.path.join(copy, 'Old', 'c.txt')),
+            (u'/Docs/Old/c.txt', os.path.join(target, 'Old', 'c.txt')),
+            (u'/Docs/a.txt', os.path.join(copy, 'a.txt')),
+            (u'/Docs/a.txt', os.path.join(target, 'a.txt')),
+            ('/top.txt', os.path.join(self.tempdir, 'top.txt')),
+        ], downloads)
+        self.assertEqual(7, len(self.lines()))
+
+    def test_cp_errors(self):
+        """Test invalid copies."""
+        self.cache(folder(u'/Docs'))
+
+        for args in (['/Docs'], ['file:a', 'file:b']):
+            with self.assertRaises(SystemExit):
+                command_cp(self.fs, args, self.out)
+        with self.assertRaises(ResourceInvalidError):
+            command_cp(self.fs, ['/Docs', 'file:' + self.tempdir], self.out)
+
+    def test_run_parallel(self):
+        """Test jobs run in parallel and the first error is raised."""
+        done = []
+
+        def fail():
+            raise ValueError()
+
+        run_parallel([lambda: done.append(1)] * 3, 2)
+        with self.assertRaises(ValueError):
+            run_parallel([fail], 2)
+
+        self.assertEqual([1, 1, 1], done)
+
+    @patch.object(dropbox.Dropbox, 'files_get_metadata')
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    def test_main(self, mock_delete, mock_metadata):
+        """Test running commands and reporting their errors."""
+        mock_metadata.side_effect = dropbox.exceptions.ApiError(
+            '1', GetMetadataError('path', LookupError('not_found')), '', '')
+        mock_delete.side_effect = dropbox.exceptions.ApiError(
+            '1', DeleteError('path_lookup', LookupError('not_found')), '', '')
+        stderr = io.BytesIO()
+
+        with patch('sys.stderr', stderr):
+            self.assertEqual(1, main(['-a', '123', '-n', '42', 'rm',
+                                      '/missing'], self.out))
+
+        self.assertIn('dropboxfs rm:', stderr.getvalue())
+        for args in ([], ['-a', '123', 'frob'], ['ls']):
+            with self.assertRaises(SystemExit):
+                with patch('sys.stderr', stderr):
+                    main(args, self.out)
+
+
+class TestTreeIndex(unittest.TestCase):
+    """Test TreeIndex."""
+
+    def setUp(self):
+        self.index = TreeIndex(u'/', TREE)
+
+    def test_build(self):
+        """Test totals are added up for every folder of a listing."""
+        self.assertEqual(8, len(self.index))
+        self.assertEqual((21, 4), self.index.total(u'/'))
+        self.assertEqual((20, 3), self.index.total(u'/docs'))
+        self.assertEqual((10, 2), self.index.total(u'/Docs/Old'))
+        self.assertEqual((5, 1), self.index.total(u'/DOCS/old/b.txt'))
+        self.assertEqual((0, 0), self.index.total(u'/Music'))
+        self.assertNotIn(u'/gone', self.index)
+        with self.assertRaises(ResourceNotFoundError):
+            self.index.total(u'/missing')
+
+    def test_build_folder(self):
+        """Test only what is below the indexed folder is kept."""
+        index = TreeIndex(u'/Docs/', TREE)
+
+        self.assertEqual(5, len(index))
+        self.assertEqual((20, 3), index.total(u'/Docs'))
+        self.assertNotIn(u'/Music', index)
+        self.assertEqual([(u'/Docs/a.txt', 10)], index.largest(1))
+
+    def test_set(self):
+        """Test adding and updating paths updates the totals above them."""
+        self.index.set(u'/Docs/Old/d.txt', file(u'/Docs/Old/d.txt', 7))
+        self.index.set(u'/Docs/a.txt', file(u'/Docs/a.txt', 4))
+        self.index.set(u'/', folder(u'/'))
+        self.index.set(u'/e.txt', file(u'/e.txt', 2))
+
+        self.assertEqual((24, 6), self.index.total(u'/'))
+        self.assertEqual((17, 3), self.index.total(u'/Docs/Old'))
+
+        # Missing parents are added, as folders.
+        self.index.set(u'/New/Sub/e.txt', file(u'/New/Sub/e.txt', 3))
+
+        self.assertEqual((3, 1), self.index.total(u'/New'))
+        self.assertEqual([(u'/New/Sub', 3)], self.index.largest(
+            5, u'/New', folders=True))
+
+        # A file replaced by a folder, and a deleted folder.
+        self.index.set(u'/top.txt', folder(u'/top.txt'))
+        self.index.set(u'/Docs', DeletedMetadata(name=u'Docs'))
+
+        self.assertEqual((5, 2), self.index.total(u'/'))
+        self.assertEqual((0, 0), self.index.total(u'/top.txt'))
+        self.assertNotIn(u'/Docs/Old/b.txt', self.index)
+
+    def test_set_without_metadata(self):
+        """Test metadata without a name, size or time."""
+        index = TreeIndex(u'/Root')
+        index.set(u'/Root/a.txt', FileMetadata())
+        index.set(u'/root/a.txt', FileMetadata(size=3))
+
+        self.assertEqual((3, 1), index.total(u'/Root'))
+        self.assertEqual([(u'/Root/a.txt', 3)], index.largest(1, u'/root'))
+
+    def test_remove(self):
+        """Test removing a folder removes everything below it."""
+        self.index.remove(u'/Docs/Old')
+        self.index.remove(u'/Docs/Old')
+        self.index.remove(u'/')
+
+        self.assertEqual(5, len(self.index))
+        self.assertEqual((11, 2), self.index.total(u'/'))
+        self.assertNotIn(u'/Docs/Old/b.txt', self.index)
+
+        # The freed nodes are reused.
+        nodes = len(self.index.kind)
+        self.index.set(u'/Docs/New', folder(u'/Docs/New'))
+        self.index.set(u'/Docs/New/f.txt', file(u'/Docs/New/f.txt', 2))
+
+        self.assertEqual(nodes, len(self.index.kind))
+        self.assertEqual((12, 2), self.index.total(u'/Docs'))
+        self.assertEqual([u'/Docs/New', u'/Docs/a.txt'], sorted(
+            p for p, s in self.index.largest(5, u'/Docs') +
+            self.index.largest(5, u'/Docs', folders=True)
+            if p in (u'/Docs/New', u'/Docs/a.txt')))
+
+    def test_move(self):
+        """Test moving a folder keeps the totals below it."""
+        self.index.move(u'/Docs/Old', u'/Music/Older', folder(u'/Music/Older'))
+
+        self.assertEqual((21, 4), self.index.total(u'/'))
+        self.assertEqual((10, 1), self.index.total(u'/Docs'))
+        self.assertEqual((10, 2), self.index.total(u'/music'))
+        self.assertEqual((5, 1), self.index.total(u'/Music/Older/c.txt'))
+        self.assertNotIn(u'/Docs/Old', self.index)
+        self.assertNotIn(u'/Docs/Old/b.txt', self.index)
+        self.assertEqual([(u'/Music/Older/b.txt', 5)],
+                         self.index.largest(1, u'/Music'))
+
+    def test_move_over(self):
+        """Test moving a file over another, and to a missing folder."""
+        self.index.move(u'/top.txt', u'/Docs/a.txt', None)
+
+        self.assertEqual((11, 3), self.index.total(u'/'))
+        self.assertEqual((1, 1), self.index.total(u'/Docs/a.txt'))
+
+        self.index.move(u'/Docs/a.txt', u'/New/a.txt', file(u'/New/a.txt'))
+
+        self.assertEqual((1, 1), self.index.total(u'/New'))
+
+    def test_move_unindexed(self):
+        """Test moves from or to paths that are not indexed."""
+        index = TreeIndex(u'/Docs', TREE)
+
+        index.move(u'/Docs/a.txt', u'/a.txt', file(u'/a.txt', 10))
+
+        self.assertEqual((10, 2), index.total(u'/Docs'))
+        self.assertNotIn(u'/a.txt', index)
+
+        index.move(u'/b.txt', u'/Docs/b.txt', file(u'/Docs/b.txt', 3))
+
+        self.assertEqual((13, 3), index.total(u'/Docs'))
+
+    def test_largest(self):
+        """Test finding the largest files and folders."""
+        self.assertEqual([(u'/Docs/a.txt', 10), (u'/Docs/Old/b.txt', 5)],
+                         self.index.largest(2))
+        self.assertEqual([(u'/Docs/Old/b.txt', 5), (u'/Docs/Old/c.txt', 5)],
+                         self.index.largest(5, u'/Docs/Old'))
+        self.assertEqual([(u'/Docs', 20), (u'/Docs/Old', 10), (u'/Music', 0)],
+                         self.index.largest(5, folders=True))
+        self.assertEqual([], self.index.largest(5, u'/top.txt'))
+        with self.assertRaises(ResourceNotFoundError):
+            self.index.largest(5, u'/missing')
+
+    def test_modified_since(self):
+        """Test finding the files modified since a time."""
+        entry = file(u'/Docs/Old/c.txt', 5)
+        entry.server_modified = datetime.datetime(2018, 1, 1)
+        self.index.set(entry.path_lower, entry)
+
+        self.assertEqual([u'/Docs/Old/c.txt'], self.index.modified_since(
+            datetime.datetime(2017, 6, 1)))
+        self.assertEqual([u'/Docs/Old/c.txt'], self.index.modified_since(
+            datetime.datetime(2017, 6, 1, tzinfo=pytz.UTC), u'/Docs/Old'))
+        self.assertEqual([], self.index.modified_since(
+            calendar.timegm((2017, 6, 1, 0, 0, 0)), u'/Music'))
+        self.assertEqual(4, len(self.index.modified_since(0)))
+        with self.assertRaises(ResourceNotFoundError):
+            self.index.modified_since(0, u'/missing')
+
+    @patch.object(dropbox.Dropbox, 'files_move')
+    @patch.object(dropbox.Dropbox, 'files_delete')
+    @patch.object(DropboxClient, 'list_tree')
+    def test_build_index(self, mock_tree, mock_delete, mock_move):
+        """Test the index of a fs follows the changes made through it."""
+        fs = DropboxFS('123')
+        mock_tree.return_value = TREE
+        mock_move.return_value = folder(u'/Music/Old')
+
+        index = fs.build_index(u'/')
+
+        mock_tree.assert_called_with(u'/')
+        self.assertIs(index, fs.client.cache.index)
+        self.assertEqual((21, 4), index.total(u'/'))
+
+        fs.client.cache.set(u'/Docs/d.txt', file(u'/Docs/d.txt', 4))
+        fs.client.cache.update({u'/e.txt': CacheItem(file(u'/e.txt', 2)),
+                                u'/Music': CacheItem(None, [])})
+        fs.client.cache[u'/Music'] = CacheItem(None, [])
+        fs.remove(u'/top.txt')
+        fs.client.files_move(u'/Docs/Old', u'/Music/Old')
+
+        self.assertEqual((26, 5), index.total(u'/'))
+        self.assertEqual((14, 2), index.total(u'/Docs'))
+        self.assertEqual((10, 2), index.total(u'/Music'))
+        self.assertIn(u'/Music/Old/b.txt', index)
+
+
+class TestDropboxSync(unittest.TestCase):
+    """Test DropboxSync."""
+
+    def setUp(self):
+        self.local = MemoryFS()
+        self.remote = DropboxFS('123')
+        self.tempdir = tempfile.mkdtemp()
+        self.state = os.path.join(self.tempdir, 'state')
+        self.uploads = {}
+        for name in ('list_changes', 'files_delete'):
+            patcher = patch.object(DropboxClient, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        for name in ('open', 'setcontents', 'makedirs'):
+            patcher = patch.object(DropboxFS, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.open.side_effect = lambda path, mode: io.BytesIO('remote')
+        self.setcontents.side_effect = self.upload
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def upload(self, path, f, rev=None):
+        data = f.read()
+        self.uploads[path] = (data, rev)
+        self.remote.client.cache.set(path, FileMetadata(
+            name=basename(path), path_display=path, rev='b%08d' % len(
+                self.uploads), content_hash=content_hash(io.BytesIO(data))))
+
+    def sync(self, *entries, **kwargs):
+        self.list_changes.return_value = (
+            list(entries), kwargs.get('cursor', 'c1'), kwargs.get('full', True))
+        sync = DropboxSync(self.local, self.remote, '/Mirror', self.state,
+                           parallelism=2)
+        return sync.run()
+
+    def remote_file(self, path, rev, data='remote'):
+        return FileMetadata(
+            name=basename(path), path_lower=path.lower(), path_display=path,
+            rev=rev, size=len(data), content_hash=content_hash(
+                io.BytesIO(data)))
+
+    def test_content_hash(self):
+        """Test the content hash is a hash of the hashes of blocks."""
+        import hashlib
+        expected = hashlib.sha256(hashlib.sha256('ab').digest() +
+                                  hashlib.sha256('c').digest()).hexdigest()
+
+        self.assertEqual(expected, content_hash(io.BytesIO('abc'), 2))
+
+    def test_sync(self):
+        """Test a first run followed by an incremental one."""
+        self.local.setcontents('/up.txt', 'up')
+        self.local.setcontents('/Both.txt', 'local')
+        self.local.setcontents('/Same.txt', 'same')
+        self.local.makedir('/LocalDir')
+
+        counts = self.sync(
+            folder(u'/Mirror'),
+            folder(u'/Mirror/Docs'),
+            self.remote_file(u'/Mirror/Docs/d.txt', 'a00000001'),
+            self.remote_file(u'/Mirror/both.txt', 'a00000002'),
+            self.remote_file(u'/Mirror/Same.txt', 'a00000003', 'same'))
+
+        self.assertEqual({'uploaded': 1, 'downloaded': 2, 'conflicts': 1,
+                          'deleted_local': 0, 'deleted_remote': 0}, counts)
+        self.list_changes.assert_called_once_with('/Mirror', None)
+        self.assertEqual('remote', self.local.getcontents('/Docs/d.txt'))
+        self.assertEqual('remote', self.local.getcontents('/both.txt'))
+        self.assertEqual(['Both (conflicted copy %s).txt'
+                          % time.strftime('%Y-%m-%d')],
+                         self.local.listdir('/', wildcard='*conflicted*'))
+        self.assertEqual({'/Mirror/up.txt': ('up', None)}, self.uploads)
+        self.makedirs.assert_called_once_with(['/Mirror/LocalDir'])
+        state = json.load(open(self.state))
+        self.assertEqual('c1', state['cursor'])
+        self.assertEqual(6, len(state['entries']))
+
+        self.local.setcontents('/up.txt', 'up2')
+        self.local.setcontents('/Same.txt', 'same')
+        self.local.removedir('/LocalDir')
+        self.uploads.clear()
+
+        counts = self.sync(
+            DeletedMetadata(name=u'Docs', path_lower=u'/mirror/docs'),
+            DeletedMetadata(name=u'Docs', path_lower=u'/mirror/docs/d.txt'),
+            DeletedMetadata(name=u'gone', path_lower=u'/mirror/gone'),
+            self.remote_file(u'/Mirror/up.txt', 'b00000001', 'up'),
+            cursor='c2', full=False)
+
+        self.assertEqual({'uploaded': 2, 'downloaded': 0, 'conflicts': 0,
+                          'deleted_local': 1, 'deleted_remote': 1}, counts)
+        self.list_changes.assert_called_with('/Mirror', 'c1')
+        self.assertFalse(self.local.exists('/Docs'))
+        self.files_delete.assert_called_once_with('/Mirror/LocalDir')
+        self.assertEqual(('up2', 'b00000001'), self.uploads['/Mirror/up.txt'])
+        self.assertEqual(2, len(self.uploads))
+        self.assertEqual('c2', json.load(open(self.state))['cursor'])
+
+    def test_types_changed(self):
+        """Test files replaced by folders and the other way around."""
+        self.local.setcontents('/a', 'a')
+        self.local.makedir('/b')
+        self.local.setcontents('/c', 'c')
+        self.local.makedir('/d')
+        self.local.makedir('/e')
+        self.sync(self.remote_file(u'/Mirror/a', 'a00000001', 'a'),
+                  folder(u'/Mirror/b'),
+                  self.remote_file(u'/Mirror/c', 'a00000002', 'c'),
+                  folder(u'/Mirror/d'), folder(u'/Mirror/e'))
+        self.local.remove('/c')
+        self.local.makedir('/c')
+        self.local.setcontents('/c/x', 'x')
+        self.local.removedir('/d')
+        self.local.setcontents('/d', 'd')
+        self.local.removedir('/e')
+        self.files_delete.side_effect = ResourceNotFoundError('/Mirror/e')
+
+        counts = self.sync(folder(u'/Mirror/a'),
+                           self.remote_file(u'/Mirror/b', 'a00000003'),
+                           full=False)
+
+        self.assertTrue(self.local.isdir('/a'))
+        self.assertEqual('remote', self.local.getcontents('/b'))
+        self.assertEqual(['/Mirror/c', '/Mirror/d', '/Mirror/e'],
+                         [c[0][0] for c in self.files_delete.call_args_list])
+        self.assertEqual(['/Mirror/c/x', '/Mirror/d'], sorted(self.uploads))
+        self.assertEqual(1, counts['downloaded'])
+
+    def test_both_changed(self):
+        """Test paths changed the same way on both sides."""
+        self.local.setcontents('/a', 'a')
+        self.local.makedir('/b')
+        self.local.setcontents('/c', 'c')
+        self.local.setcontents('/d', 'd')
+        self.local.setcontents('/e', 'e')
+        self.sync(self.remote_file(u'/Mirror/a', 'a00000001', 'a'),
+                  self.remote_file(u'/Mirror/c', 'a00000002', 'c'),
+                  self.remote_file(u'/Mirror/d', 'a00000003', 'd'),
+                  self.remote_file(u'/Mirror/e', 'a00000004', 'e'))
+        self.local.remove('/a')
+        self.local.setcontents('/c', 'c2')
+        self.local.remove('/d')
+
+        counts = self.sync(
+            DeletedMetadata(name=u'a', path_lower=u'/mirror/a'),
+            folder(u'/Mirror/b'),
+            DeletedMetadata(name=u'c', path_lower=u'/mirror/c'),
+            self.remote_file(u'/Mirror/d', 'a00000005'),
+            DeletedMetadata(name=u'e', path_lower=u'/mirror/e'),
+            full=False)
+
+        self.assertEqual(1, counts['uploaded'])
+        self.assertEqual(1, counts['downloaded'])
+        self.assertEqual(1, counts['deleted_local'])
+        self.assertEqual({'/Mirror/c': ('c2', None)}, self.uploads)
+        self.assertEqual('remote', self.local.getcontents('/d'))
+        self.assertFalse(self.local.exists('/e'))
+        entries = json.load(open(self.state))['entries']
+        self.assertEqual(['/b', '/c', '/d'], sorted(entries))
+        self.assertTrue(entries['/b']['folder'])
+
+    def test_touched(self):
+        """Test a file that was only touched is not uploaded."""
+        self.local.setcontents('/a', 'a')
+        self.sync(self.remote_file(u'/Mirror/a', 'a00000001', 'a'))
+        self.local.settimes('/a', modified_time=datetime.datetime(2000, 1, 1))
+        self.remote.client.cache.set(
+            '/Mirror/a', self.remote_file(u'/Mirror/a', 'a00000001', 'a'))
+
+        counts = self.sync(full=False)
+
+        self.assertEqual(0, counts['uploaded'])
+        self.assertEqual({}, self.uploads)
+
+    def test_conflict_on_upload(self):
+        """Test a file changed in Dropbox while it was uploaded."""
+        self.local.setcontents('/a', 'a')
+        self.setcontents.side_effect = RevisionConflictError('/Mirror/a')
+
+        counts = self.sync()
+
+        self.assertEqual(1, counts['conflicts'])
+        self.assertEqual({}, json.load(open(self.state))['entries'])
+
+    def test_failed_transfer(self):
+        """Test progress is saved but the cursor kept when a transfer fails."""
+        self.local.setcontents('/a', 'a')
+        self.sync()
+        self.open.side_effect = RemoteConnectionError('/Mirror/b')
+
+        with self.assertRaises(RemoteConnectionError):
+            self.sync(self.remote_file(u'/Mirror/b', 'a00000001'),
+                      cursor='c2', full=False)
+
+        state = json.load(open(self.state))
+        self.assertEqual('c1', state['cursor'])
+        self.assertEqual(['/a'], state['entries'].keys())
+
+    def test_other_folder(self):
+        """Test the state of another folder is not used, nor kept without a
+        state file."""
+        self.sync()
+        sync = DropboxSync(self.local, self.remote, '/Other', self.state)
+        self.assertIsNone(sync.cursor)
+
+        DropboxSync(self.local, self.remote, '/Mirror').run()
+        self.assertIsNone(DropboxSync(
+            self.local, self.remote, '/Mirror').cursor)
+
+    @patch('fs.osfs.OSFS')
+    def test_command(self, mock_osfs):
+        """Test syncing from the command line."""
+        mock_osfs.return_value = self.local
+        out = io.BytesIO()
+        self.list_changes.return_value = ([], 'c1', True)
+
+        command_sync(self.remote, ['-f', self.state,
+                                   os.path.join(self.tempdir, 'dir'),
+                                   '/Mirror'], out)
+        command_sync(self.remote, [os.path.join(self.tempdir, 'dir')], out)
+
+        self.assertIn('uploaded\t0', out.getvalue())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tempdir, '.dropboxfs-sync-dir')))
+        with self.assertRaises(SystemExit):
+            command_sync(self.remote, [], out)
+
+
+class TestDropboxPool(unittest.TestCase):
+    """Test DropboxPool."""
+
+    def setUp(self):
+        self.pool = DropboxPool(max_accounts=3, max_cached=10)
+
+    def test_get(self):
+        """Test accounts are reused and share a session."""
+        fs = self.pool.get('123')
+
+        self.assertIs(fs, self.pool.get('123'))
+        self.assertIsNot(fs, self.pool.get('456'))
+        self.assertIs(self.pool.session, fs.client._session)
+        self.assertIs(
+            self.pool.session, self.pool.get('456').client._session)
+        self.assertEqual(2, len(self.pool))
+
+    def test_namespace(self):
+        """Test an account rooted in a namespace."""
+        fs = self.pool.get('123', namespace_id='42')
+
+        self.assertIsNot(fs, self.pool.get('123'))
+        self.assertEqual(
+            {'.tag': 'namespace_id', 'namespace_id': '42'},
+            json.loads(fs.client._headers['Dropbox-API-Path-Root']))
+        self.assertIsNone(self.pool.get('123').client._headers)
+
+    def test_evict_least_recently_used(self):
+        """Test the least recently used accounts are dropped."""
+        fs1 = self.pool.get('1')
+        self.pool.get('2')
+        self.pool.get('3')
+        self.pool.get('1')
+        self.pool.get('4')
+
+        self.assertEqual(
+            [('3', None), ('1', None), ('4', None)], self.pool.accounts.keys())
+
+        for i in range(20):
+            fs1.client.cache.set('/file%d' % i, None)
+        self.pool.get('5')
+
+        self.assertEqual([('4', None), ('5', None)], self.pool.accounts.keys())
+
+    @patch('dropboxfs.time.time')
+    def test_evict_idle(self, mock_time):
+        """Test idle accounts are dropped."""
+        mock_time.return_value = 1000
+        self.pool.get('1')
+        mock_time.return_value = 1000 + self.pool.idle_timeout
+
+        self.pool.get('2')
+
+        self.assertEqual([('2', None)], self.pool.accounts.keys())
+
+
+# Seconds importing dropboxfs may take in a fresh interpreter.
+IMPORT_TIME_TARGET = 1.0
+
+
+class TestImport(unittest.TestCase):
+    """Test the cost of importing dropboxfs."""
+
+    def test_import_time(self):
+        """Test importing is fast and leaves optional modules unloaded."""
+        script = (
+            'import sys, time\n'
+            'started = time.time()\n'
+            'import dropboxfs\n'
+            'elapsed = time.time() - started\n'
+            'dropboxfs.DropboxFS("123")\n'
+            'print elapsed\n'
+            'print " ".join(m for m in ("pytz", "mmap", "multiprocessing")\n'
+            '               if m in sys.modules)\n')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # Keep pytest-cov from measuring, and importing, in the child.
+        env = dict((k, v) for k, v in os.environ.items()
+                   if not k.startswith('COV_CORE_'))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], cwd=root, env=env).splitlines()
+
+        self.assertLess(float(output[0]), IMPORT_TIME_TARGET)
+        self.assertEqual([''], output[1:] or [''])